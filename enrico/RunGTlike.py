@@ -1,15 +1,17 @@
 #!/usr/bin/env python
 import os,glob,os.path,math
+from functools import partial
 from enrico import utils
 from enrico.gtfunction import Observation
 from enrico.fitmaker import FitMaker
+from enrico import pipeline
 import Loggin
 import SummedLikelihood
 from enrico.xml_model import XmlMaker
 from enrico.extern.configobj import ConfigObj
 from utils import hasKey, isKey, typeirfs
 
-def Analysis(folder, config, configgeneric=None, tag="", convtyp='-1', verbose = 1):
+def Analysis(folder, config, configgeneric=None, tag="", convtyp='-1', verbose = 1, generate = True):
 
     mes = Loggin.Message()
     """ run an analysis"""
@@ -19,11 +21,42 @@ def Analysis(folder, config, configgeneric=None, tag="", convtyp='-1', verbose =
         Obs.printSum()
 
     FitRunner = FitMaker(Obs, config)##Class
-    if config['Spectrum']['FitsGeneration'] == 'yes':
+    if config['Spectrum']['FitsGeneration'] == 'yes' and generate:
         FitRunner.FirstSelection(configgeneric) #Generates fits files for the coarse selection
         FitRunner.GenerateFits() #Generates fits files for the rest of the products
     return FitRunner
 
+def ComponentAnalyses(folder, components, verbose = 1):
+    """ run the analyses of the components (list of (config, tag)) of a
+    summed likelihood and return their FitMaker. The components are
+    independent: once the events are selected (one after the other since
+    the coarse selection file is shared), their fits files are generated
+    in parallel processes if [analysis]/Nprocess > 1. Only the likelihood
+    objects have to be built in the main process, by the caller"""
+    FitRunners = [Analysis(folder, config, tag=tag, verbose=verbose, generate=False)
+                  for config, tag in components]
+    if components[0][0]['Spectrum']['FitsGeneration'] != 'yes':
+        return FitRunners
+
+    nproc = pipeline.GetNprocess(components[0][0])
+    if nproc <= 1 or len(components) == 1:
+        for FitRunner in FitRunners:
+            FitRunner.FirstSelection(FitRunner.config)
+            FitRunner.GenerateFits()
+        return FitRunners
+
+    steps = []
+    for FitRunner, (config, tag) in zip(FitRunners, components):
+        FitRunner.FirstSelection(config)
+        FitRunner._log('gtselect', 'Select data from library, fine cut')
+        FitRunner.obs.SelectEvents()
+        # share the cores between the components
+        config['analysis']['Nprocess'] = max(1, nproc/len(components))
+        steps.append(pipeline.Step(tag, partial(FitRunner.GenerateFits, selection=False),
+                                   description='Generate the fits files of the component '+tag))
+    pipeline.RunGraph(steps, nproc)
+    return FitRunners
+
 def GenAnalysisObjects(config, verbose = 1, xmlfile =""):
 
     mes = Loggin.Message()
@@ -79,6 +112,7 @@ def GenAnalysisObjects(config, verbose = 1, xmlfile =""):
     if isKey(config['ComponentAnalysis'],'EDISP') == 'yes':
         evtnum = [64,128,256,521]
     oldxml = config['file']['xml']
+    components = []
     for k,evt in enumerate(evtnum):
         config['event']['evtype'] = evt
         config["file"]["xml"] = oldxml.replace(".xml","_"+typeirfs[evt]+".xml").replace("_.xml",".xml")
@@ -103,27 +137,22 @@ def GenAnalysisObjects(config, verbose = 1, xmlfile =""):
                     config['analysis']['likelihood'] = "unbinned"
                     config['analysis']['ComputeDiffrsp'] = "yes"
 
-                Analyse = Analysis(folder, config, \
-                    configgeneric=config,\
-                    tag=TYPE,\
-                    verbose=verbose)
-
-
-                Fit_component = Analyse.CreateLikeObject()
-                Fit.addComponent(Fit_component)
-            FitRunner = Analyse
-            FitRunner.obs.Emin = emintotal
-            FitRunner.obs.Emax = emaxtotal
+                # the config is modified for the next component: keep a copy
+                components.append((ConfigObj(config), tag))
 
         else:
-            Analyse = Analysis(folder, config, \
-                configgeneric=config,\
-                tag=typeirfs[evt], verbose = verbose)
-
-            if not(xmlfile ==""): Analyse.obs.xmlfile = xmlfile
-            Fit_component = Analyse.CreateLikeObject()
-            Fit.addComponent(Fit_component)
+            components.append((ConfigObj(config), typeirfs[evt]))
+
+    Analyses = ComponentAnalyses(folder, components, verbose = verbose)
+    for Analyse in Analyses:
+        if not(xmlfile =="") and not(EUnBinned>emintotal and EUnBinned<emaxtotal):
+            Analyse.obs.xmlfile = xmlfile
+        Fit_component = Analyse.CreateLikeObject()
+        Fit.addComponent(Fit_component)
     FitRunner = Analyse
+    if EUnBinned>emintotal and EUnBinned<emaxtotal:
+        FitRunner.obs.Emin = emintotal
+        FitRunner.obs.Emax = emaxtotal
 
     config["event"]["evtype"] = evtold
     FitRunner.config = config
@@ -183,7 +212,7 @@ def run(infile):
     if config['Spectrum']['ResultPlots'] == 'yes' :
         outXml = utils._dump_xml(config)
         # the possibility of making the model map is checked inside the function
-        FitRunner.ModelMap(outXml)
+        FitRunner.ModelMap(outXml, Fit)
 
     #  Make energy bins by running a *new* analysis
     Nbin = config['Ebin']['NumEnergyBins']
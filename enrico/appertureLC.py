@@ -1,21 +1,19 @@
 #!/usr/bin/env python
 import os
 import numpy as np
-import ROOT
 import pyfits
 from enrico.constants import  DAY_IN_SECOND, AppLCPath #met_ref, mdj_ref,
 from enrico.gtfunction import Observation
 from enrico.config import get_config
 from enrico import environ
 from enrico import utils
-import matplotlib
-matplotlib.rc('text', usetex=True)
-import matplotlib.pyplot as plt
+from enrico import render
+from enrico import exposure
+from enrico.plotting import LoadPyplot
+from enrico.bayesianblocks import BayesianBlocks, BlocksContent
 
 def AppLC(infile):
     '''Main function of the apperture photometrie Lightcurve script. Read the config file and run the analysis'''
-    ROOT.gROOT.SetBatch(ROOT.kTRUE) #Batch mode
-
     enricodir = environ.DIRS.get('ENRICO_DIR')
     fermidir = environ.DIRS.get('FERMI_DIR')
     config = get_config(infile)
@@ -48,7 +46,7 @@ def AppLC(infile):
             Obs.GtLCbin(dt = dt)
         else:
             spfile=pyfits.open(Obs.eventfile)
-            diff = spfile[1].data.field(9)[1:-1]-spfile[1].data.field(9)[:-2]
+            diff = spfile[1].data.field('TIME')[1:-1]-spfile[1].data.field('TIME')[:-2]
             dt = np.min(diff)/2.  ##Compute the delta T as being the min delta t between 2 events divided by 2
             timefile = LCoutfolder+"/Timebin.txt"
             MakeTimebinFile(Obs,timefile)
@@ -57,109 +55,139 @@ def AppLC(infile):
             _log('gtbin', 'bin the data into a light-curve using bins based on data')#run gtbin
             Obs.GtLCbin(dt = 0)
 
-        _log('gtexposure', 'compute the exposure')#run gtexposure
-        Obs.GtExposure()
+        if config['AppLC']['ExposureTool'] == 'enrico':
+            _log('exposure', 'compute the exposure of all the bins in one pass')
+            exposure.WriteLCExposure(Obs,config['AppLC']['index'])
+        else:
+            _log('gtexposure', 'compute the exposure')#run gtexposure
+            Obs.GtExposure()
 
     #Get Some usefull value here. This allow PlotAppLC to be call independently
     Nbins = config['AppLC']['NLCbin']#Number of bins
-    #Plot the results and dump into ascii files
-    PlotAppLC(Nbins,LCoutfolder,Obs.lcfile)
+    #Compute the LC, dump it into a fits table and plot the results
+    LCfile = PlotAppLC(Nbins,LCoutfolder,Obs.lcfile)
+    render.Render(config, DrawAppLC, LCfile, LCoutfolder)
+
+    if config['AppLC']['BayesianBlocks'] == "yes":
+        _log('Bayesian blocks', 'compute the blocks on the photon arrival times')
+        EventBlocks(LCoutfolder,Obs.eventfile,config['AppLC']['p0'])
 
 def MakeTimebinFile(Obs,timefile):
     spfile = pyfits.open(Obs.eventfile)
-    spfile[1].data.sort(order='TIME')
-    Time = spfile[1].data.field(9)[:-1]
+    Time = np.sort(spfile[1].data.field('TIME'))[:-1]
+    spfile.close()
 
-    bounds = ((Time[1:] + Time[:-1])/2.).tolist() # compute the edge of the cells
-    bounds.insert(0,Obs.t1)
-    bounds.append(Obs.t2)
+    # compute the edge of the cells
+    bounds = np.concatenate([[Obs.t1],(Time[1:] + Time[:-1])/2.,[Obs.t2]])
 
     print len(Time)
-    fil = open(timefile,"w")
-    for i in xrange(len(bounds)-1):
-        fil.write(str(bounds[i])+'\t'+str(bounds[i+1])+'\n')
-    fil.close()
+    np.savetxt(timefile,np.transpose([bounds[:-1],bounds[1:]]),delimiter='\t')
+
+def ComputeAppLC(Nbins,FITSfile):
+    '''Read the LC made by gtbin and gtexposure and rebin it into Nbins bins.
+    Return the bins of the input file (time in MJD) and the rebinned LC'''
+    spfile = pyfits.open(FITSfile)
+    data = spfile[1].data
+    order = np.argsort(data.field('TIME'))[:-1]
+
+    Time = utils.met_to_MJD(data.field('TIME')[order])
+    dTime = data.field('TIMEDEL')[order]/DAY_IN_SECOND
+    Counts = data.field('COUNTS')[order]
+    Exposure = data.field('EXPOSURE')[order]
+    spfile.close()
+
+    #Only the bins with events and exposure are used
+    edges = np.linspace(Time[0],Time[-1],Nbins+1)
+    used = (Counts>0)*(Exposure>0)
+    index = np.searchsorted(edges,Time[used],side='right')-1
+    index[index==Nbins] = Nbins-1 # last edge belongs to the last bin
+    LCCounts = np.bincount(index,weights=Counts[used],minlength=Nbins)
+    LCExposure = np.bincount(index,weights=Exposure[used],minlength=Nbins)
+
+    #Correct for exposure
+    LCFlux = np.zeros(Nbins)
+    LCFluxErr = np.zeros(Nbins)
+    nonzero = LCExposure>0
+    LCFlux[nonzero] = LCCounts[nonzero]/LCExposure[nonzero]
+    LCFluxErr[nonzero] = np.sqrt(LCCounts[nonzero])/LCExposure[nonzero]
+
+    inputbins = (Time,dTime,Counts,Exposure)
+    lc = (0.5*(edges[1:]+edges[:-1]),np.diff(edges),LCCounts,
+          np.sqrt(LCCounts),LCExposure,LCFlux,LCFluxErr)
+    return inputbins, lc
+
+def _BinTable(name,columns):
+    '''Make a fits binary table from a list of (name,unit,array)'''
+    cols = [pyfits.Column(name=colname,format='D',unit=unit,array=array)
+            for colname,unit,array in columns]
+    try:
+        hdu = pyfits.BinTableHDU.from_columns(cols)
+    except AttributeError: # pyfits < 3.3
+        hdu = pyfits.new_table(cols)
+    hdu.name = name
+    return hdu
 
 def PlotAppLC(Nbins,LCoutfolder,FITSfile):
-
-    ROOT.gStyle.SetOptStat(0)
-
-    spfile=pyfits.open(FITSfile)
-    spfile[1].data.sort(order='TIME')
-
-    Time =  utils.met_to_MJD(spfile[1].data.field(0)[:-1])#mdj_ref+(spfile[1].data.field(0)[:-1]-met_ref)/DAY_IN_SECOND
-    dTime = (spfile[1].data.field(1)[:-1])/DAY_IN_SECOND
-    Counts = (spfile[1].data.field(2)[:-1])
-    Exposure = (spfile[1].data.field(4)[:-1])
-
-    count_histo =ROOT.TH1F("count","count",Nbins,Time[0],Time[-1])
-    expo_histo =ROOT.TH1F("exposure","exposure",Nbins,Time[0],Time[-1])
-    for i in xrange(len(Time)):
-      if Counts[i]>0 and Exposure[i] :
-          count_histo.Fill(Time[i],Counts[i])
-          expo_histo.Fill(Time[i],Exposure[i])
-
-    flux_histo =ROOT.TH1F()
-    count_histo.Copy(flux_histo) #correct for exposure
-    flux_histo.Divide(expo_histo)
-
-    for i in xrange(Nbins):#Correct error for exposure
-        if expo_histo.GetBinContent(i+1)>0:
-            flux_histo.SetBinError(i+1,count_histo.GetBinError(i+1)/expo_histo.GetBinContent(i+1))
-
-    ######################################################################################
+    '''Compute the apperture photometry LC and save it, with the input time
+    bins, into LCoutfolder/AppLC.fits. Return the name of this file'''
+    (Time,dTime,Counts,Exposure),lc = ComputeAppLC(Nbins,FITSfile)
+
+    hdus = pyfits.HDUList([pyfits.PrimaryHDU()])
+    hdus.append(_BinTable('LIGHTCURVE',zip(
+        ['TIME','TIMEDEL','COUNTS','COUNTS_ERR','EXPOSURE','FLUX','FLUX_ERR'],
+        ['d','d','count','count','cm**2 s','cm**-2 s**-1','cm**-2 s**-1'],lc)))
     #Save event time exposure and count
-    file_evt = open(LCoutfolder+'/TimeExposureCount.txt',"w")
-
-    #Write into file
-    file_evt.write("Time\tdTime\tExposure\tCounts\n")
-    for i in xrange(len(Time)):
-       file_evt.write(str(Time[i])+"\t"+str(dTime[i])+"\t"+str(Exposure[i])+"\t"+str(Counts[i])+"\n")
-    file_evt.close()
-    ######################################################################################
-
-    file_lc = open(LCoutfolder+'/AppLC.txt',"w")
-    for i in xrange(Nbins):
-        file_lc.write(str(flux_histo.GetBinCenter(i))+"\t"+str(flux_histo.GetBinContent(i))+"\t"+str(expo_histo.GetBinContent(i))+"\n")
-    file_lc.close()
-
-    CanvCount = ROOT.TCanvas()
-    count_histo.SetMarkerStyle(20)
-    count_histo.SetLineColor(1)
-    count_histo.SetMarkerColor(1)
-    count_histo.SetXTitle("Time (MJD)")
-    count_histo.Draw("ep")
-
-   #Save the canvas in the Apperture LightCurve subfolder
-    CanvCount.Print(LCoutfolder+'/Counts.eps')
-    CanvCount.Print(LCoutfolder+'/Counts.C')
-
-    CanvExposure = ROOT.TCanvas()
-    CanvExposure.SetGridx()
-    CanvExposure.SetGridy()
-    expo_histo.SetMarkerStyle(20)
-    expo_histo.SetLineColor(1)
-    expo_histo.SetMarkerColor(1)
-    expo_histo.SetXTitle("Time (MJD)")
-    expo_histo.Draw("ep")
-
-   #Save the canvas in the Apperture LightCurve subfolder
-    CanvExposure.Print(LCoutfolder+'/Exposure.eps')
-    CanvExposure.Print(LCoutfolder+'/Exposure.C')
-
-
-    CanvFlux = ROOT.TCanvas()
-    flux_histo.SetNameTitle("Apperture_Photometry_Flux","Apperture_Photometry_Flux")
-    flux_histo.SetYTitle("Flux")
-    flux_histo.SetXTitle("Time (MJD)")
-    flux_histo.SetMarkerStyle(20)
-    flux_histo.SetLineColor(1)
-    flux_histo.SetMarkerColor(1)
-    flux_histo.Draw("ep")
-
-   #Save the canvas in the Apperture LightCurve subfolder
-    CanvFlux.Print(LCoutfolder+'/AppLC.eps')
-    CanvFlux.Print(LCoutfolder+'/AppLC.C')
+    hdus.append(_BinTable('TIMEBINS',zip(
+        ['TIME','TIMEDEL','COUNTS','EXPOSURE'],['d','d','count','cm**2 s'],
+        [Time,dTime,Counts,Exposure])))
+
+    LCfile = LCoutfolder+'/AppLC.fits'
+    if os.path.isfile(LCfile):
+        os.remove(LCfile)
+    hdus.writeto(LCfile)
+    return LCfile
+
+def DrawAppLC(LCfile,LCoutfolder):
+    '''Plot the counts, the exposure and the flux from the AppLC.fits file'''
+    plt = LoadPyplot()
+    spfile = pyfits.open(LCfile)
+    lc = spfile['LIGHTCURVE'].data
+    Time, dTime = lc.field('TIME'), lc.field('TIMEDEL')/2.
+    zeros = np.zeros(len(Time))
+
+    for name,value,error,ylabel in [
+        ('Counts',lc.field('COUNTS'),lc.field('COUNTS_ERR'),'Counts'),
+        ('Exposure',lc.field('EXPOSURE'),zeros,r'Exposure (cm$^2$ s)'),
+        ('AppLC',lc.field('FLUX'),lc.field('FLUX_ERR'),r'Flux (cm$^{-2}$ s$^{-1}$)')]:
+        plt.figure()
+        plt.errorbar(Time,value,xerr=dTime,yerr=error,fmt='o',color='black',ls='None')
+        plt.xlabel("Time (MJD)")
+        plt.ylabel(ylabel)
+        if name == 'Exposure':
+            plt.grid()
+        #Save the plot in the Apperture LightCurve subfolder
+        plt.savefig(LCoutfolder+'/'+name+'.png', dpi=150, facecolor='w', edgecolor='w',
+            orientation='portrait', papertype=None, format=None,
+            transparent=False, bbox_inches=None, pad_inches=0.1,
+            frameon=None)
+        plt.close()
+    spfile.close()
+
+def EventBlocks(LCoutfolder,eventfile,p0=0.05):
+    '''Compute the bayesian blocks on the arrival times of the events
+    and dump the blocks (start, stop, counts and rate) into an ascii file'''
+    spfile = pyfits.open(eventfile)
+    Time = spfile[1].data.field('TIME')
+    spfile.close()
+
+    edges = BayesianBlocks(Time,fitness='events',p0=p0)
+    Counts, Rate = BlocksContent(edges,Time)
+    print "Found %d blocks with %d events"%(len(Counts),len(Time))
+
+    np.savetxt(LCoutfolder+'/BayesianBlocks.txt',
+               np.transpose([utils.met_to_MJD(edges[:-1]),utils.met_to_MJD(edges[1:]),Counts,Rate]),
+               header="Tstart (MJD)\tTstop (MJD)\tCounts\tRate (s-1)",delimiter="\t")
+    return edges, Counts, Rate
 
 def _log(task='', description=''):
     print
@@ -0,0 +1,219 @@
+"""Bayesian blocks (Scargle et al. 2012) for long light curves and event lists.
+
+The dynamic program of Scargle et al. is O(N^2): every new data cell is
+compared with all the previous ones. Both fitness functions used here
+(events and point measures) never decrease when a block is split, so a
+change point which can not beat the current optimum at step R will never
+beat it later and can be dropped (PELT pruning, Killick et al. 2012).
+Since PELT alone keeps most of the candidates when the flux is constant,
+the candidates are also dropped when a later one does better whatever
+the rate of the last block (functional pruning, Maidstone et al. 2017).
+The fitness of the surviving candidates is evaluated by chunks of steps,
+using prefix sums, with a bounded memory footprint. This makes the
+computation on 10^6 photon arrival times possible (a few minutes).
+"""
+import numpy as np
+from scipy.special import lambertw
+
+# maximum number of fitness values evaluated at once (8 MB in double)
+CHUNK_SIZE = 2 ** 20
+# number of steps between two functional prunings
+CHUNK_STEPS = 32
+
+
+def p0Prior(N, p0=0.05):
+    """Empirical prior on the number of blocks given the false alarm
+    probability p0 (eq. 21 of Scargle 2012, corrected in arXiv:1304.2818)"""
+    return 4 - np.log(73.53 * p0 * (N ** -0.478))
+
+
+def _PrepareInput(t, x, sigma, fitness):
+    """Sort the data and return the times, the weights used by the
+    fitness function and the edges of the data cells"""
+    t = np.asarray(t, dtype=float)
+    if t.ndim != 1:
+        raise ValueError("t must be a one-dimensional array")
+
+    if fitness == 'events':
+        if sigma is not None:
+            raise ValueError("sigma can not be used with fitness='events'")
+        if x is None:
+            # photon arrival times : count the events at each time
+            t, inverse = np.unique(t, return_inverse=True)
+            x = np.bincount(inverse).astype(float)
+        else:
+            x = np.asarray(x, dtype=float) + np.zeros_like(t)
+            if np.any(x % 1 > 0) or np.any(x < 0):
+                raise ValueError("x must be integer counts for fitness='events'")
+            order = np.argsort(t, kind='mergesort')
+            t, x = t[order], x[order]
+            if np.any(np.diff(t) == 0):
+                raise ValueError("Repeated values in t not supported when "
+                                 "x is specified")
+        weights = (x,)
+
+    elif fitness == 'measures':
+        if x is None:
+            raise ValueError("x must be specified for point measures")
+        x = np.asarray(x, dtype=float) + np.zeros_like(t)
+        if sigma is None:
+            sigma = 1.
+        sigma = np.asarray(sigma, dtype=float) + np.zeros_like(t)
+        order = np.argsort(t, kind='mergesort')
+        t, x, sigma = t[order], x[order], sigma[order]
+        # a_k and b_k of eq. 31 and 32
+        weights = (0.5 / sigma ** 2, -x / sigma ** 2)
+
+    else:
+        raise ValueError("fitness should be 'events' or 'measures'")
+
+    edges = np.concatenate([t[:1], 0.5 * (t[1:] + t[:-1]), t[-1:]])
+    return t, weights, edges
+
+
+def _EventsInterval(D, dS, dE, lo, hi):
+    """Interval of log(rate) where a candidate start stays at least as good
+    as a later one, for the events fitness. The later candidate is better
+    where D - dS*u + dE*exp(u) > 0, the roots are given by the Lambert W
+    function. Return the intersection with [lo, hi] (empty if lo > hi)"""
+    logz = np.log(dE / dS) + D / dS
+    has_root = logz <= -1.
+    z = -np.exp(np.minimum(logz, -1.))
+    u1 = D / dS - lambertw(z, 0).real
+    u2 = D / dS - lambertw(z, -1).real
+    u2[np.isnan(u2)] = np.inf  # z -> 0
+    lo = np.where(has_root, np.maximum(lo, u1), np.inf)
+    hi = np.where(has_root, np.minimum(hi, u2), -np.inf)
+    return lo, hi
+
+
+def _MeasuresInterval(D, dA, dB, lo, hi):
+    """Same as _EventsInterval for the point measures fitness, the later
+    candidate being better where D + dA*mu**2 + dB*mu > 0"""
+    delta = dB * dB - 4 * dA * D
+    has_root = delta >= 0
+    sqrt_delta = np.sqrt(np.maximum(delta, 0))
+    lo = np.where(has_root, np.maximum(lo, (-dB - sqrt_delta) / (2 * dA)), np.inf)
+    hi = np.where(has_root, np.minimum(hi, (-dB + sqrt_delta) / (2 * dA)), -np.inf)
+    return lo, hi
+
+
+def BayesianBlocks(t, x=None, sigma=None, fitness='events', p0=0.05,
+                   ncp_prior=None):
+    """Compute the optimal segmentation of the data into blocks.
+
+    t is the array of times. With fitness='events', t are the arrival
+    times of the events (or the bin centers if the counts x are given).
+    With fitness='measures', x and sigma are the measured values and
+    their errors. The prior on the number of blocks is given by ncp_prior
+    or computed from the false alarm probability p0.
+
+    Return the array of the (M+1) edges of the M blocks."""
+    t, weights, edges = _PrepareInput(t, x, sigma, fitness)
+    N = len(t)
+    if N < 2:
+        return edges
+
+    if ncp_prior is None:
+        ncp_prior = p0Prior(N, p0)
+
+    # prefix sums : the weight of the cells [r, e[ is cum[e]-cum[r]
+    cums = [np.concatenate([[0.], np.cumsum(w)]) for w in weights]
+
+    if fitness == 'events':
+        def Fitness(start, end):
+            N_k = cums[0][end] - cums[0][start]
+            T_k = edges[end] - edges[start]
+            return N_k * (np.log(N_k) - np.log(T_k))  # eq. 19
+
+        def Interval(old, new, lo, hi):
+            # fitness = max over the rate of N*log(rate)-rate*T, plus N
+            D = (best[new] - cums[0][new]) - (best[old] - cums[0][old])
+            return _EventsInterval(D, cums[0][new] - cums[0][old],
+                                   edges[new] - edges[old], lo, hi)
+
+        # the rate of any block lies between the rates of the cells
+        cell_rate = weights[0] / np.diff(edges)
+        bounds = np.log(cell_rate.min()), np.log(cell_rate.max())
+    else:
+        def Fitness(start, end):
+            a_k = cums[0][end] - cums[0][start]
+            b_k = cums[1][end] - cums[1][start]
+            return b_k * b_k / (4 * a_k)  # eq. 41
+
+        def Interval(old, new, lo, hi):
+            # fitness = max over the mean mu of -a*mu**2-b*mu
+            return _MeasuresInterval(best[new] - best[old],
+                                     cums[0][new] - cums[0][old],
+                                     cums[1][new] - cums[1][old], lo, hi)
+
+        bounds = -np.inf, np.inf
+
+    best = np.zeros(N + 1)  # best[R] : optimal fitness of the first R cells
+    last = np.zeros(N, dtype=int)  # start of the last block ending at R
+    # candidate starts that survived and the interval of rate (or mean)
+    # where they are still the best one
+    active = np.zeros(0, dtype=int)
+    lo = np.zeros(0)
+    hi = np.zeros(0)
+
+    R0 = 0
+    while R0 < N:
+        # the number of steps in the chunk is set by the memory budget :
+        # (len(active) + nstep) * nstep <= CHUNK_SIZE
+        na = len(active)
+        nstep = int(0.5 * (np.sqrt(na * na + 4. * CHUNK_SIZE) - na))
+        R1 = min(N, R0 + max(16, min(CHUNK_STEPS, nstep)))
+        starts = np.concatenate([active, np.arange(R0, R1)])
+        ends = np.arange(R0 + 1, R1 + 1)
+        # entries with start >= end are never used
+        olderr = np.seterr(all='ignore')
+        fit = Fitness(starts[:, np.newaxis], ends[np.newaxis, :])
+        np.seterr(**olderr)
+
+        # score of the blocks before each candidate start, -inf once pruned
+        base = np.zeros(len(starts))
+        base[:na] = best[active]
+        for j in xrange(R1 - R0):
+            n = na + j + 1
+            base[n - 1] = best[R0 + j]
+            values = fit[:n, j] + base[:n]
+            i_max = np.argmax(values)
+            best[R0 + j + 1] = values[i_max] - ncp_prior
+            last[R0 + j] = starts[i_max]
+            # PELT pruning
+            tolerance = 1e-10 * (1. + abs(best[R0 + j + 1]))
+            base[:n][values < best[R0 + j + 1] - tolerance] = -np.inf
+
+        # functional pruning : a candidate start is dropped when, whatever
+        # the rate (or mean) of the last block, the newest start does better
+        alive = np.isfinite(base)
+        active = starts[alive]
+        lo = np.concatenate([lo, np.repeat(bounds[0], R1 - R0)])[alive]
+        hi = np.concatenate([hi, np.repeat(bounds[1], R1 - R0)])[alive]
+        older = active < R1 - 1
+        olderr = np.seterr(all='ignore')
+        lo[older], hi[older] = Interval(active[older], R1 - 1,
+                                        lo[older], hi[older])
+        np.seterr(**olderr)
+        keep = lo <= hi
+        active, lo, hi = active[keep], lo[keep], hi[keep]
+        R0 = R1
+
+    # find the change points by peeling off the last block
+    change_points = [N]
+    while change_points[-1] > 0:
+        change_points.append(last[change_points[-1] - 1])
+    return edges[change_points[::-1]]
+
+
+def BlocksContent(edges, t, x=None):
+    """Return the counts and the rate in each block for an event list t
+    (or binned counts x at the times t)"""
+    t = np.asarray(t, dtype=float)
+    if x is None:
+        x = np.ones_like(t)
+    counts = np.histogram(t, bins=edges, weights=x)[0]
+    rate = counts / np.diff(edges)
+    return counts, rate
+
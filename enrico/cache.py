@@ -0,0 +1,155 @@
+"""
+Content-addressed cache for the products of the ScienceTools.
+The key of a product is a hash of the tool name, of its parameters
+(without the name of the output file) and of the content of all the
+input files. The products are stored in a shared cache directory and
+hard-linked (or copied if not possible) into the analysis folder, so that
+repeated or overlapping analyses reuse the products which are still valid.
+The cache is used if [environ]/ENRICO_CACHE_DIR (or the shell variable
+of the same name) is set.
+"""
+import os
+import shutil
+import hashlib
+from enrico import environ
+from enrico import Loggin
+from enrico import timing
+
+# parameters which do not change the content of the product
+IGNORED_PARAMETERS = ['outfile', 'clobber', 'chatter', 'debug', 'gui', 'mode']
+BLOCKSIZE = 2**20
+
+
+def GetCacheDir(config):
+    """Return the cache directory, or '' if the cache is not used"""
+    try:
+        cachedir = config['environ']['ENRICO_CACHE_DIR']
+    except KeyError:
+        cachedir = ''
+    return cachedir or environ.CACHE_DIR
+
+
+def _WriteAtomic(filename, content):
+    tmpfile = filename+'.%d.tmp' % os.getpid()
+    with open(tmpfile, 'w') as f:
+        f.write(content)
+    os.rename(tmpfile, filename)
+
+
+def FileHash(filename, cachedir):
+    """Hash of the content of a file. The result is memoized in the cache
+    directory using the path, size and modification time of the file"""
+    stat = os.stat(filename)
+    memo = hashlib.sha1('%s:%d:%r' % (os.path.realpath(filename), stat.st_size,
+                                      stat.st_mtime)).hexdigest()
+    memofile = os.path.join(cachedir, 'hashes', memo)
+    if os.path.isfile(memofile):
+        return open(memofile).read()
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        block = f.read(BLOCKSIZE)
+        while block:
+            sha1.update(block)
+            block = f.read(BLOCKSIZE)
+    _WriteAtomic(memofile, sha1.hexdigest())
+    return sha1.hexdigest()
+
+
+def _InputHash(value, cachedir):
+    """Hash of a parameter value if it is a file (or a @list of files)"""
+    if value.startswith('@') and os.path.isfile(value[1:]):
+        hashes = [FileHash(value[1:], cachedir)]
+        for line in open(value[1:]):
+            if line.strip() != '':
+                hashes.append(FileHash(line.strip(), cachedir))
+        return ':'.join(hashes)
+    if os.path.isfile(value):
+        return FileHash(value, cachedir)
+    return None
+
+
+def _Parameters(app):
+    """Parameters of the GtApp app: dictionnary name -> value"""
+    try:
+        names = app.keys()
+    except AttributeError:
+        names = app.pars.keys()
+    return dict((name, str(app[name])) for name in names)
+
+
+def ProductKey(app, cachedir, ignored=()):
+    """Key of the product of the GtApp app, the parameters ignored being
+    excluded"""
+    items = []
+    for name, value in sorted(_Parameters(app).items()):
+        if name in IGNORED_PARAMETERS or name in ignored:
+            continue
+        filehash = _InputHash(value, cachedir)
+        if filehash is not None:
+            value = 'file:'+filehash  # the content matters, not the name
+        items.append([name, value])
+    # the values may contain spaces: hash an unambiguous representation
+    return hashlib.sha1(repr([app.appName, items])).hexdigest()
+
+
+def LinkFile(source, destination):
+    """Hard link source to destination, or copy it if it is not possible"""
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def Unshare(filename):
+    """Make sure that a file linked with the cache is not modified in place
+    (e.g. by gtdiffrsp) by replacing it with a private copy"""
+    if os.path.isfile(filename) and os.stat(filename).st_nlink > 1:
+        tmpfile = filename+'.%d.tmp' % os.getpid()
+        shutil.copy2(filename, tmpfile)
+        os.rename(tmpfile, filename)
+
+
+def RunCached(app, config, outfile=None, inplace=False):
+    """Run the GtApp app, unless its product is found in the cache.
+    If inplace is True, the tool modifies outfile (e.g. gtdiffrsp)"""
+    if outfile is None:
+        outfile = app['outfile']
+    with timing.Stage(config, app.appName, outfile) as stage:
+        stage.info['cached'] = _RunCached(app, config, outfile, inplace)
+
+
+def _RunCached(app, config, outfile, inplace):
+    """Body of RunCached, return True if the product comes from the cache"""
+    cachedir = GetCacheDir(config)
+    if cachedir == '':
+        app.run()
+        return False
+    for subdir in ['hashes', 'products']:
+        if not os.path.isdir(os.path.join(cachedir, subdir)):
+            try:
+                os.makedirs(os.path.join(cachedir, subdir))
+            except OSError: # created by another job
+                pass
+
+    mes = Loggin.Message()
+    key = ProductKey(app, cachedir)
+    product = os.path.join(cachedir, 'products', key+os.path.splitext(outfile)[1])
+    if os.path.isfile(product):
+        mes.info("Reuse cached product "+product)
+        LinkFile(product, outfile)
+        return True
+
+    # never write through a link to a cached product
+    if inplace:
+        Unshare(outfile)
+    elif os.path.lexists(outfile) and os.stat(outfile).st_nlink > 1:
+        os.remove(outfile)
+    app.run()
+    if os.path.isfile(outfile):
+        tmpfile = product+'.%d.tmp' % os.getpid()
+        LinkFile(outfile, tmpfile)
+        os.rename(tmpfile, product)
+    return False
@@ -0,0 +1,138 @@
+"""
+Fast access to the Fermi catalogs for the XML generation.
+The FITS catalog is read once and converted into a snapshot: numpy arrays
+of the columns used by enrico, the unit vectors of the sources and the
+spatial template of the extended sources. The snapshot is kept in memory
+and, if the cache directory ([environ]/ENRICO_CACHE_DIR) is set, stored in
+<ENRICO_CACHE_DIR>/catalogs so that the other jobs do not read the FITS
+file again. The sources in a cone are found with a k-d tree of the unit
+vectors.
+"""
+import os
+import numpy as np
+import pyfits
+from scipy.spatial import cKDTree
+from enrico import cache
+
+# changed when the content of the snapshot changes
+SNAPSHOT_VERSION = 1
+
+#Catalogs already loaded, by (path, size, modification time)
+_Catalogs = {}
+
+
+def UnitVector(ra, dec):
+    """Unit vectors of the directions (ra, dec) in degrees"""
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+
+
+def _Strings(column):
+    return np.char.strip(np.array(column, dtype=str))
+
+
+def ReadCatalog(catalog):
+    """Read the columns used by enrico in the FITS catalog, return a dict
+    of arrays"""
+    cfile = pyfits.open(catalog)
+    data = cfile[1].data
+    columns = {'names': _Strings(data.field('Source_Name')),
+               'ra': np.array(data.field('RAJ2000')),
+               'dec': np.array(data.field('DEJ2000')),
+               'flux': np.array(data.field('Flux_Density')),
+               'pivot': np.array(data.field('Pivot_Energy')),
+               'sigma': np.array(data.field('Signif_Avg')),
+               'spectype': _Strings(data.field('SpectrumType')),
+               'extendedName': _Strings(data.field('Extended_Source_Name'))}
+    if 'FL8Y' in cfile[1].header['CDS-NAME']:
+        columns['index'] = np.array(data.field('PL_Index'))
+        columns['beta'] = np.array(data.field('LP_beta'))
+        # From the makeFL8Yxml.py script
+        expfac = data.field('PLEC_Expfactor')
+        expind = data.field('PLEC_Exp_Index')
+        columns['cutoff'] = np.array((1./expfac)**(1./expind))
+        extended = cfile[2].data
+    else:
+        columns['index'] = np.array(data.field('Spectral_Index'))
+        columns['cutoff'] = np.array(data.field('Cutoff'))
+        columns['beta'] = np.array(data.field('beta'))
+        extended = cfile[5].data
+
+    # spatial template of each source, "" for the point sources
+    templates = dict(zip(_Strings(extended.field('Source_Name')),
+                         _Strings(extended.field('Spatial_Filename'))))
+    columns['extended'] = np.array([templates.get(name, "") for name in columns['extendedName']], dtype=str)
+    cfile.close()
+    return columns
+
+
+class Catalog(object):
+    """Snapshot of a catalog: the columns are available as attributes
+    (names, ra, dec, flux, pivot, index, cutoff, beta, sigma, spectype,
+    extendedName and extended, the spatial template)"""
+    def __init__(self, columns):
+        self.columns = columns
+        for key in columns:
+            setattr(self, key, columns[key])
+        self.vectors = UnitVector(self.ra, self.dec)
+        self.tree = cKDTree(self.vectors)
+
+    def __len__(self):
+        return len(self.names)
+
+    def Separation(self, ra, dec, indices=None):
+        """Angular separation (deg) between (ra, dec) and the sources"""
+        vectors = self.vectors if indices is None else self.vectors[indices]
+        vec = UnitVector(ra, dec)
+        # accurate at all distances, as utils.calcAngSepDeg
+        cross = np.sqrt(np.sum(np.cross(vectors, vec)**2, axis=-1))
+        return np.degrees(np.arctan2(cross, np.dot(vectors, vec)))
+
+    def Cone(self, ra, dec, radius):
+        """Indices, in the order of the catalog, of the sources closer than
+        radius (deg) to (ra, dec)"""
+        chord = 2*np.sin(np.radians(min(radius, 180.))/2)
+        indices = self.tree.query_ball_point(UnitVector(ra, dec), chord*(1+1e-9))
+        return np.array(sorted(indices), dtype=int)
+
+
+def _SnapshotFile(catalog, cachedir):
+    if not os.path.isdir(os.path.join(cachedir, 'hashes')):
+        try:
+            os.makedirs(os.path.join(cachedir, 'hashes'))
+        except OSError: # created by another job
+            pass
+    key = cache.FileHash(catalog, cachedir)
+    return os.path.join(cachedir, 'catalogs', 'catalog_%d_%s.npz' % (SNAPSHOT_VERSION, key))
+
+
+def LoadCatalog(catalog, config=None):
+    """Return the Catalog of the FITS file catalog, from the snapshot if
+    it exists"""
+    stat = os.stat(catalog)
+    memo = (os.path.realpath(catalog), stat.st_size, stat.st_mtime)
+    if memo in _Catalogs:
+        return _Catalogs[memo]
+
+    cachedir = '' if config is None else cache.GetCacheDir(config)
+    columns = None
+    if cachedir != '':
+        snapshot = _SnapshotFile(catalog, cachedir)
+        if os.path.isfile(snapshot):
+            data = np.load(snapshot)
+            columns = dict((key, data[key]) for key in data.files)
+    if columns is None:
+        columns = ReadCatalog(catalog)
+        if cachedir != '':
+            if not os.path.isdir(os.path.dirname(snapshot)):
+                try:
+                    os.makedirs(os.path.dirname(snapshot))
+                except OSError: # created by another job
+                    pass
+            tmpfile = snapshot+'.%d.tmp' % os.getpid()
+            with open(tmpfile, 'wb') as f:
+                np.savez(f, **columns)
+            os.rename(tmpfile, snapshot)
+
+    _Catalogs[memo] = Catalog(columns)
+    return _Catalogs[memo]
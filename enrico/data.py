@@ -1,5 +1,6 @@
 """Utilities to download / preprocess data"""
 import os
+import posixpath
 from os.path import join
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -12,7 +13,8 @@ from enrico.environ import DIFFUSE_ISO_SOURCEEDISP0, DIFFUSE_ISO_SOURCEEDISP1, D
 from enrico.environ import DIFFUSE_ISO_CLEANPSF0, DIFFUSE_ISO_CLEANPSF1, DIFFUSE_ISO_CLEANPSF2, DIFFUSE_ISO_CLEANPSF3
 from enrico.environ import DIFFUSE_ISO_CLEANEDISP0, DIFFUSE_ISO_CLEANEDISP1, DIFFUSE_ISO_CLEANEDISP2, DIFFUSE_ISO_CLEANEDISP3
 from enrico.environ import DIRS, DOWNLOAD_DIR, CATALOG_TEMPLATE_DIR, TEMPLATE_VERSION, PREPROCESSED_DIR
-from enrico.environ import WEEKLY_DIR, SPACECRAFT, USE_FULLMISSION_SPACECRAFT
+from enrico.environ import WEEKLY_DIR, WEEKLY_SC_DIR, SPACECRAFT, USE_FULLMISSION_SPACECRAFT
+from enrico import download
 
 #TODO: Read from default config
 default_filter = 'DATA_QUAL==1&&LAT_CONFIG==1&&ABS(ROCK_ANGLE)<52'
@@ -117,47 +119,39 @@ class Data(object):
         self.clobber = clobber
         self.debug = debug
 
-    def download(self, spacecraft=True, photon=True):
+    def download(self, spacecraft=True, photon=True,
+                 nworkers=download.NWORKERS, verify=False):
         """Download spacecraft file and weekly photon files.
 
-        Uses wget to download new data incrementally from
-        the Fermi LAT data server.
-        For info on wget options see
-        http://www.gnu.org/software/wget/manual/wget.html"""
-        os.chdir(DOWNLOAD_DIR)
+        Only the new or changed files of the Fermi LAT data server
+        are downloaded, nworkers at a time (see enrico.download).
+        If verify, the checksums of the files are checked as well."""
+        tasks = []
         if spacecraft:
-            # -m --mirror
             if USE_FULLMISSION_SPACECRAFT:
-                cmd = 'wget -N ' + SPACECRAFT_URL
+                tasks += download.MirrorTasks(posixpath.dirname(SPACECRAFT_URL),
+                                              DOWNLOAD_DIR, SPACECRAFT)
             else:
-                cmd = 'wget -m -P weekly -nH --cut-dirs=4 -np ' + WEEKLY_SC_URL
-            print('EXEC: ', cmd)
-            os.system(cmd)
+                tasks += download.MirrorTasks(WEEKLY_SC_URL, WEEKLY_SC_DIR, '*.fits')
         if photon:
-            # -m --mirror
-            # -P --directory-prefix, in this case put in sub-directory weekly
-            # -nH --no-host-directories
-            # -np --no-parent
-            cmd = 'wget -m -P weekly -nH --cut-dirs=4 -np ' + WEEKLY_URL
-            print('EXEC: ', cmd)
-            os.system(cmd)
+            tasks += download.MirrorTasks(WEEKLY_URL, WEEKLY_DIR, '*.fits')
+        failed = download.Download(tasks, nworkers, verify)
+        if failed:
+            log.warning('%d file(s) could not be downloaded, run again to resume' % len(failed))
 
-    def download_aux(self):
+    def download_aux(self, nworkers=download.NWORKERS, verify=False):
         """Download missing diffuse model and catalog files"""
-        from urllib import urlretrieve
         from subprocess import call
         # Catalog and diffuse files
+        tasks = []
         for _tag, _url, _dir, _file in FILES:
-            path = join(_dir, _file)
-            url = join(_url, _file)
             if _dir:
-                if not os.path.isfile(path):
-                    print('Downloading %s' % path)
-                    urlretrieve(url, path)
-                else:
-                    print('%s exists already. Not downloading.' % _file)
+                tasks.append((join(_url, _file), join(_dir, _file), None))
             else:
                 print('Set DIRECTORIES before downloading the files.')
+        failed = download.Download(tasks, nworkers, verify)
+        for path in failed:
+            print('Could not download %s' % path)
         # Diffuse emission templates
         if CATALOG_DIR:
             if not os.path.isdir(CATALOG_TEMPLATE_DIR):
@@ -171,7 +165,9 @@ class Data(object):
                 url = join(CATALOG_URL, filename)
                 path = join(CATALOG_DIR, filename)
                 print('Downloading %s' % path)
-                urlretrieve(url, path)
+                if download.Download([(url, path, None)], nworkers, verify):
+                    print('Could not download %s' % path)
+                    return
                 print('Unpacking')
                 call(['tar', 'zxvf', path, '-C', CATALOG_DIR])
             else:
@@ -0,0 +1,162 @@
+"""
+Cutouts of the galactic diffuse model. The full sky map cube (hundreds of
+MB) is replaced in the XML model by the part of it which covers the ROI,
+plus a margin for the PSF, and the energy planes which cover the energy
+range of the analysis. gtsrcmaps, gtdiffrsp and the likelihood then only
+load this cutout.
+The cutouts are used if [model]/diffuse_cutout is yes. They are stored in
+<ENRICO_CACHE_DIR>/diffuse if the cache directory is set, <out>/Diffuse
+otherwise, and identified by the content of the map cube and the range of
+pixels and energy planes: all the analyses of the same region (e.g. the
+bins of a light curve) share the same file.
+"""
+import os
+import hashlib
+import numpy as np
+import pyfits
+from enrico import cache
+from enrico import Loggin
+
+#Rotation from the equatorial (J2000) to the galactic coordinates
+CEL_TO_GAL = np.array([[-0.0548755604, -0.8734370902, -0.4838350155],
+                       [+0.4941094279, -0.4448296300, +0.7469822445],
+                       [-0.8676661490, -0.1980763734, +0.4559837762]])
+
+
+def _Rotate(matrix, lon, lat):
+    lon, lat = np.radians(lon), np.radians(lat)
+    vec = np.array([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+    rotated = np.dot(matrix, vec)
+    return np.degrees(np.arctan2(rotated[1], rotated[0])) % 360., np.degrees(np.arcsin(rotated[2]))
+
+
+def CelToGal(ra, dec):
+    """Galactic coordinates (deg) of the direction (ra, dec)"""
+    return _Rotate(CEL_TO_GAL, ra, dec)
+
+
+def GalToCel(glon, glat):
+    """Equatorial coordinates (deg) of the direction (glon, glat)"""
+    return _Rotate(CEL_TO_GAL.T, glon, glat)
+
+
+def GetCutoutDir(config):
+    cachedir = cache.GetCacheDir(config)
+    if cachedir == '':
+        return os.path.join(config['out'], 'Diffuse')
+    return os.path.join(cachedir, 'diffuse')
+
+
+def _RoiCenter(config, header):
+    """Center of the ROI in the coordinates of the map cube"""
+    x, y = float(config['space']['xref']), float(config['space']['yref'])
+    galcube = header['CTYPE1'].startswith('GLON')
+    galroi = config['space']['coordsys'] == 'GAL'
+    if galcube and not(galroi):
+        return CelToGal(x, y)
+    if galroi and not(galcube):
+        return GalToCel(x, y)
+    return x, y
+
+
+def CutoutRange(header, energies, lon0, lat0, radius, emin, emax):
+    """Columns, range of rows and range of energy planes of the map cube
+    covering a circle of radius (deg) around (lon0, lat0) and the energy
+    range [emin, emax]"""
+    nlon, nlat = header['NAXIS1'], header['NAXIS2']
+    crpix1, cdelt1, crval1 = header['CRPIX1'], header['CDELT1'], header['CRVAL1']
+    crpix2, cdelt2, crval2 = header['CRPIX2'], header['CDELT2'], header['CRVAL2']
+
+    # rows: the latitude is linear in the pixels for CRVAL2 = 0
+    latmin, latmax = max(-90., lat0-radius), min(90., lat0+radius)
+    rows = (np.array([latmin, latmax])-crval2)/cdelt2+crpix2-1
+    j0 = max(0, int(np.floor(rows.min())))
+    j1 = min(nlat-1, int(np.ceil(rows.max())))
+
+    # columns, around the longitude of the center
+    fullsky = abs(nlon*cdelt1) >= 359.9
+    maxlat = max(abs(latmin), abs(latmax))
+    if maxlat >= 89.9:
+        dlon = 180.
+    else:
+        dlon = min(180., radius/np.cos(np.radians(maxlat)))
+    center = ((lon0-crval1+180.) % 360.-180.)/cdelt1+crpix1-1
+    i0 = int(np.floor(center-dlon/abs(cdelt1)))
+    i1 = int(np.ceil(center+dlon/abs(cdelt1)))
+    if not(fullsky):
+        i0, i1 = max(0, i0), min(nlon-1, i1)
+    elif i1-i0+1 >= nlon:
+        i0, i1 = 0, nlon-1
+
+    # energy planes, including one plane on each side of the range
+    k0 = max(0, np.searchsorted(energies, emin, side='right')-1)
+    k1 = min(len(energies)-1, np.searchsorted(energies, emax, side='left'))
+    return (i0, i1), (j0, j1), (k0, k1)
+
+
+def MakeCutout(mapcube, filename, columns, rows, planes):
+    """Write the cutout of the map cube, columns being the range of
+    columns (which can wrap around the sky for a full sky cube)"""
+    hdus = pyfits.open(mapcube, memmap=True)
+    header = hdus[0].header.copy()
+    cols = np.arange(columns[0], columns[1]+1) % header['NAXIS1']
+    data = hdus[0].data[planes[0]:planes[1]+1, rows[0]:rows[1]+1]
+    data = np.array(data[:, :, cols])
+    energies = np.array(hdus['ENERGIES'].data.field(0)[planes[0]:planes[1]+1], dtype=float)
+    unit = hdus['ENERGIES'].columns[0].unit or 'MeV'
+    name = hdus['ENERGIES'].columns[0].name
+    hdus.close()
+
+    # same WCS, shifted to the first pixel of the cutout
+    header['CRPIX1'] = header['CRPIX1']-columns[0]
+    header['CRPIX2'] = header['CRPIX2']-rows[0]
+    if 'CRPIX3' in header:
+        header['CRPIX3'] = header['CRPIX3']-planes[0]
+    hdu = pyfits.PrimaryHDU(data, header)
+    col = pyfits.Column(name=name, format='D', unit=unit, array=energies)
+    try:
+        energyhdu = pyfits.BinTableHDU.from_columns([col])
+    except AttributeError: # pyfits < 3.3
+        energyhdu = pyfits.new_table([col])
+    energyhdu.name = 'ENERGIES'
+
+    tmpfile = filename+'.%d.tmp' % os.getpid()
+    pyfits.HDUList([hdu, energyhdu]).writeto(tmpfile, clobber=True)
+    os.rename(tmpfile, filename)
+
+
+def GalacticCutout(mapcube, config):
+    """Return the cutout of the map cube mapcube for the ROI of the config
+    (see the module documentation), making it if needed"""
+    mes = Loggin.Message()
+    folder = GetCutoutDir(config)
+    for subdir in ['', 'hashes']:
+        if not os.path.isdir(os.path.join(folder, subdir)):
+            try:
+                os.makedirs(os.path.join(folder, subdir))
+            except OSError: # created by another job
+                pass
+
+    hdus = pyfits.open(mapcube, memmap=True)
+    header = hdus[0].header
+    if not(header['CTYPE1'].endswith('CAR')) or header['CRVAL2'] != 0:
+        hdus.close()
+        mes.warning("Cannot cut the diffuse model "+mapcube+" (not a CAR cube with CRVAL2=0)")
+        return mapcube
+    energies = np.array(hdus['ENERGIES'].data.field(0), dtype=float)
+    lon0, lat0 = _RoiCenter(config, header)
+    radius = float(config['space']['rad'])+float(config['model']['diffuse_margin'])
+    columns, rows, planes = CutoutRange(header, energies, lon0, lat0, radius,
+                                        float(config['energy']['emin']),
+                                        float(config['energy']['emax']))
+    hdus.close()
+
+    hashdir = cache.GetCacheDir(config) or folder
+    key = hashlib.sha1('%s %r %r %r' % (cache.FileHash(mapcube, hashdir),
+                                        columns, rows, planes)).hexdigest()
+    name = os.path.splitext(os.path.basename(mapcube))[0]
+    filename = os.path.join(folder, name+'_'+key[:16]+'.fits')
+    if not os.path.isfile(filename):
+        mes.info("Make the cutout "+filename+" of the diffuse model")
+        MakeCutout(mapcube, filename, columns, rows, planes)
+    return filename
@@ -0,0 +1,349 @@
+"""
+Parallel and resumable download of the data files (weekly photon and
+spacecraft files, catalog and diffuse model files) over HTTP and FTP.
+The files are fetched by a pool of workers into <file>.part and renamed
+once their size (and checksum, if known) has been verified, so that an
+interrupted download never leaves a truncated file; a new run resumes the
+partial files (HTTP Range, FTP REST) if the remote file has not changed
+since: its size and ETag or modification time are kept in
+<file>.part.json.
+Each destination directory holds a manifest (enrico_manifest.json) with the
+url, size and md5 of the files: a file is only fetched again if it is not
+in the manifest, if its local or remote size differs from the manifest, or
+(verify mode) if its checksum does not match. The weekly directories are
+mirrored incrementally: only the new (or changed) files of the remote
+listing are fetched.
+"""
+import os
+import re
+import json
+import fnmatch
+import hashlib
+import ftplib
+import httplib
+import urllib
+import urllib2
+import urlparse
+import posixpath
+import logging
+from multiprocessing.pool import ThreadPool
+log = logging.getLogger(__name__)
+
+MANIFEST = 'enrico_manifest.json'
+# number of files downloaded at the same time
+NWORKERS = 4
+# attempts for each file, the next ones resuming the partial file
+RETRIES = 3
+# timeout (s) of the connections
+TIMEOUT = 60
+BLOCKSIZE = 1 << 20
+# errors of a transfer
+ERRORS = ftplib.all_errors+(httplib.HTTPException,)
+
+
+def FileChecksum(path):
+    """md5 of the content of the file"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCKSIZE), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def ReadManifest(folder):
+    """Manifest of the folder: dict of {'url', 'size', 'md5'} by file name"""
+    try:
+        return json.load(open(os.path.join(folder, MANIFEST)))
+    except (IOError, ValueError):
+        return {}
+
+
+def WriteManifest(folder, manifest):
+    filename = os.path.join(folder, MANIFEST)
+    tmpfile = filename+'.%d.tmp' % os.getpid()
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmpfile, filename)
+
+
+def _FtpConnect(parts):
+    ftp = ftplib.FTP(timeout=TIMEOUT)
+    ftp.connect(parts.hostname, parts.port or 21)
+    ftp.login(parts.username or 'anonymous', parts.password or 'anonymous@')
+    return ftp
+
+
+def _ListFtp(url):
+    parts = urlparse.urlparse(url)
+    ftp = _FtpConnect(parts)
+    lines = []
+    try:
+        ftp.cwd(urllib.unquote(parts.path) or '/')
+        ftp.retrlines('LIST', lines.append)
+    finally:
+        ftp.close()
+    files = {}
+    for line in lines:
+        # unix format: permissions, links, owner, group, size, date (3), name
+        fields = line.split(None, 8)
+        if len(fields) == 9 and line.startswith('-'):
+            files[fields[8]] = int(fields[4])
+    return files
+
+
+def _ListHttp(url):
+    page = urllib2.urlopen(url.rstrip('/')+'/', timeout=TIMEOUT).read()
+    files = {}
+    for href in re.findall(r'href="([^"?#]+)"', page, re.IGNORECASE):
+        if not href.endswith('/'):
+            files[urllib.unquote(posixpath.basename(urlparse.urlparse(href).path))] = None
+    return files
+
+
+def ListDirectory(url):
+    """Files of the remote directory url: dict of the sizes by file name
+    (the sizes are None if the server does not give them)"""
+    if url.startswith('ftp://'):
+        return _ListFtp(url)
+    return _ListHttp(url)
+
+
+def RemoteSize(url):
+    """Size of the remote file, None if unknown"""
+    try:
+        if url.startswith('ftp://'):
+            parts = urlparse.urlparse(url)
+            ftp = _FtpConnect(parts)
+            try:
+                ftp.voidcmd('TYPE I')
+                return ftp.size(urllib.unquote(parts.path))
+            finally:
+                ftp.close()
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        length = urllib2.urlopen(request, timeout=TIMEOUT).info().getheader('Content-Length')
+        return None if length is None else int(length)
+    except ERRORS:
+        return None
+
+
+def _PartInfoFile(part):
+    return part+'.json'
+
+
+def _ReadPartInfo(part):
+    """Version (size, etag, modification time) of the remote file from
+    which the partial file part was downloaded, None if unknown"""
+    try:
+        return json.load(open(_PartInfoFile(part)))
+    except (IOError, ValueError):
+        return None
+
+
+def _WritePartInfo(part, info):
+    infofile = _PartInfoFile(part)
+    tmpfile = infofile+'.%d.tmp' % os.getpid()
+    with open(tmpfile, 'w') as f:
+        json.dump(info, f)
+    os.rename(tmpfile, infofile)
+
+
+def _RemovePart(part):
+    for filename in [part, _PartInfoFile(part)]:
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+def _TransferHttp(url, part, offset, partinfo):
+    request = urllib2.Request(url)
+    if offset > 0:
+        # the range is only sent if the remote file is the same version
+        request.add_header('Range', 'bytes=%d-' % offset)
+        request.add_header('If-Range', partinfo['validator'])
+    try:
+        response = urllib2.urlopen(request, timeout=TIMEOUT)
+    except urllib2.HTTPError, e:
+        if e.code != 416:
+            raise
+        # range not satisfiable: start again
+        offset = 0
+        response = urllib2.urlopen(urllib2.Request(url), timeout=TIMEOUT)
+    headers = response.info()
+    total = None
+    if response.getcode() == 206:
+        contentrange = headers.getheader('Content-Range') or ''
+        if re.match(r'bytes \d+-\d+/\d+$', contentrange):
+            total = int(contentrange.rsplit('/', 1)[1])
+        if total is None or total != partinfo['size']: # another version
+            response.close()
+            offset = 0
+            response = urllib2.urlopen(urllib2.Request(url), timeout=TIMEOUT)
+            headers = response.info()
+    if response.getcode() != 206: # the range is ignored or not sent
+        offset = 0
+        length = headers.getheader('Content-Length')
+        total = None if length is None else int(length)
+
+    # version of the file, to check it before resuming: a strong ETag or
+    # the modification time (If-Range does not accept weak ETags)
+    validator = headers.getheader('ETag')
+    if validator is None or validator.startswith('W/'):
+        validator = headers.getheader('Last-Modified')
+    _WritePartInfo(part, {'size': total, 'validator': validator})
+    with open(part, 'ab' if offset > 0 else 'wb') as f:
+        for block in iter(lambda: response.read(BLOCKSIZE), ''):
+            f.write(block)
+    return total
+
+
+def _TransferFtp(url, part, offset, partinfo):
+    parts = urlparse.urlparse(url)
+    path = urllib.unquote(parts.path)
+    ftp = _FtpConnect(parts)
+    try:
+        ftp.voidcmd('TYPE I')
+        try:
+            size = ftp.size(path)
+        except ftplib.error_perm:
+            size = None
+        try:
+            validator = ftp.sendcmd('MDTM '+path)
+        except ftplib.error_perm:
+            validator = None
+        # only resume from the same version of the remote file
+        if offset > 0 and (partinfo['size'] != size or partinfo['validator'] != validator):
+            offset = 0
+        _WritePartInfo(part, {'size': size, 'validator': validator})
+        with open(part, 'ab' if offset > 0 else 'wb') as f:
+            ftp.retrbinary('RETR '+path, f.write, BLOCKSIZE, rest=offset or None)
+    finally:
+        ftp.close()
+    return size
+
+
+def Fetch(url, path, size=None, md5=None):
+    """Download url in path, resuming path.part if it exists and comes from
+    the same version of the remote file. size and md5 are the expected
+    size and checksum, if known. Return the manifest entry of the file"""
+    transfer = _TransferFtp if url.startswith('ftp://') else _TransferHttp
+    part = path+'.part'
+    error = None
+    mismatch = None
+    for attempt in xrange(RETRIES):
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        partinfo = _ReadPartInfo(part)
+        # resume only if the version of the partial file can be checked
+        if partinfo is None or partinfo.get('validator') is None or partinfo.get('size') is None:
+            offset = 0
+        elif size is not None and (offset >= size or partinfo['size'] != size):
+            offset = 0
+        try:
+            total = transfer(url, part, offset, partinfo)
+        except ERRORS, e:
+            error = e
+            continue
+        if total is None:
+            total = size
+        got = os.path.getsize(part)
+        if total is not None and got != total:
+            error = "%d bytes received out of %d" % (got, total)
+            if got > total:
+                _RemovePart(part)
+            continue
+        checksum = FileChecksum(part)
+        if md5 is not None and checksum != md5:
+            if checksum == mismatch:
+                # the same content twice: the remote file has changed
+                log.warning('%s differs from the manifest, new version' % url)
+            else:
+                error = "wrong checksum"
+                mismatch = checksum
+                _RemovePart(part)
+                continue
+        os.rename(part, path)
+        _RemovePart(part)
+        return {'url': url, 'size': got, 'md5': checksum}
+    raise IOError("Cannot download %s: %s" % (url, error))
+
+
+def _Fetch(task):
+    url, path, size, md5 = task
+    try:
+        return path, Fetch(url, path, size, md5), None
+    except (IOError, OSError), e:
+        return path, None, e
+
+
+def UpToDate(path, entry, size, verify=False):
+    """True if the file path is the one of the manifest entry, size being
+    the remote size (None if unknown)"""
+    if entry is None or not os.path.isfile(path):
+        return False
+    if os.path.getsize(path) != entry['size']:
+        return False
+    if size is not None and size != entry['size']: # changed on the server
+        return False
+    return not(verify) or FileChecksum(path) == entry['md5']
+
+
+def Download(tasks, nworkers=NWORKERS, verify=False):
+    """Download the files of tasks, a list of (url, path, remote size or
+    None), which are not up to date in the manifests. The files already
+    present but not in the manifest are kept if they have the remote size.
+    Return the list of the files which could not be downloaded"""
+    manifests = {}
+    for url, path, size in tasks:
+        folder = os.path.dirname(path)
+        if folder not in manifests:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            manifests[folder] = ReadManifest(folder)
+
+    todo = []
+    for url, path, size in tasks:
+        folder, name = os.path.split(path)
+        manifest = manifests[folder]
+        entry = manifest.get(name)
+        if entry is None and os.path.isfile(path):
+            # downloaded before the manifest: keep it if it is complete
+            if size is None:
+                size = RemoteSize(url)
+            if size is not None and os.path.getsize(path) == size:
+                manifest[name] = {'url': url, 'size': size, 'md5': FileChecksum(path)}
+                WriteManifest(folder, manifest)
+                continue
+        if UpToDate(path, entry, size, verify):
+            continue
+        # checksum known for this version of the file
+        md5 = None
+        if entry is not None and (size is None or size == entry['size']):
+            md5 = entry['md5']
+        todo.append((url, path, size, md5))
+    log.info('%d file(s) to download, %d up to date' % (len(todo), len(tasks)-len(todo)))
+
+    failed = []
+    if not todo:
+        return failed
+    pool = ThreadPool(min(nworkers, len(todo)))
+    try:
+        for path, entry, error in pool.imap_unordered(_Fetch, todo):
+            if error is not None:
+                log.warning(str(error))
+                failed.append(path)
+                continue
+            folder, name = os.path.split(path)
+            manifests[folder][name] = entry
+            WriteManifest(folder, manifests[folder])
+            log.info('Downloaded %s (%d bytes)' % (path, entry['size']))
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+def MirrorTasks(url, folder, pattern='*'):
+    """Tasks (see Download) to mirror the files of the remote directory url
+    matching pattern in folder"""
+    remote = ListDirectory(url)
+    return [(url.rstrip('/')+'/'+name, os.path.join(folder, name), remote[name])
+            for name in sorted(remote) if fnmatch.fnmatch(name, pattern)]
@@ -30,6 +30,7 @@ if DOWNLOAD_DIR :
   WEEKLY_DIR = join(DOWNLOAD_DIR, 'weekly/photon')
   WEEKLY_SC_DIR = join(DOWNLOAD_DIR, 'weekly/spacecraft')
 PREPROCESSED_DIR = os.environ.get('FERMI_PREPROCESSED_DIR', '')
+CACHE_DIR = os.environ.get('ENRICO_CACHE_DIR', '')
 CONFIG_DIR = join(os.path.dirname(__file__), 'config')
 USE_FULLMISSION_SPACECRAFT = bool(os.environ.get('USE_FULLMISSION_SPACECRAFT','False')=='True')
 
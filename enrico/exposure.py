@@ -0,0 +1,178 @@
+"""
+In-process exposure calculation, used in place of gtexposure.
+The effective area, averaged over the energy range with a power law
+spectrum, is tabulated once as a function of the off-axis angle. It is
+then integrated over the pointing history (FT2) for all the time bins
+at once, the livetime of each FT2 interval being spread uniformly over
+the interval and restricted to the good time intervals (GTI).
+The azimuthal dependence of the effective area is averaged out.
+"""
+import os
+import numpy as np
+import pyfits
+from enrico import utils
+
+#Binning of the effective area table
+NCOSTHETA = 201
+NENERGY = 50
+NPHI = 8
+
+
+def GetIrfNames(config):
+    """Return the list of IRFs (class::type) whose effective areas are
+    summed, given the [event] section of the config"""
+    irfs = config['event']['irfs']
+    if irfs == 'CALDB':
+        classirf, types = utils.GetIRFS(config['event']['evclass'],
+                                        config['event']['evtype'])
+    elif '::' in irfs:
+        return [irfs]
+    else:
+        classirf, types = irfs, ['']
+    names = []
+    for typ in types:
+        if typ == '': # FRONT+BACK
+            names += [classirf+'::FRONT', classirf+'::BACK']
+        else:
+            names.append(classirf+'::'+typ)
+    return names
+
+
+def AeffTable(irfnames, emin, emax, index):
+    """Tabulate the effective area (cm2) weighted by a power law
+    dN/dE ~ E^-index between emin and emax (MeV) vs cos(theta)"""
+    import pyIrfLoader
+    pyIrfLoader.Loader_go()
+    factory = pyIrfLoader.IrfsFactory.instance()
+
+    costheta = np.linspace(0, 1, NCOSTHETA)
+    theta = np.degrees(np.arccos(costheta))
+    energy = np.logspace(np.log10(emin), np.log10(emax), NENERGY)
+    phis = np.arange(NPHI)*360./NPHI
+
+    aeff = np.zeros((NCOSTHETA, NENERGY))
+    for name in irfnames:
+        irf = factory.create(name).aeff()
+        for i in xrange(NCOSTHETA):
+            for j in xrange(NENERGY):
+                aeff[i, j] += np.mean([irf.value(energy[j], theta[i], phi) for phi in phis])
+
+    # integrate in log(E), the weight is E*dN/dE
+    weight = energy**(1.-index)
+    table = np.trapz(aeff*weight, np.log(energy), axis=1)/np.trapz(weight, np.log(energy))
+    return costheta, table
+
+
+def _FileList(filename):
+    """Handle the @list convention of the ST"""
+    if filename.startswith('@'):
+        return [f.strip() for f in open(filename[1:]) if f.strip() != '']
+    return [filename]
+
+
+def ReadPointing(ft2, tmin, tmax):
+    """Read the FT2 file(s) and return the START, STOP, LIVETIME, RA_SCZ
+    and DEC_SCZ columns of the intervals overlapping [tmin, tmax]"""
+    columns = [[], [], [], [], []]
+    for filename in _FileList(ft2):
+        spfile = pyfits.open(filename)
+        data = spfile['SC_DATA'].data
+        keep = (data.field('STOP') > tmin)*(data.field('START') < tmax)
+        for col, name in zip(columns, ['START', 'STOP', 'LIVETIME', 'RA_SCZ', 'DEC_SCZ']):
+            col.append(np.array(data.field(name)[keep], dtype=float))
+        spfile.close()
+    columns = [np.concatenate(col) for col in columns]
+    order = np.argsort(columns[0])
+    return [col[order] for col in columns]
+
+
+def ReadGTI(fitsfile):
+    """Return the START and STOP of the GTIs of a FT1 (or LC) file"""
+    spfile = pyfits.open(fitsfile)
+    gti = spfile['GTI'].data
+    start, stop = np.array(gti.field('START'), dtype=float), np.array(gti.field('STOP'), dtype=float)
+    spfile.close()
+    order = np.argsort(start)
+    return start[order], stop[order]
+
+
+def _Cumulative(knots_start, knots_stop, cumul, rate, t):
+    """Evaluate at times t the integral of a rate constant over each
+    interval [knots_start, knots_stop] and null outside, cumul being the
+    integral before each interval"""
+    i = np.searchsorted(knots_start, t, side='right')-1
+    inside = i >= 0
+    i = np.maximum(i, 0)
+    dt = np.clip(t-knots_start[i], 0, knots_stop[i]-knots_start[i])
+    return np.where(inside, cumul[i]+rate[i]*dt, 0.)
+
+
+def BinExposure(tstart, tstop, ra, dec, pointing, gti, table):
+    """Exposure (cm2 s) of the source at (ra, dec) in each time bin
+    [tstart, tstop], given the pointing history, the GTIs and the
+    effective area table"""
+    start, stop, livetime, ra_scz, dec_scz = pointing
+    costheta, aeff = table
+
+    #off-axis angle of the source for all the FT2 intervals
+    dec0, ra0 = np.radians(dec), np.radians(ra)
+    dec_scz, ra_scz = np.radians(dec_scz), np.radians(ra_scz)
+    cos_offaxis = (np.sin(dec0)*np.sin(dec_scz) +
+                   np.cos(dec0)*np.cos(dec_scz)*np.cos(ra0-ra_scz))
+    area = np.interp(cos_offaxis, costheta, aeff, left=0., right=aeff[-1])
+
+    #exposure per unit time, uniform over each FT2 interval
+    duration = stop-start
+    rate = np.where(duration > 0, livetime*area/np.maximum(duration, 1e-10), 0.)
+    cumul = np.concatenate([[0.], np.cumsum(rate*duration)[:-1]])
+
+    #same thing restricted to the GTIs
+    gti_start, gti_stop = gti
+    F_start = _Cumulative(start, stop, cumul, rate, gti_start)
+    F_stop = _Cumulative(start, stop, cumul, rate, gti_stop)
+    gti_cumul = np.concatenate([[0.], np.cumsum(F_stop-F_start)[:-1]])
+
+    def G(t):
+        g = np.searchsorted(gti_start, t, side='right')-1
+        inside = g >= 0
+        g = np.maximum(g, 0)
+        F_t = _Cumulative(start, stop, cumul, rate, np.clip(t, gti_start[g], gti_stop[g]))
+        return np.where(inside, gti_cumul[g]+F_t-F_start[g], 0.)
+
+    tstart, tstop = np.asarray(tstart, dtype=float), np.asarray(tstop, dtype=float)
+    return G(tstop)-G(tstart)
+
+
+def ComputeExposure(Obs, tstart, tstop, index):
+    """Exposure of the target of the Observation Obs in the time bins
+    [tstart, tstop] for a power law of index index"""
+    config = Obs.Configuration
+    table = AeffTable(GetIrfNames(config), Obs.Emin, Obs.Emax, index)
+    pointing = ReadPointing(Obs.ft2, np.min(tstart), np.max(tstop))
+    gti = ReadGTI(Obs.mktimefile)
+    return BinExposure(tstart, tstop, float(config['target']['ra']),
+                       float(config['target']['dec']), pointing, gti, table)
+
+
+def WriteLCExposure(Obs, index):
+    """Add the EXPOSURE column to the LC file made by gtbin, as gtexposure
+    does"""
+    spfile = pyfits.open(Obs.lcfile)
+    data = spfile[1].data
+    tstart = data.field('TIME')-data.field('TIMEDEL')/2.
+    exposure = ComputeExposure(Obs, tstart, tstart+data.field('TIMEDEL'), index)
+
+    if 'EXPOSURE' in [name.upper() for name in data.names]:
+        data.field('EXPOSURE')[:] = exposure
+        hdu = spfile[1]
+    else:
+        cols = spfile[1].columns + pyfits.ColDefs([pyfits.Column(name='EXPOSURE',format='D',unit='cm**2 s',array=exposure)])
+        try:
+            hdu = pyfits.BinTableHDU.from_columns(cols, header=spfile[1].header)
+        except AttributeError: # pyfits < 3.3
+            hdu = pyfits.new_table(cols, header=spfile[1].header)
+    hdus = pyfits.HDUList([spfile[0], hdu]+spfile[2:])
+    hdus.writeto(Obs.lcfile+'.tmp', clobber=True)
+    spfile.close()
+    os.rename(Obs.lcfile+'.tmp', Obs.lcfile)
+    return exposure
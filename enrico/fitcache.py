@@ -0,0 +1,204 @@
+"""
+Cache of the fitted model states. The baseline fit of a given model on
+given data products is done once: its result (parameter values and
+errors, deleted weak sources, covariance matrix, log-likelihood, output
+XML and the MINOS errors computed afterwards) is stored and a later fit of the same model (RunGTlike, the
+model tests, the scans...) starts from it without re-optimizing.
+The key of a fit is a hash of the config sections which affect the fit,
+of the initial state of all the spectral parameters of the model, of the
+spatial models of the sources (XML model of each component) and of the
+content of the data products of all the components.
+The cache is used if [fitting]/FitCache is yes. The states are stored in
+<ENRICO_CACHE_DIR>/fits if the cache directory is set, in <out>/FitCache
+otherwise.
+"""
+import os
+import json
+import hashlib
+import xml.dom.minidom
+from enrico import cache
+from enrico import Loggin
+
+# sections of the config which change the result of the fit
+KEY_SECTIONS = ['target', 'space', 'energy', 'time', 'event', 'analysis',
+                'fitting', 'ComponentAnalysis']
+# options of these sections which do not
+IGNORED_OPTIONS = ['Nprocess', 'Trace', 'FitCache']
+
+
+def _Enabled(config):
+    try:
+        return config['fitting']['FitCache'] == 'yes'
+    except KeyError:
+        return False
+
+
+def GetFitCacheDir(config):
+    cachedir = cache.GetCacheDir(config)
+    if cachedir == '':
+        return os.path.join(config['out'], 'FitCache')
+    return os.path.join(cachedir, 'fits')
+
+
+def Components(Fit):
+    """Likelihood objects of a SummedLikelihood or of a single analysis"""
+    if hasattr(Fit, 'components'):
+        return Fit.components
+    return [Fit]
+
+
+def _DataFiles(comp):
+    """Data products used by a BinnedAnalysis or an UnbinnedAnalysis"""
+    files = []
+    if hasattr(comp, 'binnedData'):
+        for name in ['srcMaps', 'expCube', 'binnedExpMap']:
+            files.append(getattr(comp.binnedData, name, None))
+    if hasattr(comp, 'observation'):
+        files += list(getattr(comp.observation, 'eventFiles', []))
+        for name in ['expMap', 'expCube']:
+            files.append(getattr(comp.observation, name, None))
+    return [f for f in files if f is not None and os.path.isfile(f)]
+
+
+def SpatialModels(xmlfile, folder):
+    """Spatial model (type, hash of the template, parameters) of each source
+    of the XML model, folder being where the file hashes are kept"""
+    items = []
+    for src in xml.dom.minidom.parse(xmlfile).getElementsByTagName('source'):
+        for spatial in src.getElementsByTagName('spatialModel'):
+            item = [src.getAttribute('name'), spatial.getAttribute('type')]
+            if spatial.getAttribute('file') != '':
+                item.append(cache.FileHash(spatial.getAttribute('file'), folder))
+            for param in spatial.getElementsByTagName('parameter'):
+                item.append('%s=%s*%s' % (param.getAttribute('name'), param.getAttribute('value'),
+                                          param.getAttribute('scale')))
+            items.append(item)
+    return sorted(items)
+
+
+def ModelState(Fit):
+    """List of [source, parameter, value, error, free] for all the spectral
+    parameters of the model"""
+    state = []
+    for src in Fit.model.srcNames:
+        spectrum = Fit[src].funcs['Spectrum']
+        for par in spectrum.paramNames:
+            param = spectrum.getParam(par)
+            state.append([src, par, param.value(), param.error(), int(param.isFree())])
+    return state
+
+
+def SetModelState(Fit, state):
+    """Set the parameters of the model Fit from a list made by ModelState"""
+    for src, par, value, error, free in state:
+        for comp in Components(Fit):
+            param = comp[src].funcs['Spectrum'].getParam(par)
+            param.setFree(free)
+            param.setValue(value)
+            param.setError(error)
+    for comp in Components(Fit):
+        comp.logLike.syncParams()
+
+
+def FitKey(Fit, config):
+    """Key of the fit of the model Fit with the config, None if the cache
+    is not used"""
+    if not(_Enabled(config)):
+        return None
+    items = []
+    for section in KEY_SECTIONS:
+        try:
+            options = config[section].dict()
+        except KeyError:
+            continue
+        for option in IGNORED_OPTIONS:
+            options.pop(option, None)
+        items.append([section, options])
+    # initial parameters, errors excluded
+    items.append([[src, par, value, free] for src, par, value, _, free in ModelState(Fit)])
+
+    folder = GetFitCacheDir(config)
+    if not os.path.isdir(os.path.join(folder, 'hashes')):
+        try:
+            os.makedirs(os.path.join(folder, 'hashes'))
+        except OSError: # created by another job
+            pass
+    for comp in Components(Fit):
+        items.append([cache.FileHash(f, folder) for f in _DataFiles(comp)])
+        # positions and templates, which the unbinned data products do not depend on
+        xmlfile = getattr(comp, 'srcModel', None)
+        if xmlfile is not None and os.path.isfile(xmlfile):
+            items.append(SpatialModels(xmlfile, folder))
+    return hashlib.sha1(json.dumps(items, sort_keys=True, default=str)).hexdigest()
+
+
+def _StateFile(config, key):
+    return os.path.join(GetFitCacheDir(config), key+'.json')
+
+
+def _WriteState(statefile, state):
+    tmpfile = statefile+'.%d.tmp' % os.getpid()
+    with open(tmpfile, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmpfile, statefile)
+
+
+def Restore(Fit, config, key=None):
+    """Set the model Fit in the state of a cached fit with the same key.
+    Return the log-likelihood of the fit, or None if it is not cached"""
+    if key is None:
+        key = FitKey(Fit, config)
+    if key is None:
+        return None
+    statefile = _StateFile(config, key)
+    if not os.path.isfile(statefile):
+        return None
+    state = json.load(open(statefile))
+    Loggin.Message().info("Restore the fitted model from "+statefile)
+
+    for src in list(Fit.model.srcNames):
+        if src in state['deleted']:
+            for comp in Components(Fit):
+                comp.deleteSource(src)
+    SetModelState(Fit, state['params'])
+    Fit.covariance = state['covariance']
+    return state['logLike']
+
+
+def Store(Fit, config, key, logLike, deleted=()):
+    """Store the fitted state of the model Fit under key, deleted being the
+    sources removed from the model by the fit"""
+    if key is None:
+        return
+    folder = GetFitCacheDir(config)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError: # created by another job
+            pass
+    covariance = getattr(Fit, 'covariance', None)
+    if covariance is not None:
+        covariance = [list(row) for row in covariance]
+    state = {'params': ModelState(Fit), 'deleted': list(deleted),
+             'covariance': covariance, 'logLike': logLike,
+             'xml': os.path.join(folder, key+'.xml')}
+    Fit.writeXml(state['xml'])
+    _WriteState(_StateFile(config, key), state)
+
+
+def CachedMinos(config, key):
+    """MINOS errors stored with the fit key: dictionnary parameter ->
+    (lower, upper) error or None"""
+    if key is None or not os.path.isfile(_StateFile(config, key)):
+        return {}
+    minos = json.load(open(_StateFile(config, key))).get('minos', {})
+    return dict((par, None if err is None else tuple(err)) for par, err in minos.items())
+
+
+def StoreMinos(config, key, errors):
+    """Add the MINOS errors (see CachedMinos) to the stored fit key"""
+    if key is None or not errors or not os.path.isfile(_StateFile(config, key)):
+        return
+    state = json.load(open(_StateFile(config, key)))
+    state.setdefault('minos', {}).update(errors)
+    _WriteState(_StateFile(config, key), state)
@@ -9,13 +9,79 @@ begun September 2011
 #import logging
 #logging.basicConfig(level=logging.INFO)
 #log = logging.getLogger(__name__)
+import os
+import sys
+import time
+import multiprocessing
 import numpy as np
+from scipy.integrate import cumtrapz
 import string,pyfits
 from UnbinnedAnalysis import UnbinnedAnalysis, UnbinnedObs
 from BinnedAnalysis import BinnedAnalysis, BinnedObs
 from enrico import utils
 from enrico import Loggin
-from enrico import environ
+from enrico import render
+from enrico import exposure
+from enrico import pipeline
+from enrico import timing
+from enrico import fitcache
+from enrico import cache
+from enrico import stats
+from enrico import likeprofile
+
+#Tolerance of the coarse optimization done before the precise one
+COARSE_FTOL = 1e-3
+#Telemetry read from the optimizer after a fit, if it provides it
+OPTIMIZER_TELEMETRY = [('retcode', 'getRetCode'), ('quality', 'getQuality'),
+                       ('edm', 'getDistance'), ('nfev', 'getNumEvals')]
+
+#Containment radii already computed, by (psf file, modification time, fraction)
+_ContainmentCache = {}
+
+def ContainmentRadius(psffile, fraction=0.68):
+    """Radius (deg) containing the fraction of the PSF at each energy of
+    the output of gtpsf: the first sample of theta beyond which the
+    cumulative integral of the PSF exceeds fraction. The result is kept
+    for the psf file (i.e. for a given livetime cube and IRF)"""
+    key = (os.path.realpath(psffile), os.path.getmtime(psffile), fraction)
+    if key not in _ContainmentCache:
+        psfres = pyfits.open(psffile)
+        theta = np.array(psfres[2].data["Theta"], dtype=float)
+        psf = np.array(psfres[1].data["psf"], dtype=float)
+        psfres.close()
+        cumul = cumtrapz(psf, theta, axis=1, initial=0)
+        cumul /= cumul[:, -1:]
+        # first j such as the integral up to theta[j-1] exceeds fraction
+        # (the cumulative integral is monotonic: this is a searchsorted)
+        j = np.sum(cumul[:, :-1] <= fraction, axis=1)+1
+        radius = np.where(j < theta.size, theta[np.minimum(j, theta.size-1)], 0.)
+        _ContainmentCache[key] = radius
+    return _ContainmentCache[key]
+
+def DistanceMap(header):
+    """Distance (deg) of the pixels of a map to its reference pixel, in
+    the small angle approximation"""
+    x = (np.arange(header["NAXIS1"])+1-header["CRPIX1"])*header["CDELT1"]
+    y = (np.arange(header["NAXIS2"])+1-header["CRPIX2"])*header["CDELT2"]
+    xx, yy = np.meshgrid(x, y)
+    return np.sqrt(xx**2 + yy**2)
+
+def GetBeltCacheDir(config):
+    """Folder where the Feldman-Cousins belts are stored"""
+    cachedir = cache.GetCacheDir(config)
+    if cachedir == '':
+        return os.path.join(config['out'], 'FCBelts')
+    return os.path.join(cachedir, 'fcbelts')
+
+#FitMaker and fit used by the worker processes, see FitMaker.ParallelMap
+_WorkerFit = None
+
+def _FitWorker(conn, method, arg):
+    """Body of a worker process: send the result of the call in conn"""
+    FitRunner, Fit = _WorkerFit
+    conn.send(getattr(FitRunner, method)(Fit, arg))
+    conn.close()
+    sys.stdout.flush()
 
 class FitMaker(Loggin.Message):
     """Collection of functions to prepare/run the GTLIKE fit
@@ -27,6 +93,8 @@ class FitMaker(Loggin.Message):
         self.config = config
         self.task_number = 1
         self.log_like = 0
+        #(Fit, fit cache key, restored from the cache) of the last PerformFit
+        self.cachedfit = None
 
     def _log(self, task='', description=''):
         print
@@ -50,39 +118,46 @@ class FitMaker(Loggin.Message):
         else:
             self.obs.FirstCut()
 
-    def GenerateFits(self):
+    def GenerateFits(self, selection=True):
         """Run the different ST tools and compute the fits files
            First it runs the tools that are common to the binned
            and unbinned analysis chain then it run the specific
-           tools following the choise of the user"""
+           tools following the choise of the user.
+           If selection is False, the events are supposed to be already
+           selected (gtselect) and the chain starts at gtmktime"""
+
+        #The steps are run as a dependency graph: the independent steps
+        #run concurrently if [analysis]/Nprocess > 1
+        Step = pipeline.Step
+        unbinned = self.config['analysis']['likelihood'] == 'unbinned'
 
         #Run the tools common to binned and unbinned chain
-        self._log('gtselect', 'Select data from library, fine cut')#run gtselect
-        self.obs.SelectEvents()
-        self._log('gtmktime', 'Update the GTI and cut data based on ROI')#run gtmktime
-        self.obs.MkTime()
-        if (self.config["analysis"]["ComputeDiffrsp"] == "yes" and self.config["analysis"]["likelihood"] == "unbinned"):
-            self._log('gtdiffrsp', 'Compute Diffuse response')
-            self.obs.DiffResps()#run gtdiffresp
-        self._log('gtbin', 'Create a count map')
-        self.obs.Gtbin()
-        self._log('gtltcube', 'Make live time cube')#run gtltcube
-        self.obs.ExpCube()
-        self.info('Compute the psf')#run gtpsf
-        self.obs.GtPSF()
+        steps = []
+        if selection:
+            steps.append(Step('gtselect', self.obs.SelectEvents, [], 'Select data from library, fine cut'))
+        steps.append(Step('gtmktime', self.obs.MkTime, ['gtselect'] if selection else [],
+                          'Update the GTI and cut data based on ROI'))
+        #gtdiffrsp replaces the event file: the steps reading it wait for it,
+        #so that they always read (and hash, for the cache) the same file
+        events = ['gtmktime']
+        if (self.config["analysis"]["ComputeDiffrsp"] == "yes" and unbinned):
+            steps.append(Step('gtdiffrsp', self.obs.DiffResps, ['gtmktime'], 'Compute Diffuse response'))
+            events = ['gtdiffrsp']
+        steps += [Step('gtbin', self.obs.Gtbin, events, 'Create a count map'),
+                  Step('gtltcube', self.obs.ExpCube, events, 'Make live time cube'),
+                  Step('gtpsf', self.obs.GtPSF, ['gtltcube'], 'Compute the psf')]
 
         #Choose between the binned of the unbinned analysis
         if self.config['analysis']['likelihood'] == 'binned': #binned analysis chain
-            self._log('gtbin', 'Make count map CCUBE')#run gtbin
-            self.obs.GtCcube()
-            self._log('gtexpcube2', 'Make binned exposure cube')#run gtexpcube2
-            self.obs.GtBinnedMap()
-            self._log('gtsrcmap', 'Make a source map')#run gtsrcmap
-            self.obs.SrcMap()
-
-        if self.config['analysis']['likelihood'] == 'unbinned': #unbinned analysis chain
-            self._log('gtexpmap', 'Make an exposure map')
-            self.obs.ExpMap()
+            steps += [Step('gtbin ccube', self.obs.GtCcube, events, 'Make count map CCUBE'),
+                      Step('gtexpcube2', self.obs.GtBinnedMap, ['gtltcube', 'gtbin ccube'], 'Make binned exposure cube'),
+                      Step('gtsrcmap', self.obs.SrcMap, ['gtltcube', 'gtbin ccube', 'gtexpcube2'], 'Make a source map')]
+
+        if unbinned: #unbinned analysis chain
+            steps.append(Step('gtexpmap', self.obs.ExpMap, events+['gtltcube'], 'Make an exposure map'))
+
+        pipeline.RunGraph(steps, pipeline.GetNprocess(self.config),
+                          log=lambda step: self._log(step.name, step.description))
     #the function ends here. It does not run gtlike
 
     def CreateLikeObject(self):
@@ -130,62 +205,147 @@ class FitMaker(Loggin.Message):
         return Fit #return the BinnedAnalysis or UnbinnedAnalysis object.
 
     def PerformFit(self, Fit, writeXml = True):
-        """Run gtlile tool. First it run gtlike with the DRNMGB optimizer
-        and the user optimizer after. A dictionnay is return with all
-        the releveant results"""
+        """Run gtlile tool. The fit is done by FitDriver: a coarse
+        optimization followed by a precise one with the user optimizer.
+        Then the weak sources are removed"""
 
         self._log('gtlike', 'Run likelihood analysis')
-        # TODO fix this part
-
-        # try:
-        # Fit.fit(0,covar=False, optimizer="DRMNGB") #first try to run gtlike to approche the minimum
-        # except:
-            # self.warning("First FIT did not converge with DRMNGB, trying DRMNFB")
-            # try:
-                # Fit.fit(0, optimizer="DRMNFB")
-            # except:
-                # self.warning("First FIT did not converge with DRMNFB either")
-
-        # Now the precise fit will be done
         #change the fit tolerance to the one given by the user
         Fit.ftol = float(self.config['fitting']['ftol'])
-        #fit with the user optimizer and ask gtlike to compute the covariance matrix
-        self.log_like = Fit.fit(0,covar=True, optimizer=self.config['fitting']['optimizer'])
-        #fit with the user optimizer and ask gtlike to compute the covariance matrix
-
-        # remove source with TS<min_source_TS (default=1)
-        # to be sure that MINUIT will converge
         try:             self.config['fitting']['min_source_TS']
         except KeyError: self.config['fitting']['min_source_TS'] = 1.
 
-        self.RemoveWeakSources(Fit,\
-            self.config['fitting']['min_source_TS'])
+        #the same fit may have been done already
+        key = fitcache.FitKey(Fit, self.config)
+        log_like = fitcache.Restore(Fit, self.config, key)
+        self.cachedfit = (Fit, key, log_like is not None)
+        if log_like is not None:
+            self.log_like = log_like
+        else:
+            sources = list(Fit.model.srcNames)
+            #fit with the user optimizer and ask gtlike to compute the covariance matrix
+            self.log_like = self.FitDriver(Fit)
+
+            # remove source with TS<min_source_TS (default=1)
+            # to be sure that MINUIT will converge
+            self.RemoveWeakSources(Fit,\
+                self.config['fitting']['min_source_TS'])
+            deleted = [src for src in sources if src not in Fit.model.srcNames]
+            fitcache.Store(Fit, self.config, key, self.log_like, deleted)
         if writeXml :
             Fit.writeXml(utils._dump_xml(self.config))
 
         self.success("Fit with gtlike preformed")
 
+    def _FitStage(self, Fit, optimizer, tol, covar):
+        """Run one optimization, record and print its telemetry (time, return
+        code, EDM, quality and number of evaluations if the optimizer
+        provides them). Return -log(likelihood) and the success flag"""
+        with timing.Stage(self.config, 'fit') as stage:
+            stage.info['optimizer'] = optimizer
+            stage.info['tol'] = tol
+            start = time.time()
+            try:
+                log_like = Fit.fit(0, tol=tol, covar=covar, optimizer=optimizer)
+            except RuntimeError, e:
+                self.warning("Fit with %s failed: %s" %(optimizer, str(e)))
+                stage.info['success'] = False
+                return None, False
+            telemetry = {}
+            optObject = getattr(Fit, 'optObject', None)
+            for name, method in OPTIMIZER_TELEMETRY:
+                try:
+                    telemetry[name] = getattr(optObject, method)()
+                except Exception:
+                    pass
+            # only the MINUIT return codes are 0 when the fit converged
+            success = telemetry.get('retcode', 0) == 0 or not(optimizer in ['MINUIT', 'NEWMINUIT'])
+            stage.info.update(telemetry)
+            stage.info['success'] = success
+        self.info("%s (tol=%g): -logL=%g in %.1f s %s" %(optimizer, tol, log_like, time.time()-start,
+                  " ".join("%s=%s" %(key, telemetry[key]) for key in sorted(telemetry))))
+        return log_like, success
+
+    def FitDriver(self, Fit, covar=True, coarse=True):
+        """Fit the model: a fast optimization with [fitting]/coarse_optimizer
+        and a loose tolerance (skipped if coarse is False), then a precise one
+        with [fitting]/optimizer. If the precise fit fails, it is done again
+        with the [fitting]/fallback_optimizers. Return -log(likelihood)"""
+        ftol = float(self.config['fitting']['ftol'])
+        try:
+            coarse_optimizer = self.config['fitting']['coarse_optimizer']
+            fallbacks = list(self.config['fitting']['fallback_optimizers'])
+        except KeyError:
+            coarse_optimizer, fallbacks = 'none', []
+
+        if coarse and coarse_optimizer != 'none':
+            self._FitStage(Fit, coarse_optimizer, max(ftol, COARSE_FTOL), False)
+
+        optimizers = [self.config['fitting']['optimizer']]
+        optimizers += [opt for opt in fallbacks if opt not in optimizers]
+        result = None
+        for optimizer in optimizers:
+            log_like, success = self._FitStage(Fit, optimizer, ftol, covar)
+            if success:
+                if optimizer != optimizers[0]:
+                    self.warning("Fit done with the fallback optimizer "+optimizer)
+                return log_like
+            self.warning("Fit with %s did not converge" %optimizer)
+            if log_like is not None:
+                result = log_like
+        if result is None:
+            raise RuntimeError("The fit failed with all the optimizers: "+", ".join(optimizers))
+        self.warning("The fit did not converge with any optimizer, keep the last result")
+        return result
+
+    def _WaldTS(self, Fit, src):
+        """Cheap estimate of the TS of a source from its fitted normalization
+        and the error on it (Wald test): TS ~ (N/dN)**2. Return None if the
+        normalization is not free or has no error"""
+        norm = Fit.model.srcs[src].spectrum().normPar()
+        if not(norm.isFree()) or norm.error() <= 0:
+            return None
+        return (norm.getValue()/norm.error())**2
+
     def RemoveWeakSources(self,Fit,minTS=1.0):
         """Remove the weak source after a fit and reoptimized
-         weak mens TS<1"""
+         weak mens TS<1.
+         Only the point sources can be removed: their TS is first
+         estimated from the covariance matrix (Wald test) and the full TS is
+         computed only for the sources which are within a factor
+         stats.WALD_BAND of the threshold or have a fixed normalization. All the weak sources
+         are removed at once and the model is re-optimized once"""
         self._log('','Remove all the weak (TS<%.2f) sources' %minTS)
-        NoWeakSrcLeft = False
-        while not(NoWeakSrcLeft):
-            NoWeakSrcLeft = True
-            for src in Fit.model.srcNames:
+        weak = {}
+        for src in Fit.model.srcNames:
+            if src == self.obs.srcname:
+                continue
+            if not(any(comp.logLike.getSource(src).getType() == 'Point' for comp in Fit.components)):
+                continue
+            wald = self._WaldTS(Fit, src)
+            if wald is not None:
+                isweak = stats.WaldWeak(wald, minTS)
+                if isweak is False:
+                    continue # significant, whatever the approximation
+                if isweak:
+                    weak[src] = wald
+                    continue
+            with timing.Stage(self.config, 'Ts') as stage:
+                stage.info['source'] = src
                 ts = Fit.Ts(src)
-                if  (ts<minTS) and not(src == self.obs.srcname):
-                    #and Fit.logLike.getSource(src).getType() == 'Point':
-                    for comp in Fit.components:
-                        if comp.logLike.getSource(src).getType() == 'Point':
-                            if self.config['verbose'] == 'yes' :
-                                self.info("deleting source "+src+" with TS = "+str(ts)+" from the model")
-                            NoWeakSrcLeft = False
-                            comp.deleteSource(src)
-            if not(NoWeakSrcLeft):
-                self._log('Re-optimize', '')
-                Fit.fit(0,covar=True, optimizer=self.config['fitting']['optimizer'])
-            print
+            if ts<minTS:
+                weak[src] = ts
+
+        for src, ts in weak.items():
+            for comp in Fit.components:
+                if comp.logLike.getSource(src).getType() == 'Point':
+                    if self.config['verbose'] == 'yes' :
+                        self.info("deleting source "+src+" with TS = "+str(ts)+" from the model")
+                    comp.deleteSource(src)
+        if len(weak) > 0:
+            self._log('Re-optimize', '')
+            self.log_like = self.FitDriver(Fit, coarse=False)
+        print
         return Fit
 
     def GetAndPrintResults(self, Fit):
@@ -207,7 +367,9 @@ class FitMaker(Loggin.Message):
         # fill the dictonnary with some values
         Result['Optimizer'] = self.config['fitting']['optimizer']
         Result['Npred'] = Fit.NpredValue(self.obs.srcname)
-        Result['TS'] = Fit.Ts(self.obs.srcname)
+        with timing.Stage(self.config, 'Ts') as stage:
+            stage.info['source'] = self.obs.srcname
+            Result['TS'] = Fit.Ts(self.obs.srcname)
         if self.config['verbose'] == 'yes' :
             print "Values and (MINOS) errors for " + self.obs.srcname
             print "TS : ", Fit.Ts(self.obs.srcname)
@@ -230,24 +392,32 @@ class FitMaker(Loggin.Message):
         Result['Flux'] = Fit.flux(self.obs.srcname,self.obs.Emin,self.obs.Emax)
         Result['dFlux'] = Fit.fluxError(self.obs.srcname,self.obs.Emin,self.obs.Emax)
 
+        # Compute MINOS errors for relevent parameters, in parallel
+        try:
+            minos_TS = float(self.config['fitting']['minos_TS'])
+        except KeyError:
+            minos_TS = 0.
+        MinosPars = []
+        if Result['TS'] > minos_TS:
+            MinosPars = [par for par in ParName if spectrum.getParam(par).error()>0]
+        MinosErrors = self.MinosErrors(Fit, MinosPars)
+
         for par in ParName : #Loop over the parameters and get value, error and scale
             ParValue = spectrum.getParam(par).value()
             ParError = spectrum.getParam(par).error()
             Scale    = spectrum.getParam(par).getScale()
             Result[par] = ParValue * Scale
             Result['d'+par] = ParError * Scale
-            if ParError>0: # Compute MINOS errors for relevent parameters  Fit.Ts(self.obs.srcname) > 5 and
-                try:
-                    MinosErrors = Fit.minosError(self.obs.srcname, par)
-                    if self.config['verbose'] == 'yes' :
-                       print(par+" :  %2.2f +/-  %2.2f [ %2.2f, + %2.2f ] %2.0e" %
-                          (ParValue, ParError, MinosErrors[0], MinosErrors[1], Scale))
-                       Result.update({'d'+par+'-': MinosErrors[0] * Scale})
-                       Result.update({'d'+par+'+': MinosErrors[1] * Scale})
-                except:
-                    if self.config['verbose'] == 'yes' :
-                        print(par+" :  %2.2f +/-  %2.2f  %2.0e" %
-                          (ParValue, ParError, Scale))
+            if MinosErrors.get(par) is not None:
+                Result.update({'d'+par+'-': MinosErrors[par][0] * Scale})
+                Result.update({'d'+par+'+': MinosErrors[par][1] * Scale})
+                if self.config['verbose'] == 'yes' :
+                   print(par+" :  %2.2f +/-  %2.2f [ %2.2f, + %2.2f ] %2.0e" %
+                      (ParValue, ParError, MinosErrors[par][0], MinosErrors[par][1], Scale))
+            elif ParError>0:
+                if self.config['verbose'] == 'yes' :
+                    print(par+" :  %2.2f +/-  %2.2f  %2.0e" %
+                      (ParValue, ParError, Scale))
             else:
                 if self.config['verbose'] == 'yes' :
                     print(par+" :  %2.2f   %2.0e" %
@@ -265,24 +435,109 @@ class FitMaker(Loggin.Message):
         #Compute an UL if the source is too faint
         if float(self.config['UpperLimit']['TSlimit']) > Fit.Ts(self.obs.srcname):
             if self.config['UpperLimit']['envelope'] == 'yes':
-                self.EnvelopeUL(Fit)
+                with timing.Stage(self.config, 'EnvelopeUL'):
+                    self.EnvelopeUL(Fit)
             else:
-                Ulval = self.ComputeUL(Fit)
+                with timing.Stage(self.config, 'UL') as stage:
+                    stage.info['method'] = self.config['UpperLimit']['Method']
+                    Ulval = self.ComputeUL(Fit)
                 Result['Ulvalue'] = Ulval
 
         return Result   #Return the dictionnary
 
 
+    def _MinosError(self, Fit, par):
+        """MINOS error of a parameter of the target, None if it fails"""
+        try:
+            with timing.Stage(self.config, 'minosError') as stage:
+                stage.info['parameter'] = par
+                return Fit.minosError(self.obs.srcname, par)
+        except Exception, e:
+            self.warning("MINOS error of %s failed: %s" % (par, e))
+            return None
+
+    def ParallelMap(self, Fit, method, args):
+        """Return [self.method(Fit, arg) for arg in args]. With
+        [analysis]/Nprocess > 1, the calls are made in (at most Nprocess)
+        processes which start from a copy of the fitted model (fork), so
+        that each call can modify the model without affecting the others.
+        A RuntimeError is raised if a process fails"""
+        nproc = min(pipeline.GetNprocess(self.config), len(args))
+        if nproc <= 1:
+            return [getattr(self, method)(Fit, arg) for arg in args]
+
+        global _WorkerFit
+        _WorkerFit = (self, Fit)
+        # one process per call, as pipeline.RunGraph: a worker which dies
+        # (e.g. abort in MINUIT) is detected from its exit code
+        results = [None]*len(args)
+        received = set()
+        pending = range(len(args))
+        running = {}
+        failed = []
+        try:
+            while pending or running:
+                while pending and len(running) < nproc and not failed:
+                    i = pending.pop(0)
+                    recv, send = multiprocessing.Pipe(False)
+                    sys.stdout.flush()
+                    worker = multiprocessing.Process(target=_FitWorker,
+                                                     args=(send, method, args[i]))
+                    worker.start()
+                    send.close()
+                    running[i] = (worker, recv)
+                time.sleep(pipeline.POLL_INTERVAL)
+                for i, (worker, recv) in running.items():
+                    # read the result before the exit: the worker may wait
+                    # for it to be read
+                    if i not in received and recv.poll():
+                        try:
+                            results[i] = recv.recv()
+                            received.add(i)
+                        except EOFError: # no result sent
+                            pass
+                    if worker.is_alive():
+                        continue
+                    worker.join()
+                    del running[i]
+                    if worker.exitcode != 0 or i not in received:
+                        failed.append("%s(%s) (exit code %s)" % (method, args[i], worker.exitcode))
+        finally:
+            for worker, recv in running.values():
+                worker.terminate()
+            _WorkerFit = None
+        if failed:
+            raise RuntimeError("Worker process(es) failed: "+", ".join(failed))
+        return results
+
+    def MinosErrors(self, Fit, pars):
+        """Compute the MINOS errors of the parameters pars of the target,
+        in parallel processes if [analysis]/Nprocess > 1.
+        Return a dictionnary parameter -> (lower, upper) error or None.
+        The errors are stored with the fit in the fit cache"""
+        key, restored = None, False
+        if self.cachedfit is not None and self.cachedfit[0] is Fit:
+            key, restored = self.cachedfit[1:]
+        cached = fitcache.CachedMinos(self.config, key)
+        missing = [par for par in pars if cached.get(par) is None]
+        if missing and restored:
+            # a restored fit has no optimizer state for MINOS, re-optimize
+            # from the restored point (converges immediately)
+            self.info("Re-optimize the restored fit to compute the MINOS errors")
+            Fit.fit(0, covar=True, optimizer=self.config['fitting']['optimizer'])
+            self.cachedfit = (Fit, key, False)
+        errors = self.ParallelMap(Fit, '_MinosError', missing)
+        errors = dict((par, None if err is None else tuple(err)) for par, err in zip(missing, errors))
+        # the failures are not stored, so that they are tried again
+        fitcache.StoreMinos(self.config, key,
+                            dict((par, err) for par, err in errors.items() if err is not None))
+        errors.update((par, cached[par]) for par in pars if cached.get(par) is not None)
+        return errors
+
     def PoissonUL(self,Fit):
         """ Compute UL using Feldman-cousin poisson stat"""
         self.info('Compute the exposure')#run gtexposure
 
-        try :
-            spfile = pyfits.open(self.obs.lcfile)
-        except:
-            self.obs.GtLCbin(dt = self.config['time']['tmax']-self.config['time']['tmin'])
-            #spfile = pyfits.open(self.obs.lcfile)
-
         try:
             self.obs.Configuration['AppLC']['index'] = self.config['UpperLimit']['SpectralIndex']
         except:
@@ -293,58 +548,40 @@ class FitMaker(Loggin.Message):
                 self.obs.Configuration['AppLC']['index'] = 1.5
 
         self.info("Assuming spectral index of %s" %self.info("Assuming default index of 1.5"))
-        self.obs.GtExposure()
-        Exposure = np.sum(spfile[1].data.field("EXPOSURE"))
+        if self.config['AppLC']['ExposureTool'] == 'enrico':
+            Exposure = np.sum(exposure.ComputeExposure(self.obs,[self.obs.t1],[self.obs.t2],
+                                                       self.obs.Configuration['AppLC']['index']))
+        else:
+            try :
+                pyfits.open(self.obs.lcfile)
+            except:
+                self.obs.GtLCbin(dt = self.config['time']['tmax']-self.config['time']['tmin'])
+            self.obs.GtExposure()
+            spfile = pyfits.open(self.obs.lcfile)
+            Exposure = np.sum(spfile[1].data.field("EXPOSURE"))
 
         ### Run it in any case (useful for instance for the DL3)
         #self.info('Compute the psf')#run gtpsf
         #self.obs.GtPSF()
 
+        #get the 68% containement radius of the psf at each energy
+        theta68 = ContainmentRadius(self.obs.psf, 0.68)
+
+        #compute the number of events within the PSF radius, for all the
+        #energy planes of the CCUBE at once
         ccube = pyfits.open(self.obs.ccube)
-        psfres = pyfits.open(self.obs.psf)
-
-        #read psf and get the 68% containement radius
-        theta = (psfres[2].data["Theta"])
-        theta68 = np.zeros(len(psfres[1].data["psf"]))
-        for i in xrange(len(psfres[1].data["psf"])):
-            integral = np.trapz(psfres[1].data["psf"][i],theta)
-            for j in xrange(psfres[1].data["psf"][i].size):
-               if np.trapz(psfres[1].data["psf"][i][:j],theta[:j])/integral>0.68:
-                   theta68[i] = theta[j]
-                   break
-
-        #read the CCUBE
-        x = np.arange(-abs(int(ccube[0].header["CRPIX1"])*ccube[0].header["CDELT1"]),\
-                abs(ccube[0].header["CRPIX1"]*ccube[0].header["CDELT1"]),abs(ccube[0].header["CDELT1"]))
-        y = np.arange(-abs(ccube[0].header["CRPIX2"]*ccube[0].header["CDELT2"]),\
-                abs(int(ccube[0].header["CRPIX2"])*ccube[0].header["CDELT2"]),abs(ccube[0].header["CDELT2"]))
-
-        xx, yy = np.meshgrid(x, y)
-        dist = np.sqrt(xx**2 + yy**2)
-        Obsevt = 0 #compute the number of events within the PSF radius
-        for i in xrange(len(psfres[1].data["psf"])):
-            maps = ccube[0].data[i]
-            Obsevt += sum(maps[dist<theta68[i]])/0.68
+        counts = ccube[0].data[:len(theta68)]
+        dist = DistanceMap(ccube[0].header)
+        Obsevt = np.sum(counts*(dist < theta68[:len(counts), np.newaxis, np.newaxis]))/0.68
+        ccube.close()
 
         nbg = max(0,int(Obsevt-Fit.NpredValue(self.obs.srcname)))
         Obsevt = int(Fit.NpredValue(self.obs.srcname)+nbg)
-        if Obsevt> 20:
-            self.warning("Observed Numbers of event too high (>20)\n abort and return -1")
-            return -1
-
-        cl = str(int(float(self.config['UpperLimit']['cl'])*100))
-        try :
-            ullookup = np.genfromtxt(environ.ENRICO_DIR+'/enrico/extern/UL_poisson_'+cl+'.dat',unpack=True)
-        except:
-            self.warning("cannot find the file "+environ.ENRICO_DIR+'/enrico/extern/UL_poisson_'+cl+'.dat')
-        bkglookup = np.array([0.0,0.5,1.0,1.5,2.0,2.5,3.0,3.5,4.0,5.0,6.0,7.0,8.0,9.0,10.0,11.0,12.0,13.0,14.0,15.0])
-        measurement = ullookup[0] #the first row is the measurement
-
-        uls = ullookup[2:-1:2] #keep only 1 row over 2 since we don't care about LL
 
         self.info("Found "+str(Obsevt)+" events for "+str(nbg)+" background event ")
-#        print uls[bkglookup.searchsorted(nbg)][measurement.searchsorted(Obsevt)]," ",Exposure
-        return uls[bkglookup.searchsorted(nbg)][measurement.searchsorted(Obsevt)]/Exposure
+        cl = float(self.config['UpperLimit']['cl'])
+        ul = stats.FCInterval(Obsevt, nbg, cl, GetBeltCacheDir(self.config))[1]
+        return ul/Exposure
 
     def ComputeUL(self, Fit):
         """Compute an Upper Limit using either the profil or integral method
@@ -376,13 +613,10 @@ class FitMaker(Loggin.Message):
         if self.config['UpperLimit']['Method'] == "Profile": #The method is Profile
             if Fit.Ts(self.obs.srcname)<2 :
                 self.warning("TS of the source is very low, better to use Integral method")
-            import UpperLimits
-            ulobject = UpperLimits.UpperLimits(Fit)
-            ul, _ = ulobject[self.obs.srcname].compute(emin=self.obs.Emin,
-                                      emax=self.obs.Emax,delta=delta)
-                                      #delta=2.71 / 2)
-            self.info("Upper limit using Profile method: ")
-            print ulobject[self.obs.srcname].results
+            profile = likeprofile.GetProfile(Fit, self.obs.srcname,
+                                             self.config['fitting']['optimizer'])
+            ul = profile.UpperLimit(delta, self.obs.Emin, self.obs.Emax)
+            self.info("Upper limit using Profile method: "+str(ul))
             self.warning("Be sure to have enough photons to validate the gaussian assumption")
         if self.config['UpperLimit']['Method'] == "Integral": #The method is Integral
             import IntegralUpperLimit
@@ -399,55 +633,66 @@ class FitMaker(Loggin.Message):
         print "This is an ul on the integral flux in ph/cm2/s"
         return ul #Return the result. This is an ul on the integral flux in ph/cm2/s
 
+    def _IndexUL(self, Fit, indx):
+        """UL for the index indx, used by EnvelopeUL"""
+        import IntegralUpperLimit
+        utils.FreezeParams(Fit,self.obs.srcname,'Index',indx)
+        #Use either the profile or the integral method
+        with timing.Stage(self.config, 'UL') as stage:
+            stage.info['method'] = self.config['UpperLimit']['Method']
+            stage.info['index'] = indx
+            if self.config['UpperLimit']['Method'] == "Profile":
+                profile = likeprofile.GetProfile(Fit, self.obs.srcname,
+                                                 self.config['fitting']['optimizer'])
+                ul_val = profile.UpperLimit(2.71 / 2, self.obs.Emin, self.obs.Emax)
+            if self.config['UpperLimit']['Method'] == "Integral":
+                ul_val, _ = IntegralUpperLimit.calc_int(Fit, self.obs.srcname,
+                                                        verbosity=0)
+        print "Index = ", indx, " UL = ", ul_val  #small print
+        return ul_val
+
     def EnvelopeUL(self, Fit):
         """Compute the envelope UL. An UL is computed for different index and the maximum is taken at each energy.
         This is usefull when the source index is not know or can not be constrain by theoritical argument
-        The index range form 1.5 to 2.5"""
-        import IntegralUpperLimit
-        import UpperLimits
+        The index range form 1.5 to 2.5. The ULs for the different index are computed in parallel
+        if [analysis]/Nprocess > 1. The envelope is written in <out>/<target>_EnvelopeUL.txt
+        and returned with the energies"""
         self._log('EnvelopeUL', 'Compute upper limit envelope')
-        PhIndex = Fit.par_index(self.obs.srcname, 'Index')
         Nbp = 20 #Make Nbp computations
         Npgraph = 100#The graph has Npgraph points
         ener = np.logspace(np.log10(self.obs.Emin),
                            np.log10(self.obs.Emax), Npgraph)#the array containing the energy
-        Ulenv = np.array(Npgraph * [0.])#the array containing the UL value
-
-        for i in xrange(Nbp):
-            indx = -1.5 - i / (Nbp - 1.)
-            utils.FreezeParams(Fit,self.srcname,PhIndex,indx)
-            #Use either the profile or the integral method
-            self.info("Methode used: "+self.config['UpperLimit']['Method'])
-            if self.config['UpperLimit']['Method'] == "Profile":
-                ul = UpperLimits.UpperLimits(Fit)
-                source_ul = ul[self.obs.srcname]
-                ul_val, _ = source_ul.compute(emin=self.obs.Emin,
-                                              emax=self.obs.Emax,
-                                              delta=2.71 / 2)
-            if self.config['UpperLimit']['Method'] == "Integral":
-                ul_val, _ = IntegralUpperLimit.calc_int(Fit, self.obs.srcname,
-                                                        verbosity=0)
-            self.success("Upper Limits calculated")
-            print "Index = ", indx, " UL = ", ul_val  #small print
-            for j in xrange(Npgraph):
-                model_name = Fit.model.srcs[self.obs.srcname].spectrum().genericName()
-                #compute the DNDE value. The computation change is
-                #the model is PowerLaw or PowerLaw2
-                #Note : Other model are not taken into account
-                #and no UL will be computed
-                if model_name == 'PowerLaw2':
-                    newUl = ul_val * (indx + 1) * pow(ener[j], indx + 2) \
-                        / (pow(self.obs.Emax, indx + 1) - pow(self.obs.Emin, indx + 1))
-                elif model_name == 'PowerLaw':
-                    IdEScale = utils.getParamIndx(Fit, self.obs.srcname, 'Scale')
-                    Escale = Fit[IdEScale].value()
-                    newUl = ul_val * pow(ener[j] / Escale, indx + 2)*Escale**2*1.6022e-6
-                Ulenv[j] = max(Ulenv[j], newUl)
+        indices = -1.5 - np.arange(Nbp) / (Nbp - 1.)
+
+        self.info("Methode used: "+self.config['UpperLimit']['Method'])
+        ul_val = np.array(self.ParallelMap(Fit, '_IndexUL', list(indices)))
+        self.success("Upper Limits calculated")
+
+        #compute the DNDE value on the index x energy grid. The computation change is
+        #the model is PowerLaw or PowerLaw2
+        #Note : Other model are not taken into account
+        #and no UL will be computed
+        model_name = Fit.model.srcs[self.obs.srcname].spectrum().genericName()
+        indx = indices[:, np.newaxis]
+        if model_name == 'PowerLaw2':
+            newUl = ul_val[:, np.newaxis] * (indx + 1) * ener**(indx + 2) \
+                / (self.obs.Emax**(indx + 1) - self.obs.Emin**(indx + 1))
+        elif model_name == 'PowerLaw':
+            IdEScale = utils.getParamIndx(Fit, self.obs.srcname, 'Scale')
+            Escale = Fit[IdEScale].value()
+            newUl = ul_val[:, np.newaxis] * (ener / Escale)**(indx + 2)*Escale**2*1.6022e-6
+        else:
+            self.warning("No UL envelope for the model "+model_name)
+            return None
+        Ulenv = np.max(newUl, axis=0)
 
         print
         self.info("Result of the UL envelope")
         for j in xrange(Npgraph):
             print ener[j], " ", Ulenv[j]
+        filename = self.config['out']+'/'+self.obs.srcname+'_EnvelopeUL.txt'
+        np.savetxt(filename, np.transpose([ener, Ulenv]), header='Energy (MeV)  E2dN/dE UL')
+        return ener, Ulenv
 
     def ComputeSED(self, Fit, dump=False):
         """compute the SED with the butterfly for all the model and save it into an ascii file"""
@@ -462,11 +707,13 @@ class FitMaker(Loggin.Message):
         result.GetDecorrelationEnergy(Param)
         if (dump):
             result._DumpSED(Param)
+            render.Render(self.config, plotting.PlotCounts, Param)
 
         return(result)
 
-    def ModelMap(self, xml):
-        """Make a model Map. Valid only if the statistic is binned"""
+    def ModelMap(self, xml, Fit=None):
+        """Make a model Map. Valid only if the statistic is binned. If the
+        fitted model Fit is given, it is computed in the job (no gtmodel)"""
         if self.config['analysis']['likelihood'] == 'binned':
             self._log('gtmodel', 'Make model map')#run gtmodel
-            self.obs.ModelMaps(xml)
+            self.obs.ModelMaps(xml, Fit)
@@ -6,10 +6,15 @@ The Observation class contains all the variables needed  to run the ST like file
 begun October 2010
 """
 import os
+import shutil
 from math import sqrt, log10
 from gt_apps import evtbin, maketime, diffResps, expCube, expMap, srcMaps, model_map, filter
 from GtApp import GtApp
 from enrico import utils
+from enrico import cache
+from enrico import srcmaps
+from enrico import modelmap
+from enrico import timing
 
 
 class Observation:
@@ -114,7 +119,7 @@ class Observation:
         evtbin['axisrot'] = 0
         evtbin['proj'] = self.Configuration['space']['proj']
         evtbin['clobber'] = self.clobber
-        evtbin.run()
+        cache.RunCached(evtbin, self.Configuration)
 
     def GtBinDef(self,filename):
         if (self.clobber=="no" and os.path.isfile(self.BinDef)):
@@ -124,7 +129,8 @@ class Observation:
         bindef['bintype'] = 'T'
         bindef['binfile'] = filename
         bindef['outfile'] = self.BinDef
-        bindef.run()
+        with timing.Stage(self.Configuration, 'gtbindef', self.BinDef):
+            bindef.run()
 
     def GtExposure(self):
         exposure = GtApp('gtexposure', 'Likelihood')
@@ -137,7 +143,9 @@ class Observation:
         exposure['srcmdl'] = "none"
         exposure['specin'] = -self.Configuration['AppLC']['index']
         exposure['clobber'] = self.clobber
-        exposure.run()
+        cache.Unshare(self.lcfile) # gtexposure modifies its input file
+        with timing.Stage(self.Configuration, 'gtexposure', self.lcfile):
+            exposure.run()
 
     def GtLCbin(self,dt=60):
         """Run gtbin with the LC option. the default dt is 60 sec and data can be rebinned after.
@@ -158,7 +166,7 @@ class Observation:
             evtbin["tbinalg"] = "FILE"
             evtbin["tbinfile"] = self.BinDef
         evtbin['clobber'] = self.clobber
-        evtbin.run()
+        cache.RunCached(evtbin, self.Configuration)
 
     def GtCcube(self):
         """Run gtbin with the CCUBE option"""
@@ -187,7 +195,7 @@ class Observation:
         #per decade (given by the users). The +0.5 rounds it properly
         evtbin["enumbins"] = max(2,int(Nbdecade*self.Configuration['energy']['enumbins_per_decade']+0.5))
         evtbin['clobber'] = self.clobber
-        evtbin.run()
+        cache.RunCached(evtbin, self.Configuration)
 
     def GtBinnedMap(self):
         """Run the gtexpcube2 tool for binned analysis"""
@@ -208,7 +216,7 @@ class Observation:
         expcube2['coordsys'] = self.Configuration['space']['coordsys']
         expcube2['proj'] = self.Configuration['space']['proj'] #"AIT"
         expcube2['clobber'] = self.clobber
-        expcube2.run()
+        cache.RunCached(expcube2, self.Configuration)
     
     def FirstCut(self):
         """Run gtselect tool"""
@@ -237,7 +245,7 @@ class Observation:
         filter['evclass'] = self.Configuration['event']['evclass']
         filter['evtype'] = "INDEF"
         filter['clobber'] = self.clobber
-        filter.run()
+        cache.RunCached(filter, self.Configuration)
 
     def SelectEvents(self):
         """Run gtselect tool"""
@@ -257,7 +265,7 @@ class Observation:
         filter['evclass'] = self.Configuration['event']['evclass']
         filter['evtype'] = self.Configuration['event']['evtype']
         filter['clobber'] = self.clobber
-        filter.run()
+        cache.RunCached(filter, self.Configuration)
 
     def time_selection(self):
         """
@@ -322,14 +330,19 @@ class Observation:
         maketime['evfile']  = self.eventfile
         maketime['outfile'] = outfile
         maketime['clobber'] = self.clobber
-        maketime.run()
+        cache.RunCached(maketime, self.Configuration)
 
     def DiffResps(self):
         """run gtdiffresp"""
         if (self.clobber=="no" and os.path.isfile(self.diffrspflag)):
             #print("File exists and clobber is False")
             return(0)
-        diffResps['evfile']=self.mktimefile
+        #gtdiffrsp writes in the event file: work on a copy and replace the
+        #file at the end, so that an interrupted run never leaves a partly
+        #modified event file (the steps reading it run after this one)
+        tmpfile = self.mktimefile+'.diffrsp.tmp'
+        shutil.copy2(self.mktimefile, tmpfile)
+        diffResps['evfile']=tmpfile
         diffResps['scfile']=self.ft2
         diffResps['srcmdl']=self.xmlfile
         if  self.Configuration['event']['irfs'] != 'CALDB':
@@ -342,7 +355,8 @@ class Observation:
         diffResps['convert']="no"
 
         diffResps['clobber'] = self.clobber
-        diffResps.run()
+        cache.RunCached(diffResps, self.Configuration, tmpfile, inplace=True)
+        os.rename(tmpfile, self.mktimefile)
         with open(self.diffrspflag,"w") as diffrspflag:
             diffrspflag.write("")
 
@@ -361,7 +375,7 @@ class Observation:
         expCube['zmax']=self.Configuration['analysis']['zmax']
         expCube['phibins']=self.Configuration['space']['phibins']
         expCube['clobber'] = self.clobber
-        expCube.run()
+        cache.RunCached(expCube, self.Configuration)
 
     def ExpMap(self):
         "Run gtexpmap for unbinned analysis"
@@ -382,7 +396,7 @@ class Observation:
         #The number of bin is the number of decade * the number of bin per decade (given by the users)
         expMap['nenergies'] =  max(2,int(Nbdecade*self.Configuration['energy']['enumbins_per_decade']+0.5))
         expMap['clobber'] = self.clobber
-        expMap.run()
+        cache.RunCached(expMap, self.Configuration)
 
     def SrcMap(self):
         """Run gtsrcmap tool for binned analysis"""
@@ -402,14 +416,19 @@ class Observation:
         srcMaps['outfile'] = self.srcMap
         srcMaps['emapbnds']='no'
         srcMaps['clobber'] = self.clobber
-        srcMaps.run()
+        srcmaps.RunSrcMaps(srcMaps, self.Configuration)
 
-    def ModelMaps(self,xml):
+    def ModelMaps(self,xml,Fit=None):
         """Run gtmodelmap tool for binned analysis and make a subtraction of the produced map
-         with the count map to produce a residual map"""
+         with the count map to produce a residual map. If the fitted model Fit is given,
+         the maps are computed from the source maps without gtmodel"""
         if (self.clobber=="no" and os.path.isfile(self.ModelMap)):
             #print("File exists and clobber is False")
             return(0)
+        if Fit is not None:
+            with timing.Stage(self.Configuration, 'modelmap', self.ModelMap):
+                modelmap.MakeModelMaps(Fit, self.srcMap, self.ModelMap, self.Configuration)
+            return
         model_map['expcube'] = self.Cubename
         model_map['srcmaps'] = self.srcMap
         model_map['bexpmap'] = self.BinnedMapfile
@@ -421,7 +440,8 @@ class Observation:
         model_map["irfs"]=self.irfs
         model_map['outfile'] = self.ModelMap
         model_map['clobber'] = self.clobber
-        model_map.run()
+        with timing.Stage(self.Configuration, 'gtmodel', self.ModelMap):
+            model_map.run()
         #Compute the residual map
         utils.SubtractFits(self.cmapfile,self.ModelMap,self.Configuration)
 
@@ -449,7 +469,8 @@ class Observation:
         findsrc['clobber'] = self.clobber
         findsrc['reopt'] = self.Configuration["findsrc"]["Refit"]
         findsrc['outfile'] = outfile
-        findsrc.run()
+        with timing.Stage(self.Configuration, 'gtfindsrc', outfile):
+            findsrc.run()
 
     def SrcProb(self):
         """Run the gtsrcprob tool"""
@@ -468,7 +489,8 @@ class Observation:
         srcprob['outfile'] = self.Probfile
         srcprob['srclist'] = self.Configuration['srcprob']['srclist']
         srcprob['clobber'] = self.clobber
-        srcprob.run()
+        with timing.Stage(self.Configuration, 'gtsrcprob', self.Probfile):
+            srcprob.run()
 
     def GtPSF(self):
         if (self.clobber=="no" and os.path.isfile(self.psf)):
@@ -487,5 +509,5 @@ class Observation:
         psf["emax"]    = self.Emax
         psf["nenergies"] = max(2,int(Nbdecade*self.Configuration['energy']['enumbins_per_decade']+0.5))
         psf["thetamax"] = 5.
-        psf.run()
+        cache.RunCached(psf, self.Configuration)
 
@@ -3,13 +3,9 @@ from math import sqrt
 import numpy as np
 import scipy.optimize
 from scipy.stats import chi2
-import matplotlib
-matplotlib.use('Agg')
-matplotlib.rc('font', **{'family': 'serif', 'serif': ['Computer Modern'], 'size': 15})
-matplotlib.rc('text', usetex=True)
-import matplotlib.pyplot as plt
 from enrico import utils
 from enrico import plotting
+from enrico import render
 from enrico import environ
 from enrico.config import get_config
 from enrico.constants import LightcurvePath,FoldedLCPath
@@ -225,6 +221,9 @@ class LightCurve(Loggin.Message):
 
     def _PlotLC(self,folded=False):
         self.info("Reading files produced by enrico")
+        # this is the render stage of the LC: deferred plots are made now
+        if self.config['Spectrum']['RenderPlots'] == 'deferred':
+            self.config['Spectrum']['RenderPlots'] = 'inline'
         LcOutPath = self.LCfolder + self.config['target']['name']
 
         #Result are stored into list. This allow to get rid of the bin which failled
@@ -321,17 +320,14 @@ class LightCurve(Loggin.Message):
         #             TS vs Time
         if self.config['LightCurve']['DiagnosticPlots'] == 'yes' and len(Npred)>0:
             #plot Npred vs flux
-            plt.figure()
             NdN = np.asarray(Npred) /np.sqrt(Npred)
             FdF = np.asarray(FluxForNpred) / (np.asarray(FluxErr) + 1e-20)
-            plt.errorbar(NdN, FdF,fmt='+',color='black')
 
             if len(Npred_detected)>0:
-                NdN = np.asarray(Npred_detected) /np.sqrt(Npred_detected)
-                FdF = np.asarray(FluxForNpred[Npred_detected_indices]) / (np.asarray(FluxErr[Npred_detected_indices]) + 1e-20)
-                plt.errorbar(NdN, FdF,fmt='+',color='red')
+                NdN_detected = np.asarray(Npred_detected) /np.sqrt(Npred_detected)
+                FdF_detected = np.asarray(FluxForNpred[Npred_detected_indices]) / (np.asarray(FluxErr[Npred_detected_indices]) + 1e-20)
 
-                popt,_ = scipy.optimize.curve_fit(pol1, NdN, FdF, p0=[0,1])#, sigma=dydata)
+                popt,_ = scipy.optimize.curve_fit(pol1, NdN_detected, FdF_detected, p0=[0,1])#, sigma=dydata)
 
 
                 for i in xrange(len(FluxForNpred)):
@@ -341,60 +337,18 @@ class LightCurve(Loggin.Message):
                         print "V(Npred) = ",sqrt(Npred[i])
                         print 
 
-                plt.plot(np.array([0,max(NdN)]),pol1(np.array([0,max(NdN)]),popt[0],popt[1]),'--',color='black')
-                plt.xlabel(r"${\rm Npred/\sqrt{Npred}}$")
-                plt.ylabel(r"${\rm Flux/\Delta Flux}$")
-                plt.savefig(LcOutPath+"_Npred.png", dpi=150, facecolor='w', edgecolor='w',
-                    orientation='portrait', papertype=None, format=None,
-                    transparent=False, bbox_inches=None, pad_inches=0.1,
-                    frameon=None)
+                render.Render(self.config, PlotNpred, NdN, FdF, NdN_detected, FdF_detected,
+                              popt, LcOutPath+"_Npred.png")
             else :
                 print "No Npred Plot produced"
 
             #plot TS vs Time
-            plt.figure()
-            plt.ylim(ymin=min(TS)*0.8,ymax=max(TS)*1.2)
-            plt.xlabel(r"Time (s)")
-            plt.ylabel(r"Test Statistic")
-            plt.errorbar(Time,TS,xerr=TimeErr,fmt='+',color='black',ls='None')
-            plt.savefig(LcOutPath+"_TS.png", dpi=150, facecolor='w', edgecolor='w',
-                    orientation='portrait', papertype=None, format=None,
-                    transparent=False, bbox_inches=None, pad_inches=0.1,
-                    frameon=None)
-
-
-#    Plot the LC itself. This function return a TH2F for a nice plot
-#    a TGraph and a list of TArrow for the ULs
-        # if folded:
-        #     phase = np.linspace(0,1,self.Nbin+1)
-        #     Time = (phase[1:]+phase[:-1])/2.
-        #     TimeErr = (phase[1:]-phase[:-1])/2.
-        #     gTHLC,TgrLC,ArrowLC = plotting.PlotFoldedLC(Time,TimeErr,Flux,FluxErr)
-        #     gTHIndex,TgrIndex,ArrowIndex = plotting.PlotFoldedLC(Time,TimeErr,Index,IndexErr)
-        #     if CutoffName is not None:
-        #         gTHCutoff,TgrCutoff,ArrowCutoff = plotting.PlotFoldedLC(Time,TimeErr,Cutoff,CutoffErr)
-        # else :
-        #     gTHLC,TgrLC,ArrowLC = plotting.PlotLC(Time,TimeErr,Flux,FluxErr)
-        #     gTHIndex,TgrIndex,ArrowIndex = plotting.PlotLC(Time,TimeErr,Index,IndexErr)
-        #     if CutoffName is not None:
-        #         gTHCutoff,TgrCutoff,ArrowCutoff = plotting.PlotFoldedLC(Time,TimeErr,Cutoff,CutoffErr)
-
-        # xmin = min(Time) - max(TimeErr) * 10
-        # xmax = max(Time) + max(TimeErr) * 10
-        # ymin = min(Flux) - max(FluxErr) * 1.3
-        # ymax = max(Flux) + max(FluxErr) * 1.3
-        plt.figure()
-        plt.xlabel(r"Time (s)")
-        plt.ylabel(r"${\rm Flux\ (photon\ cm^{-2}\ s^{-1})}$")
-        # plt.ylim(ymin=ymin,ymax=ymax)
-        # plt.xlim(xmin=xmin,xmax=xmax)
-        #plt.errorbar(Time,Flux,xerr=TimeErr,yerr=FluxErr,fmt='o',color='black',ls='None',uplims=uplim)
-        plot_errorbar_withuls(Time,TimeErr,TimeErr,Flux,FluxErr,FluxErr,uplim,bblocks=True)
-
-        plt.savefig(LcOutPath+"_LC.png", dpi=150, facecolor='w', edgecolor='w',
-                orientation='portrait', papertype=None, format=None,
-                transparent=False, bbox_inches=None, pad_inches=0.1,
-                frameon=None)
+            render.Render(self.config, PlotTS, Time, TimeErr, TS, LcOutPath+"_TS.png")
+
+        #Plot the LC itself, with the bayesian blocks if asked
+        bblocks = (self.config['LightCurve']['BayesianBlocks'] == 'yes')
+        render.Render(self.config, PlotFlux, Time, TimeErr, Flux, FluxErr, uplim,
+                      LcOutPath+"_LC.png", bblocks)
 
         # compute Fvar and probability of being cst
 
@@ -522,15 +476,7 @@ class LightCurve(Loggin.Message):
             del Fit #Clean memory
 
 
-        plt.figure()
-        plt.xlabel("Time")
-        plt.ylabel("Log(Like) Variability")
-        plt.errorbar(Time,LogL0,fmt='o',color='black',ls='None')
-
-        plt.savefig(LcOutPath+"_VarIndex.png", dpi=150, facecolor='w', edgecolor='w',
-                orientation='portrait', papertype=None, format=None,
-                transparent=False, bbox_inches=None, pad_inches=0.1,
-                frameon=None)
+        render.Render(self.config, PlotVarIndex, Time, LogL0, LcOutPath+"_VarIndex.png")
 
         self.info("Variability index calculation") 
         print "\t TSvar = ",2*(sum(LogL1)-sum(LogL0))
@@ -560,3 +506,56 @@ def WriteToAscii(Time, TimeErr, Flux, FluxErr, Index, IndexErr, Cutoff, CutoffEr
                       str(TS[i]) + "\t" + str(Npred[i]) + "\n")
     flc.close()
 
+def PlotNpred(NdN, FdF, NdN_detected, FdF_detected, popt, filename):
+    """Plot Flux/dFlux vs Npred/sqrt(Npred) for all the bins (black)
+    and for the detected ones (red) with the linear fit of the latter"""
+    plt = plotting.LoadPyplot()
+    plt.figure()
+    plt.errorbar(NdN, FdF,fmt='+',color='black')
+    plt.errorbar(NdN_detected, FdF_detected,fmt='+',color='red')
+    plt.plot(np.array([0,max(NdN_detected)]),pol1(np.array([0,max(NdN_detected)]),popt[0],popt[1]),'--',color='black')
+    plt.xlabel(r"${\rm Npred/\sqrt{Npred}}$")
+    plt.ylabel(r"${\rm Flux/\Delta Flux}$")
+    plt.savefig(filename, dpi=150, facecolor='w', edgecolor='w',
+        orientation='portrait', papertype=None, format=None,
+        transparent=False, bbox_inches=None, pad_inches=0.1,
+        frameon=None)
+
+def PlotTS(Time, TimeErr, TS, filename):
+    """Plot the TS vs time"""
+    plt = plotting.LoadPyplot()
+    plt.figure()
+    plt.ylim(ymin=min(TS)*0.8,ymax=max(TS)*1.2)
+    plt.xlabel(r"Time (s)")
+    plt.ylabel(r"Test Statistic")
+    plt.errorbar(Time,TS,xerr=TimeErr,fmt='+',color='black',ls='None')
+    plt.savefig(filename, dpi=150, facecolor='w', edgecolor='w',
+            orientation='portrait', papertype=None, format=None,
+            transparent=False, bbox_inches=None, pad_inches=0.1,
+            frameon=None)
+
+def PlotFlux(Time, TimeErr, Flux, FluxErr, uplim, filename, bblocks=False):
+    """Plot the light curve with the upper limits and optionally the bayesian blocks"""
+    plt = plotting.LoadPyplot()
+    plt.figure()
+    plt.xlabel(r"Time (s)")
+    plt.ylabel(r"${\rm Flux\ (photon\ cm^{-2}\ s^{-1})}$")
+    plot_errorbar_withuls(Time,TimeErr,TimeErr,Flux,FluxErr,FluxErr,uplim,bblocks=bblocks)
+
+    plt.savefig(filename, dpi=150, facecolor='w', edgecolor='w',
+            orientation='portrait', papertype=None, format=None,
+            transparent=False, bbox_inches=None, pad_inches=0.1,
+            frameon=None)
+
+def PlotVarIndex(Time, LogL0, filename):
+    """Plot the log(likelihood) of the constant flux hypothesis vs time"""
+    plt = plotting.LoadPyplot()
+    plt.figure()
+    plt.xlabel("Time")
+    plt.ylabel("Log(Like) Variability")
+    plt.errorbar(Time,LogL0,fmt='o',color='black',ls='None')
+
+    plt.savefig(filename, dpi=150, facecolor='w', edgecolor='w',
+            orientation='portrait', papertype=None, format=None,
+            transparent=False, bbox_inches=None, pad_inches=0.1,
+            frameon=None)
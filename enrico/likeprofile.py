@@ -0,0 +1,158 @@
+"""
+Profile likelihood upper limits. The normalization of the source is
+increased from its best fit value until the profile log-likelihood has
+decreased by delta: the root is first bracketed with steps of increasing
+size, then found with Brent's method. At each point, the other free
+parameters are re-optimized starting from the values found at the
+previous point.
+The evaluated points of the profile are kept, so that the upper limits
+at other confidence levels (or the same one computed again) reuse them
+and need few or no new fits.
+"""
+import weakref
+import numpy as np
+from scipy.optimize import brentq
+from enrico import fitcache
+from enrico import Loggin
+
+# relative precision of the upper limit on the normalization
+XTOL = 1e-4
+# first step (relative to the normalization) to bracket the upper limit
+# when the fit gives no error on the normalization
+STEP = 0.1
+# maximum number of steps to bracket the upper limit
+MAXSTEP = 30
+
+#Profiles already computed for the model _ProfileFit (weak reference, so
+#that the Fit objects are not kept alive), by (source, initial state)
+_Profiles = {}
+_ProfileFit = None
+
+
+class Profile(object):
+    """Profile of -log(likelihood) vs the normalization of the source
+    srcname, the other free parameters of the model being optimized"""
+    def __init__(self, Fit, srcname, optimizer='MINUIT'):
+        self.Fit = weakref.proxy(Fit)
+        self.srcname = srcname
+        self.optimizer = optimizer
+        self.norm = Fit.model.srcs[srcname].spectrum().normPar().getName()
+        self.points = {}
+        self.nfit = 0
+
+        # best fit with the current (frozen) parameters
+        self.minus_logLike0 = self._Optimize()
+        self.state = fitcache.ModelState(Fit)
+        param = self._Params()[0]
+        self.x0 = param.value()
+        self.bounds = param.getBounds()
+        self.step = param.error()
+        if not(self.step > 0):
+            # the normalizations are scaled to be of order 1
+            self.step = STEP*abs(self.x0) or STEP
+        self.points[self.x0] = self.minus_logLike0
+
+    def _Params(self):
+        """The normalization parameter in all the components"""
+        return [comp[self.srcname].funcs['Spectrum'].getParam(self.norm)
+                for comp in fitcache.Components(self.Fit)]
+
+    def _Optimize(self):
+        """Fit the free parameters and return -log(likelihood)"""
+        self.nfit += 1
+        try:
+            self.Fit.fit(0, covar=False, optimizer=self.optimizer)
+        except RuntimeError: # e.g. no free parameter left
+            pass
+        return -sum(comp.logLike.value() for comp in fitcache.Components(self.Fit))
+
+    def _SetNorm(self, x):
+        """Fix the normalization to x"""
+        for param in self._Params():
+            if x > param.getBounds()[1]:
+                param.setBounds(param.getBounds()[0], x)
+            param.setFree(0)
+            param.setValue(x)
+        for comp in fitcache.Components(self.Fit):
+            comp.logLike.syncParams()
+
+    def __call__(self, x):
+        """-log(likelihood) with the normalization fixed to x"""
+        if x not in self.points:
+            self._SetNorm(x)
+            self.points[x] = self._Optimize()
+        return self.points[x]
+
+    def Points(self):
+        """The evaluated points of the profile, sorted by normalization"""
+        x = np.array(sorted(self.points))
+        return x, np.array([self.points[xi] for xi in x])
+
+    def Restore(self):
+        """Put the model back in its best fit state"""
+        for param in self._Params():
+            param.setBounds(*self.bounds)
+        fitcache.SetModelState(self.Fit, self.state)
+
+    def UpperLimitNorm(self, delta):
+        """Normalization for which -log(likelihood) has increased by delta"""
+        diff = lambda x: self(x)-self.minus_logLike0-delta
+
+        # tightest bracket among the points already evaluated
+        x, values = self.Points()
+        above = (x >= self.x0)*(values-self.minus_logLike0 > delta)
+        below = (x >= self.x0)*(values-self.minus_logLike0 <= delta)
+        lo = x[below].max()
+        if above.any():
+            hi = x[above].min()
+        else:
+            step = self.step
+            for i in xrange(MAXSTEP):
+                hi = lo+step
+                if diff(hi) > 0:
+                    break
+                lo = hi
+                step *= 2
+            else:
+                raise RuntimeError("Cannot bracket the upper limit of "+self.srcname)
+        # relative precision on the root, the absolute one only matters
+        # for an upper limit much smaller than the first step
+        return brentq(diff, lo, hi, xtol=XTOL*XTOL*self.step, rtol=XTOL)
+
+    def UpperLimit(self, delta, emin, emax):
+        """Upper limit on the flux (ph/cm2/s) between emin and emax, the
+        profile likelihood having decreased by delta"""
+        nfit = self.nfit
+        try:
+            xul = self.UpperLimitNorm(delta)
+            self._SetNorm(xul)
+            ul = self.Fit.flux(self.srcname, emin, emax)
+        finally:
+            self.Restore()
+        Loggin.Message().info("Profile upper limit: %s=%g (%d fits, %d points in the profile)"
+                              % (self.norm, xul, self.nfit-nfit, len(self.points)))
+        return ul
+
+
+def _Key(Fit, srcname):
+    state = [(src, par, value, free) for src, par, value, _, free in fitcache.ModelState(Fit)]
+    return (srcname, tuple(state))
+
+
+def GetProfile(Fit, srcname, optimizer='MINUIT'):
+    """Return the profile of the source srcname for the model Fit in its
+    current state, reusing the one already computed if any"""
+    global _ProfileFit
+    if _ProfileFit is None or _ProfileFit() is not Fit:
+        # new model: forget the profiles of the previous one
+        _Profiles.clear()
+        _ProfileFit = weakref.ref(Fit)
+    key = _Key(Fit, srcname)
+    if key not in _Profiles:
+        profile = Profile(Fit, srcname, optimizer)
+        _Profiles[key] = profile
+        # the model is left in its best fit state
+        _Profiles[_Key(Fit, srcname)] = profile
+    else:
+        _Profiles[key].Restore()
+    return _Profiles[key]
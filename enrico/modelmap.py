@@ -0,0 +1,87 @@
+"""
+In-process model and residual maps for the binned analyses, used in place
+of gtmodel. The source maps file contains, for each source, the expected
+counts per unit of dN/dE at the bounds of the energy bins: the model cube
+is the sum of the maps weighted by the fitted spectra, integrated over
+each energy bin with the trapezoid rule in log(E) as done by the binned
+likelihood.
+"""
+import os
+from functools import partial
+import numpy as np
+import pyfits
+from enrico import fitcache
+from enrico import Loggin
+
+
+def PlaneEnergies(hdus):
+    """Energies (MeV) of the planes of the source maps"""
+    try:
+        return np.array(hdus['ENERGIES'].data.field(0), dtype=float)
+    except KeyError:
+        ebounds = hdus['EBOUNDS'].data
+        # the bounds are in keV
+        return np.append(ebounds.field('E_MIN'), ebounds.field('E_MAX')[-1])/1e3
+
+
+def Spectrum(Fit, name, energies):
+    """dN/dE (ph/cm2/s/MeV) of the fitted model of a source"""
+    import pyLikelihood
+    spectrum = fitcache.Components(Fit)[0][name].funcs['Spectrum']
+    return np.array([spectrum(pyLikelihood.dArg(energy)) for energy in energies])
+
+
+def ModelCube(srcmapfile, names, spectrum):
+    """Model counts cube of the sources names, spectrum being a function
+    (name, energies) returning the dN/dE of the source name"""
+    mes = Loggin.Message()
+    hdus = pyfits.open(srcmapfile)
+    energies = PlaneEnergies(hdus)
+    counts = hdus[0].data
+    extensions = [hdu.name for hdu in hdus]
+    dlogE = np.log(energies[1:]/energies[:-1])[:, np.newaxis, np.newaxis]
+
+    model = np.zeros(counts.shape)
+    for name in names:
+        if name.upper() not in extensions:
+            mes.warning("No source map for "+name+", not included in the model map")
+            continue
+        weighted = hdus[name].data*(energies*spectrum(name, energies))[:, np.newaxis, np.newaxis]
+        model += 0.5*dlogE*(weighted[:-1]+weighted[1:])
+    header = hdus[0].header.copy()
+    counts = np.array(counts, dtype=float)
+    hdus.close()
+    return counts, model, header
+
+
+def Significance(counts, model):
+    """Signed significance of the counts given the model, from the Poisson
+    likelihood ratio"""
+    model = np.maximum(model, 1e-20)
+    logterm = np.where(counts > 0, counts*np.log(np.maximum(counts, 1e-20)/model), 0.)
+    return np.sign(counts-model)*np.sqrt(np.maximum(2*(logterm-(counts-model)), 0.))
+
+
+def _WriteFits(filename, data, header):
+    tmpfile = filename+'.%d.tmp' % os.getpid()
+    pyfits.writeto(tmpfile, np.asarray(data, dtype=np.float32), header, clobber=True)
+    os.rename(tmpfile, filename)
+
+
+def MakeModelMaps(Fit, srcmapfile, modelfile, config):
+    """Write the model cube of the fitted model Fit in modelfile and the
+    residual maps (counts - model, (counts - model)/model and the
+    significance of the counts summed over energy) in the output folder"""
+    counts, model, header = ModelCube(srcmapfile, Fit.model.srcNames, partial(Spectrum, Fit))
+    filebase = config['out'] + "/" + config['target']['name']
+    _WriteFits(modelfile, model, header)
+    _WriteFits(filebase + "_Subtract_Model_cmap.fits", counts-model, header)
+    _WriteFits(filebase + "_Residual_Model_cmap.fits",
+               (counts-model)/np.where(model > 0, model, np.inf), header)
+
+    header2d = header.copy()
+    for key in ['NAXIS3', 'CTYPE3', 'CRVAL3', 'CRPIX3', 'CDELT3', 'CUNIT3']:
+        if key in header2d:
+            del header2d[key]
+    _WriteFits(filebase + "_Significance_Model_cmap.fits",
+               Significance(counts.sum(axis=0), model.sum(axis=0)), header2d)
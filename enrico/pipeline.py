@@ -0,0 +1,125 @@
+"""
+Run the steps of the data preparation (gtselect, gtmktime, gtltcube, ...)
+as a dependency graph. A step is started as soon as all the steps it
+depends on are done, so that independent steps (e.g. the count map, the
+livetime cube and the diffuse response) run side by side on the local
+cores, each one in its own process. The number of processes is given by
+[analysis]/Nprocess (1 runs the steps one after the other, in the job
+itself, 0 uses all the cores).
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+from enrico import Loggin
+
+# time between two checks of the running steps, in seconds
+POLL_INTERVAL = 0.1
+
+
+class Step(object):
+    """A step of the graph: function() is run once all the steps named in
+    depends are done. description is printed when the step starts"""
+    def __init__(self, name, function, depends=(), description=''):
+        self.name = name
+        self.function = function
+        self.depends = list(depends)
+        self.description = description
+
+
+def GetNprocess(config):
+    """Number of processes used to run the graph"""
+    try:
+        nproc = int(config['analysis']['Nprocess'])
+    except KeyError:
+        nproc = 1
+    if nproc <= 0:
+        nproc = multiprocessing.cpu_count()
+    return nproc
+
+
+def _PrivatePfiles():
+    """Give the process its own directory of parameter files, so that two
+    instances of the same tool do not write the same .par file"""
+    pfiles = os.environ.get('PFILES', '')
+    userdir = tempfile.mkdtemp(prefix='pfiles_')
+    os.environ['PFILES'] = userdir+';'+pfiles.split(';')[-1]
+    return userdir
+
+
+def _RunStep(step):
+    """Body of the process running a step"""
+    userdir = _PrivatePfiles()
+    try:
+        step.function()
+    finally:
+        shutil.rmtree(userdir, ignore_errors=True)
+        sys.stdout.flush()
+
+
+def _CheckGraph(steps):
+    mes = Loggin.Message()
+    names = [step.name for step in steps]
+    for step in steps:
+        for dep in step.depends:
+            if dep not in names:
+                mes.error("Step "+step.name+" depends on the unknown step "+dep)
+
+    # a step can only depend on steps declared before it: no cycle
+    done = set()
+    for step in steps:
+        for dep in step.depends:
+            if dep not in done:
+                mes.error("Step "+step.name+" must be declared after "+dep)
+        done.add(step.name)
+
+
+def RunGraph(steps, nproc=1, log=None):
+    """Run the steps (a list of Step, each one declared after the steps it
+    depends on) with at most nproc processes. log(step) is called when a
+    step starts."""
+    _CheckGraph(steps)
+    mes = Loggin.Message()
+
+    if nproc <= 1:
+        for step in steps:
+            if log is not None:
+                log(step)
+            step.function()
+        return
+
+    pending = list(steps)
+    running = {}
+    done = set()
+    failed = []
+    while pending or running:
+        # start the steps which are ready, in the order of declaration
+        for step in list(pending):
+            if failed or len(running) >= nproc:
+                break
+            if all(dep in done for dep in step.depends):
+                pending.remove(step)
+                if log is not None:
+                    log(step)
+                sys.stdout.flush()
+                worker = multiprocessing.Process(target=_RunStep, args=(step,))
+                worker.start()
+                running[step.name] = worker
+
+        if failed and not running:
+            break
+        time.sleep(POLL_INTERVAL)
+        for name, worker in running.items():
+            if worker.is_alive():
+                continue
+            worker.join()
+            del running[name]
+            if worker.exitcode == 0:
+                done.add(name)
+            else:
+                failed.append(name)
+
+    if failed:
+        mes.error("Step(s) "+", ".join(failed)+" failed", "RunGraph")
@@ -1,18 +1,26 @@
-import os
 from distutils.version import LooseVersion
 import numpy as np
-import pyfits
 import pyLikelihood
-import matplotlib
-matplotlib.use('Agg')
-matplotlib.rc('font', **{'family': 'serif', 'serif': ['Computer Modern'], 'size': 15})
-matplotlib.rc('text', usetex=True)
-import matplotlib.pyplot as plt
 from enrico.constants import MEV_TO_ERG, ERG_TO_MEV
 from enrico.config import get_config
 from enrico import utils
 from enrico import Loggin
-from enrico.extern.astropy_bayesian_blocks import bayesian_blocks
+from enrico.bayesianblocks import BayesianBlocks
+
+_pyplot = None
+
+def LoadPyplot():
+    """Import and set up matplotlib on first use only, so that the jobs
+    which never make a plot do not pay for the matplotlib and LaTeX setup"""
+    global _pyplot
+    if _pyplot is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        matplotlib.rc('font', **{'family': 'serif', 'serif': ['Computer Modern'], 'size': 15})
+        matplotlib.rc('text', usetex=True)
+        import matplotlib.pyplot as plt
+        _pyplot = plt
+    return _pyplot
 
 class Params:
     """Collection of Plotting parameters like Energy bounds,
@@ -56,7 +64,7 @@ class Result(Loggin.Message):
 
     def _DumpSED(self,par):
         """Save the energy, E2.dN/dE, and corresponding  error in an ascii file
-        The count and residuals plot vs E is also made"""
+        The counts spectrum is also saved, see PlotCounts to plot it"""
 
         try:
             self.decE
@@ -69,10 +77,7 @@ class Result(Loggin.Message):
         self.info("SED value at the Decorrelation energy : %2.2e +/-  %2.2e erg/cm2/s" \
                 %(self.decSED, self.decSEDerr))
 
-        try:
-            self.CountsPlot(par)
-        except:
-            raise
+        self.DumpCountsSpectrum(par)
         # Save all in ascii file
         # log(E)  log (E**2*dN/dE)   log(E**2*dN/dE_err)  is_dot (0,1) is_upper (0,1)
         save_file = open(par.PlotName + '.dat', 'w')
@@ -120,106 +125,106 @@ class Result(Loggin.Message):
         arg = pyLikelihood.dArg(energy)
         return self.ptsrc.spectrum()(arg)
 
+    def DumpCountsSpectrum(self, Parameter):
+        """Save the observed and model counts spectra in an ascii file.
+        The spectra of all the components are summed in memory"""
+        emin, emax, obs, src, total = CountsSpectrum(self.Fit, Parameter.srcname)
+        np.savetxt(Parameter.PlotName + "_CountsPlot.dat",
+                   np.transpose([emin, emax, obs, src, total]), fmt="%12.4e",
+                   header="Emin (MeV)  Emax (MeV)  Observed counts  %s counts  Total model counts"
+                   % Parameter.srcname)
+
     def CountsPlot(self, Parameter):
-        """@todo: document me"""
-        imName = "tmp.fits"
-        filebase = Parameter.PlotName
-
-        total   = np.array([])
-        obs     = np.array([])
-        obs_err = np.array([])
-        emax    = np.array([])
-        emin    = np.array([])
-        src     = np.array([])
-
-        # Summed Likelihood has no writeCountsSpectra
-        # but we can do it component by component
-        for comp in self.Fit.components:
-            #self.Fit.writeCountsSpectra(imName)
-            comp.writeCountsSpectra(imName)
-            image = pyfits.open(imName)
-
-            #loop on the source names to find the good one
-            j = 0
-            for ID in image[1].data.names:
-                if ID == Parameter.srcname:
-                    indice = j
-                j += 1
-
-            for jn in xrange(len(image[3].data.field(0))):
-                energymin = image[3].data.field(1)[jn]
-                energymax = image[3].data.field(0)[jn]
-                if energymax in emax and energymin in emin:
-                    k = np.where(energymax==emax)
-                    obs[k]     = obs[k] + image[1].data.field(0)[jn]
-                    obs_err[k] = np.sqrt(obs[k])
-                    src[k]     = src[k] + image[1].data.field(indice)[jn]
-                    for i in xrange(len(image[1].data.names) - 1):
-                        total[k] = total[k] + image[1].data.field(i + 1)[jn]
-                else:
-                    emax    = np.append(emax, energymax)
-                    emin    = np.append(emin, energymin)
-                    obs     = np.append(obs,image[1].data.field(0)[jn])
-                    obs_err = np.append(obs_err, np.sqrt(image[1].data.field(0)[jn]))
-                    src     = np.append(src, image[1].data.field(indice)[jn])
-                    total   = np.append(total,0)
-                    for i in xrange(len(image[1].data.names) - 1):
-                        total[-1] = total[-1] + image[1].data.field(i + 1)[jn]
-
-        other = np.array(total - src)
-        Nbin  = len(src)
-        E = np.array((emax + emin) / 2.)
-        err_E = np.array((emax - emin) / 2.)
-
-        total = np.array(total)
-        residual = np.zeros(Nbin)
-        Dres = np.zeros(Nbin)
-
-        plt.figure()
-        plt.loglog()
-        plt.title('Counts plot')
-        plt.xlabel("E (MeV) ")
-        plt.ylabel("Counts / bin")
-        plt.errorbar(E,obs,xerr=err_E,yerr=obs_err,fmt='o',color="red",ls='None',label="Data")
-        plt.plot(E,other,'--',color="blue",label=Parameter.srcname)
-        plt.plot(E,src,'-',color="green",label="Other Sources")
-        plt.plot(E,total,'-',ls='None',label="All Sources")
-        plt.legend()
-        plt.savefig(filebase + "_CountsPlot.png", dpi=150, facecolor='w', edgecolor='w',
-            orientation='portrait', papertype=None, format=None,
-            transparent=False, bbox_inches=None, pad_inches=0.1,
-            frameon=None)
+        """Plot the counts spectrum and the residuals of the fit"""
+        self.DumpCountsSpectrum(Parameter)
+        PlotCounts(Parameter)
+
+
+def CountsSpectrum(Fit, srcname):
+    """Compute the observed and model counts spectra of a (summed) likelihood
+    object directly from the components, without writing any fits file.
+    Energy bins shared by several components (e.g. Front/Back or PSF classes)
+    are merged and their counts summed.
+    Return emin, emax, observed counts, counts of srcname and total model counts"""
+    try:
+        components = Fit.components
+    except AttributeError:
+        components = [Fit]
+
+    emin, emax, obs, src, total = [], [], [], [], []
+    for comp in components:
+        energies = np.asarray(comp.energies)
+        emin.append(energies[:-1])
+        emax.append(energies[1:])
+        obs.append(np.asarray(comp.nobs, dtype=float))
+        src.append(np.asarray(comp._srcCnts(srcname), dtype=float))
+        #model counts summed over all the sources of the component
+        total.append(np.sum([comp._srcCnts(name) for name in comp.sourceNames()], axis=0))
+
+    #identify the bins with the same bounds
+    bounds = np.zeros(sum(len(e) for e in emin), dtype=[('emin', float), ('emax', float)])
+    bounds['emin'] = np.concatenate(emin)
+    bounds['emax'] = np.concatenate(emax)
+    bins, index = np.unique(bounds, return_inverse=True)
+
+    def merge(counts):
+        return np.bincount(index, weights=np.concatenate(counts), minlength=len(bins))
+
+    return bins['emin'], bins['emax'], merge(obs), merge(src), merge(total)
+
+
+def PlotCounts(Parameter):
+    """Plot the counts spectrum and the residuals of the fit from
+    the ascii file written by Result.DumpCountsSpectrum"""
+    plt = LoadPyplot()
+    filebase = Parameter.PlotName
+
+    emin, emax, obs, src, total = np.loadtxt(filebase + "_CountsPlot.dat", unpack=True, ndmin=2)
+    obs_err = np.sqrt(obs)
+    other = total - src
+    E = (emax + emin) / 2.
+    err_E = (emax - emin) / 2.
 
-        plt.figure()
-        plt.title('Residuals plot')
-        plt.semilogx()
+    plt.figure()
+    plt.loglog()
+    plt.title('Counts plot')
+    plt.xlabel("E (MeV) ")
+    plt.ylabel("Counts / bin")
+    plt.errorbar(E,obs,xerr=err_E,yerr=obs_err,fmt='o',color="red",ls='None',label="Data")
+    plt.plot(E,src,'--',color="blue",label=Parameter.srcname)
+    plt.plot(E,other,'-',color="green",label="Other Sources")
+    plt.plot(E,total,'-',ls='None',label="All Sources")
+    plt.legend()
+    plt.savefig(filebase + "_CountsPlot.png", dpi=150, facecolor='w', edgecolor='w',
+        orientation='portrait', papertype=None, format=None,
+        transparent=False, bbox_inches=None, pad_inches=0.1,
+        frameon=None)
 
-        for i in xrange(Nbin):
-            try:
-                residual[i] = (obs[i] - total[i]) / total[i]
-                Dres[i] = (obs_err[i] / total[i])
-            except:
-                residual[i] = 0.
-                Dres[i] = 0.
-            if residual[i] == -1.:
-               residual[i] = 0.
-
-        ymin = min(residual) - max(Dres)
-        ymax = max(residual) + max(Dres)
-        plt.ylim(ymax = ymax, ymin = ymin)
-        plt.xlim(xmin = min(E)*0.3, xmax = max(E)*2)
-        plt.xlabel("E (MeV) ")
-        plt.ylabel("(counts-model)/model")
-        plt.errorbar(E,residual,xerr=err_E,yerr=Dres,fmt='o',color="red",ls='None',label="Data")
-        zero = np.zeros(2)
-        Ezero = np.array([0, 1e10])
-        plt.plot(Ezero,zero,'-',color='black')
-        plt.savefig(filebase + "ResPlot.png", dpi=150, facecolor='w', edgecolor='w',
-            orientation='portrait', papertype=None, format=None,
-            transparent=False, bbox_inches=None, pad_inches=0.1,
-            frameon=None)
-        os.system("rm " + imName)
-        image.close()
+    plt.figure()
+    plt.title('Residuals plot')
+    plt.semilogx()
+
+    # bins without model counts or without observed counts get no residual
+    valid = (total > 0) * (obs > 0)
+    residual = np.zeros(len(E))
+    Dres = np.zeros(len(E))
+    residual[valid] = (obs[valid] - total[valid]) / total[valid]
+    Dres[valid] = obs_err[valid] / total[valid]
+
+    ymin = min(residual) - max(Dres)
+    ymax = max(residual) + max(Dres)
+    plt.ylim(ymax = ymax, ymin = ymin)
+    plt.xlim(xmin = min(E)*0.3, xmax = max(E)*2)
+    plt.xlabel("E (MeV) ")
+    plt.ylabel("(counts-model)/model")
+    plt.errorbar(E,residual,xerr=err_E,yerr=Dres,fmt='o',color="red",ls='None',label="Data")
+    zero = np.zeros(2)
+    Ezero = np.array([0, 1e10])
+    plt.plot(Ezero,zero,'-',color='black')
+    plt.savefig(filebase + "ResPlot.png", dpi=150, facecolor='w', edgecolor='w',
+        orientation='portrait', papertype=None, format=None,
+        transparent=False, bbox_inches=None, pad_inches=0.1,
+        frameon=None)
 
 
 # def PlotFoldedLC(Time, TimeErr, Flux, FluxErr, tag="Flux (photon cm^{-2} s^{-1})"):
@@ -324,6 +329,8 @@ def GetDataPoints(config,pars):
 
 def plot_errorbar_withuls(x,xerrm,xerrp,y,yerrm,yerrp,uplim,bblocks=False):
     """ plot an errorbar plot with upper limits. Optionally compute and draw bayesian blocks (bblocks) """
+    import matplotlib
+    plt = LoadPyplot()
     # plt.errorbar(Epoint, Fluxpoint, xerr=[EpointErrm, EpointErrp], yerr=[FluxpointErrm, FluxpointErrp],fmt='o',color='black',ls='None',uplims=uplim)
     uplim = np.asarray(uplim,dtype=bool) # It is an array of 1 and 0s, needs to be a bool array.
     # make sure that the arrays are numpy arrays and not lists.
@@ -375,8 +382,7 @@ def plot_errorbar_withuls(x,xerrm,xerrp,y,yerrm,yerrp,uplim,bblocks=False):
         # Set the value and error for the uls.
         yerr[uplim] = y[uplim] #min(y[yerr>0]+yerr[yerr>0])
         y[uplim] = 0
-        edges = bayesian_blocks(x,y,yerr,fitness='measures',p0=0.5)
-        #edges = bayesian_blocks(x[yerr>0],y[yerr>0],yerr[yerr>0],fitness='measures',p0=0.1)
+        edges = BayesianBlocks(x,y,yerr,fitness='measures',p0=0.5)
         xvalues = 0.5*(edges[:-1]+edges[1:])
         xerrors = 0.5*(edges[1:]-edges[:-1])
         yvalues = []
@@ -418,6 +424,7 @@ def plot_errorbar_withuls(x,xerrm,xerrp,y,yerrm,yerrp,uplim,bblocks=False):
 
 def PlotSED(config,pars):
     """plot a nice SED with a butterfly and points"""
+    plt = LoadPyplot()
 
     # Read the ascii file where the butterfly is stored
     filebase = utils._SpecFileName(config)
@@ -504,6 +511,8 @@ def PlotSED(config,pars):
             frameon=None)
 
 def PlotUL(pars,config,ULFlux,Index):
+    import matplotlib
+    plt = LoadPyplot()
 
     #Compute the SED
     E = np.logspace(np.log10(pars.Emin), np.log10(pars.Emax), pars.N)
@@ -0,0 +1,26 @@
+"""Figure rendering, kept off the critical path of the analysis.
+The analysis jobs dump their results in ascii files and the figures are made
+from these files following the [Spectrum]/RenderPlots option:
+ - inline : in the job itself, as soon as the results are available
+ - background : in a child process, while the job goes on
+ - deferred : not by the job. Run enrico_plot_sed or enrico_plot_lc once at the end
+"""
+import multiprocessing
+from enrico import Loggin
+
+
+def Render(config, function, *args):
+    """Make a figure by calling function(*args), either now, in a background
+    process or not at all, depending on config['Spectrum']['RenderPlots'].
+    Return the background process if one has been started"""
+    mes = Loggin.Message()
+    mode = config['Spectrum']['RenderPlots']
+    if mode == 'deferred':
+        mes.info("Plotting deferred, use enrico_plot_sed or enrico_plot_lc to make the figures")
+        return None
+    if mode == 'background':
+        worker = multiprocessing.Process(target=function, args=args)
+        worker.start()
+        return worker
+    function(*args)
+    return None
@@ -4,12 +4,9 @@ begun November 2013
 """
 import enrico.constants as cst
 import RunGTlike
-import ROOT
 import numpy,os,string,array
 from enrico import Loggin
-import matplotlib
-matplotlib.rc('text', usetex=True)
-import matplotlib.pyplot as plt
+from enrico import fitcache
 
 def MakeScan(Fit,spectrum,par,bmin,bmax,opt,N=100):
     Param = numpy.zeros(N)
@@ -26,14 +23,16 @@ def MakeScan(Fit,spectrum,par,bmin,bmax,opt,N=100):
     return Param,loglike
 
 def Scan(config):
-    ROOT.gROOT.SetBatch(ROOT.kTRUE)
-    cres = ROOT.TCanvas("Scan")
+    from enrico.plotting import LoadPyplot
+    plt = LoadPyplot()
     config["Spectrum"]["FitsGeneration"] = "no"
     FitRunner,Fit = RunGTlike.GenAnalysisObjects(config)
     spectrum = Fit[FitRunner.obs.srcname].funcs['Spectrum']
     ParName = spectrum.paramNames
 
-    Fit.fit(0,covar=False,optimizer=config['fitting']['optimizer'])
+    #start from the baseline fit if it has been cached
+    if fitcache.Restore(Fit, config) is None:
+        Fit.fit(0,covar=False,optimizer=config['fitting']['optimizer'])
 
     for par in ParName : #Loop over the parameters and get value, error and scale
       if  spectrum.getParam(par).isFree():
@@ -68,6 +67,7 @@ def Scan(config):
             frameon=None)
 
 def Contour(config):
+    import ROOT
     # ROOT.gROOT.SetBatch(ROOT.kTRUE)
 #    cres = ROOT.TCanvas("Contour")
     config["Spectrum"]["FitsGeneration"] = "no"
@@ -99,7 +99,9 @@ def Contour(config):
     if not(findpar2):
         mes.error(parname2+" is not a valid parameter")
 
-    bestloglike = Fit.fit(0,covar=False,optimizer=config['fitting']['optimizer'])
+    bestloglike = fitcache.Restore(Fit, config)
+    if bestloglike is None:
+        bestloglike = Fit.fit(0,covar=False,optimizer=config['fitting']['optimizer'])
     print spectrum
     print "Min LogLikelihood =",bestloglike
 
@@ -0,0 +1,142 @@
+"""
+Cache of the source maps of gtsrcmaps, source by source. The map of a
+source only depends on its spatial model (position, template), on its
+spectral model type, on the livetime cube, the exposure map, the binning
+(counts cube) and the IRFs: it is the same for all the bins of a light
+curve sharing these products, and in the reruns where only a few sources
+have changed. gtsrcmaps is only run for the sources whose map is not in
+the cache, and the source maps file is assembled from the cached maps and
+the other HDUs written by gtsrcmaps (counts cube, energies, GTI...),
+which are cached at the first run.
+The cache is used if [environ]/ENRICO_CACHE_DIR is set; the maps are
+stored in <ENRICO_CACHE_DIR>/srcmaps.
+"""
+import os
+import hashlib
+import xml.dom.minidom
+import pyfits
+from enrico import cache
+from enrico import timing
+from enrico import Loggin
+
+
+def SourceKey(src, basekey, cachedir):
+    """Key of the map of the source src (element of the XML model),
+    basekey being the key of the data products used by gtsrcmaps"""
+    items = [basekey, src.getAttribute('type')]
+    for spectrum in src.getElementsByTagName('spectrum'):
+        items.append(spectrum.getAttribute('type'))
+    for spatial in src.getElementsByTagName('spatialModel'):
+        items.append(spatial.getAttribute('type'))
+        if spatial.getAttribute('file') != '':
+            items.append(cache.FileHash(spatial.getAttribute('file'), cachedir))
+        for param in spatial.getElementsByTagName('parameter'):
+            items.append('%s=%s*%s' % (param.getAttribute('name'), param.getAttribute('value'),
+                                       param.getAttribute('scale')))
+    return hashlib.sha1(' '.join(items)).hexdigest()
+
+
+def _WriteSources(sources, filename):
+    """Write an XML model made of the sources"""
+    doc = xml.dom.minidom.getDOMImplementation().createDocument(None, "source_library", None)
+    lib = doc.documentElement
+    lib.setAttribute("title", "source library")
+    for src in sources:
+        lib.appendChild(src.cloneNode(True))
+    open(filename, 'w').write(doc.toprettyxml('  '))
+
+
+def _ReadHDUs(filename):
+    """HDUs of a FITS file, loaded in memory (the file is closed)"""
+    hdus = pyfits.open(filename, memmap=False)
+    try:
+        for hdu in hdus:
+            hdu.data # read now
+        return list(hdus)
+    finally:
+        hdus.close()
+
+
+def _WriteHDUs(hdus, filename):
+    tmpfile = filename+'.%d.tmp' % os.getpid()
+    pyfits.HDUList(hdus).writeto(tmpfile, clobber=True)
+    os.rename(tmpfile, filename)
+
+
+def _StoreMaps(srcmapfile, sources, keys, folder, basefile):
+    """Store the maps of the sources found in the output of gtsrcmaps, and
+    the other HDUs (counts cube, energies, GTI...) in basefile"""
+    mes = Loggin.Message()
+    hdus = _ReadHDUs(srcmapfile)
+    names = [hdu.name for hdu in hdus]
+    srcnames = [src.getAttribute('name').upper() for src in sources]
+    for src in sources:
+        name = src.getAttribute('name')
+        if name.upper() not in names:
+            mes.warning("No map for the source "+name+" in "+srcmapfile)
+            continue
+        _WriteHDUs([pyfits.PrimaryHDU(), hdus[names.index(name.upper())]],
+                   os.path.join(folder, keys[name]+'.fits'))
+    _WriteHDUs([hdus[0]]+[hdu for hdu in hdus[1:] if hdu.name not in srcnames], basefile)
+
+
+def RunSrcMaps(app, config):
+    """Run the GtApp gtsrcmaps app for the sources whose map is not in
+    the cache and assemble the output file"""
+    cachedir = cache.GetCacheDir(config)
+    if cachedir == '':
+        cache.RunCached(app, config)
+        return
+
+    mes = Loggin.Message()
+    folder = os.path.join(cachedir, 'srcmaps')
+    for subdir in ['srcmaps', 'hashes']:
+        if not os.path.isdir(os.path.join(cachedir, subdir)):
+            try:
+                os.makedirs(os.path.join(cachedir, subdir))
+            except OSError: # created by another job
+                pass
+
+    xmlfile, outfile = app['srcmdl'], app['outfile']
+    basekey = cache.ProductKey(app, cachedir, ignored=['srcmdl'])
+    sources = xml.dom.minidom.parse(xmlfile).getElementsByTagName('source')
+    keys = dict((src.getAttribute('name'), SourceKey(src, basekey, cachedir)) for src in sources)
+    missing = [src for src in sources
+               if not os.path.isfile(os.path.join(folder, keys[src.getAttribute('name')]+'.fits'))]
+    # HDUs of the output which are not source maps, from the first run
+    basefile = os.path.join(folder, basekey+'_base.fits')
+    if not missing and sources and not os.path.isfile(basefile):
+        missing = sources[:1]
+
+    with timing.Stage(config, app.appName, outfile) as stage:
+        stage.info['cached_sources'] = len(sources)-len(missing)
+        stage.info['computed_sources'] = len(missing)
+        if missing:
+            mes.info("Compute the source maps of %d source(s), %d are cached"
+                     % (len(missing), len(sources)-len(missing)))
+            tmpxml = outfile+'.%d.xml' % os.getpid()
+            tmpout = outfile+'.%d.tmp' % os.getpid()
+            _WriteSources(missing, tmpxml)
+            app['srcmdl'], app['outfile'] = tmpxml, tmpout
+            try:
+                app.run()
+                _StoreMaps(tmpout, missing, keys, folder, basefile)
+            finally:
+                app['srcmdl'], app['outfile'] = xmlfile, outfile
+                for tmpfile in [tmpxml, tmpout]:
+                    if os.path.isfile(tmpfile):
+                        os.remove(tmpfile)
+        else:
+            mes.info("All the %d source maps are cached" % len(sources))
+
+        # the source maps file is made of the HDUs written by gtsrcmaps
+        # which are not source maps, followed by the maps
+        hdus = _ReadHDUs(basefile)
+        for src in sources:
+            mapfile = os.path.join(folder, keys[src.getAttribute('name')]+'.fits')
+            if os.path.isfile(mapfile):
+                hdu = _ReadHDUs(mapfile)[1]
+                # the cached map may come from a source with another name
+                hdu.name = src.getAttribute('name')
+                hdus.append(hdu)
+        _WriteHDUs(hdus, outfile)
@@ -1,8 +1,208 @@
 """Statistics functions"""
+import os
+import numpy as np
+from scipy.stats import poisson
+from scipy.signal import fftconvolve
 
-def significance(x, mu):
-    """Li & Ma significance formula"""
-    pass
+#Step of the grid of signal means of the Feldman-Cousins belts
+FC_MU_STEP = 0.01
+#Number of signal means processed at once when building a belt
+FC_CHUNK = 1000
 
-def sensitivity():
-    pass
\ No newline at end of file
+#Maximum number of doublings of the signal to bracket the sensitivity
+SENSITIVITY_MAXSTEP = 100
+
+#Factor around the TS threshold where the Wald estimate of the TS is not
+#trusted and the full TS is computed (multiplicative, so that the band is
+#not empty for the small thresholds)
+WALD_BAND = 4.
+
+#Belts already computed, by (cl, background, step)
+_BeltCache = {}
+
+def significance(non, noff, alpha):
+    """Li & Ma (1983, eq. 17) significance of non counts in the on region,
+    noff being the counts in the off region and alpha the ratio of the on
+    and off exposures. The significance is negative for a deficit. The
+    arguments can be arrays"""
+    non, noff, alpha = np.broadcast_arrays(np.asarray(non, dtype=float),
+                                           np.asarray(noff, dtype=float),
+                                           np.asarray(alpha, dtype=float))
+    ntot = np.maximum(non+noff, 1e-20)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        termon = np.where(non > 0, non*np.log((1+alpha)/alpha*non/ntot), 0.)
+        termoff = np.where(noff > 0, noff*np.log((1+alpha)*noff/ntot), 0.)
+    sig = np.sqrt(np.maximum(2*(termon+termoff), 0.))
+    return np.where(non >= alpha*noff, sig, -sig)
+
+def _PixelRadius2(radius, binsz):
+    """Squared distances (pixels) to the center of a kernel of the given
+    radius (deg) and the squared radius in pixels"""
+    rpix = radius/binsz
+    npix = int(np.ceil(rpix-1e-6))
+    x = np.arange(-npix, npix+1)
+    # tolerance for the pixels at exactly the radius
+    return x[:, np.newaxis]**2+x[np.newaxis]**2, rpix**2*(1+1e-9)
+
+def DiskKernel(radius, binsz):
+    """Pixels closer than radius (deg) to the center, binsz (deg) being
+    the size of the pixels"""
+    r2, rmax2 = _PixelRadius2(radius, binsz)
+    return (r2 <= rmax2).astype(float)
+
+def RingKernel(rin, rout, binsz):
+    """Pixels between rin and rout (deg) from the center"""
+    r2, rmax2 = _PixelRadius2(rout, binsz)
+    return ((r2 >= (rin/binsz)**2*(1-1e-9))*(r2 <= rmax2)).astype(float)
+
+def _Convolve(image, kernel):
+    # the images and the kernels hold integers, remove the FFT round-off
+    return np.maximum(np.round(fftconvolve(image, kernel, mode='same')), 0.)
+
+def RingBackground(counts, binsz, radius, rin, rout, exclusion=None):
+    """Counts in a disk of radius (deg) around each pixel of the map counts
+    (summed over energy for a cube), counts in a ring between rin and rout
+    (deg) and ratio alpha of the on and off areas. The pixels where
+    exclusion is True are not used for the background; the edges of the
+    map are taken into account in the areas. The distances are computed in
+    pixels (flat sky approximation)"""
+    counts = np.asarray(counts, dtype=float)
+    if counts.ndim == 3:
+        counts = counts.sum(axis=0)
+    valid = np.ones(counts.shape)
+    if exclusion is not None:
+        valid[np.asarray(exclusion, dtype=bool)] = 0.
+    disk = DiskKernel(radius, binsz)
+    ring = RingKernel(rin, rout, binsz)
+    non = _Convolve(counts, disk)
+    noff = _Convolve(counts*valid, ring)
+    areaoff = _Convolve(valid, ring)
+    alpha = _Convolve(np.ones(counts.shape), disk)/np.where(areaoff > 0, areaoff, np.nan)
+    return non, noff, alpha
+
+def SignificanceMap(counts, binsz, radius, rin, rout, exclusion=None):
+    """Li & Ma significance map of the counts with a ring background (see
+    RingBackground); 0 where there is no background estimate"""
+    non, noff, alpha = RingBackground(counts, binsz, radius, rin, rout, exclusion)
+    with np.errstate(invalid='ignore'):
+        sig = significance(non, noff, alpha)
+    return np.where(np.isfinite(sig), sig, 0.)
+
+def ExclusionMask(sigmap, threshold, radius, binsz):
+    """Pixels closer than radius (deg) to a pixel of sigmap above threshold"""
+    return _Convolve(sigmap > threshold, DiskKernel(radius, binsz)) > 0
+
+def sensitivity(exposure, background, alpha=0.2, sigma=5., nmin=10.):
+    """Minimum flux (ph/cm2/s) detected at the sigma level (Li & Ma) with
+    at least nmin signal counts, for each bin of exposure (cm2 s) and
+    expected background counts in the on region. The background is
+    measured in an off region 1/alpha times larger"""
+    exposure, background, alpha = np.broadcast_arrays(np.asarray(exposure, dtype=float),
+                                                      np.asarray(background, dtype=float),
+                                                      np.asarray(alpha, dtype=float))
+    # no sensitivity without background estimate (e.g. ring fully excluded)
+    with np.errstate(invalid='ignore'):
+        valid = (np.isfinite(exposure)*(exposure > 0)*np.isfinite(background)*(background >= 0)
+                 *np.isfinite(alpha)*(alpha > 0))
+    background = np.where(valid, background, 0.)
+    alpha = np.where(valid, alpha, 1.)
+    noff = background/alpha
+    detected = lambda signal: significance(background+signal, noff, alpha) >= sigma
+
+    # bracket, then bisect, the signal counts giving sigma
+    lo = np.zeros(background.shape)
+    hi = np.maximum(sigma*np.sqrt(background), sigma**2)
+    for i in xrange(SENSITIVITY_MAXSTEP):
+        above = detected(hi)
+        if np.all(above):
+            break
+        hi = np.where(above, hi, 2*hi)
+    valid *= detected(hi)
+    for i in xrange(60):
+        mid = 0.5*(lo+hi)
+        above = detected(mid)
+        lo, hi = np.where(above, lo, mid), np.where(above, mid, hi)
+    return np.where(valid, np.maximum(hi, nmin)/np.where(valid, exposure, 1.), np.nan)
+
+def WaldWeak(wald, minTS, band=WALD_BAND):
+    """Decision on a source from the Wald estimate of its TS: True if it is
+    weak (wald < minTS/band), False if it is significant (wald > band*minTS)
+    and None if it is borderline and its full TS has to be computed"""
+    if wald < minTS/band:
+        return True
+    if wald > minTS*band:
+        return False
+    return None
+
+def FCBelt(cl, background, mumax, step=FC_MU_STEP):
+    """Feldman-Cousins confidence belt for a Poisson process with a known
+    mean background. Return the grid of signal means mu (0 to mumax) and
+    the bounds n1, n2 of the acceptance interval of the number of
+    observed events for each mu"""
+    mu = np.arange(0, mumax+step/2., step)
+    nmax = int(mumax+background+10*np.sqrt(mumax+background)+20)
+    n = np.arange(nmax+1)
+    # likelihood of each n for its best physical signal, max(0, n-b)
+    pbest = poisson.pmf(n, np.maximum(n-background, 0)+background)
+
+    n1 = np.zeros(mu.size, dtype=int)
+    n2 = np.zeros(mu.size, dtype=int)
+    for start in xrange(0, mu.size, FC_CHUNK):
+        mus = mu[start:start+FC_CHUNK, np.newaxis]
+        prob = poisson.pmf(n[np.newaxis], mus+background)
+        # add the n by decreasing likelihood ratio until cl is reached
+        order = np.argsort(-prob/pbest, axis=1, kind='mergesort')
+        cumul = np.cumsum(np.take_along_axis(prob, order, axis=1), axis=1)
+        naccept = np.sum(cumul < cl, axis=1)+1
+        rank = np.empty_like(order)
+        np.put_along_axis(rank, order, np.arange(n.size)[np.newaxis], axis=1)
+        accepted = rank < naccept[:, np.newaxis]
+        n1[start:start+FC_CHUNK] = np.argmax(accepted, axis=1)
+        n2[start:start+FC_CHUNK] = nmax-np.argmax(accepted[:, ::-1], axis=1)
+    return mu, n1, n2
+
+def _BeltFile(cachedir, cl, background, step):
+    return os.path.join(cachedir, 'FCbelt_%r_%r_%r.npz' % (cl, background, step))
+
+def GetFCBelt(cl, background, mumax, cachedir=None, step=FC_MU_STEP):
+    """Return a belt (see FCBelt) which extends at least up to mumax. The
+    belts are memoized, on disk in cachedir if given"""
+    key = (cl, background, step)
+    belt = _BeltCache.get(key)
+    if belt is None and cachedir is not None:
+        try:
+            data = np.load(_BeltFile(cachedir, cl, background, step))
+            belt = (data['mu'], data['n1'], data['n2'])
+        except IOError:
+            pass
+    if belt is not None and belt[0][-1] >= mumax:
+        _BeltCache[key] = belt
+        return belt
+
+    belt = FCBelt(cl, background, mumax, step)
+    _BeltCache[key] = belt
+    if cachedir is not None:
+        if not os.path.isdir(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError: # created by another job
+                pass
+        beltfile = _BeltFile(cachedir, cl, background, step)
+        tmpfile = beltfile+'.%d.tmp' % os.getpid()
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, mu=belt[0], n1=belt[1], n2=belt[2])
+        os.rename(tmpfile, beltfile)
+    return belt
+
+def FCInterval(nobs, background, cl=0.95, cachedir=None, step=FC_MU_STEP):
+    """Feldman-Cousins confidence interval (lower and upper limits) on the
+    mean signal for nobs observed events and a mean background"""
+    mumax = max(10., 2*(nobs-background)+10*np.sqrt(nobs+1))
+    while True:
+        mu, n1, n2 = GetFCBelt(cl, background, mumax, cachedir, step)
+        # the belt must extend beyond the upper limit
+        if n1[-1] > nobs:
+            break
+        mumax *= 2
+    inside = (n1 <= nobs)*(n2 >= nobs)
+    return mu[inside].min(), mu[inside].max()
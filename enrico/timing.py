@@ -0,0 +1,110 @@
+"""
+Instrumentation of the analysis: the wall time, the CPU time (of the job
+and of the ST tools it runs), the peak memory and the size of the output
+of each stage (ST tool, fit, TS, MINOS, UL...) are recorded following the
+[analysis]/Trace option:
+ - no : nothing is recorded
+ - yes : one JSON record per stage is appended to <out>/enrico_trace.jsonl
+ - chrome : same thing, plus <out>/enrico_trace.json which can be loaded
+   in chrome://tracing or https://ui.perfetto.dev
+Several jobs (or the processes of one job) can write in the same files.
+"""
+import os
+import json
+import time
+import socket
+import resource
+
+TRACE_FILE = 'enrico_trace.jsonl'
+CHROME_FILE = 'enrico_trace.json'
+
+
+def _TraceMode(config):
+    try:
+        return config['analysis']['Trace']
+    except KeyError:
+        return 'no'
+
+
+def _Append(filename, line):
+    # one write per record, in append mode, so that the records of
+    # concurrent processes do not mix
+    with open(filename, 'a') as f:
+        f.write(line)
+
+
+def _AppendChrome(filename, event):
+    """Append an event to a trace in the JSON array format of chrome. The
+    closing bracket is optional in this format, so the file is valid
+    whatever the number of jobs writing in it"""
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        os.write(fd, '[\n')
+        os.close(fd)
+    except OSError: # the file already exists
+        pass
+    _Append(filename, json.dumps(event)+',\n')
+
+
+class Stage(object):
+    """Context manager recording a stage of the analysis:
+
+        with timing.Stage(config, 'gtltcube', outfile) as stage:
+            ...
+            stage.info['cached'] = True
+
+    outfile is the product of the stage, whose size is recorded. The items
+    of stage.info are added to the record"""
+    def __init__(self, config, name, outfile=None):
+        self.mode = _TraceMode(config)
+        self.name = name
+        self.outfile = outfile
+        self.info = {}
+        if self.mode != 'no':
+            self.folder = config['out']
+            self.target = config['target']['name']
+
+    def __enter__(self):
+        if self.mode != 'no':
+            self.start = time.time()
+            self.times = os.times()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.mode == 'no':
+            return False
+        stop = time.time()
+        times = os.times()
+        record = {'stage': self.name,
+                  'target': self.target,
+                  'host': socket.gethostname(),
+                  'pid': os.getpid(),
+                  'start': self.start,
+                  'wall': stop-self.start,
+                  'cpu': (times[0]-self.times[0])+(times[1]-self.times[1]),
+                  # time of the ST tools, run as child processes
+                  'cpu_children': (times[2]-self.times[2])+(times[3]-self.times[3]),
+                  # peak RSS so far, in kB
+                  'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'maxrss_children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                  'status': 'ok' if exc_type is None else 'error'}
+        if self.outfile is not None:
+            record['output'] = self.outfile
+            if os.path.isfile(self.outfile):
+                record['output_size'] = os.path.getsize(self.outfile)
+        record.update(self.info)
+
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError: # created by another process
+                pass
+        _Append(os.path.join(self.folder, TRACE_FILE), json.dumps(record)+'\n')
+        if self.mode == 'chrome':
+            event = {'name': self.name, 'cat': self.target, 'ph': 'X',
+                     'ts': int(self.start*1e6), 'dur': int((stop-self.start)*1e6),
+                     'pid': record['pid'], 'tid': 0,
+                     'args': dict((key, record[key]) for key in record
+                                  if key not in ('stage', 'start', 'pid'))}
+            _AppendChrome(os.path.join(self.folder, CHROME_FILE), event)
+        return False
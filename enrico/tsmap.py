@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 import os
 import sys
+import numpy as np
 import pyfits
-from enrico.constants import TSMapPath
+from enrico.constants import TSMapPath, MEV_TO_ERG
+from enrico import stats
+from enrico import modelmap
+from enrico import diffuse
 from enrico import utils
 from enrico.submit import call
 from enrico import environ
@@ -10,6 +14,10 @@ from enrico.RunGTlike import GenAnalysisObjects
 from enrico.gtfunction import Observation
 from enrico import Loggin
 
+#Significance above which the pixels are removed from the background of
+#the quick-look map
+QUICKLOOK_EXCLUSION = 5.
+
 class TSMap(Loggin.Message):
     # This class groups all the needed functions and 
     # variables to compute a TS map
@@ -178,6 +186,103 @@ class TSMap(Loggin.Message):
         pyfits.writeto(folder+"/"+self.TSfits,data,header)
         self.info("TS Map saved in "+folder+"/"+self.TSfits)
 
+    def QuickLook(self) :
+        """ Li & Ma significance map of the count map with a ring
+        background and sensitivity at the position of the target. It takes
+        seconds and does not use the likelihood"""
+        folder = self.config['out']
+        FitRunner = Observation(folder, self.config)
+        radius = self.config['TSMap']['quicklook_radius']
+        rin, rout = self.config['TSMap']['quicklook_ring']
+        prefix = folder+"/"+self.config['target']['name']+'_'+self.config['file']['tag']
+
+        cmap = pyfits.open(FitRunner.cmapfile)
+        counts, header = cmap[0].data, cmap[0].header
+        binsz = abs(header['CDELT1'])
+        sigmap = stats.SignificanceMap(counts, binsz, radius, rin, rout)
+        # remove the significant regions from the background and redo
+        exclusion = stats.ExclusionMask(sigmap, QUICKLOOK_EXCLUSION, radius, binsz)
+        sigmap = stats.SignificanceMap(counts, binsz, radius, rin, rout, exclusion)
+        cmap.close()
+        pyfits.writeto(prefix+"_QuickLook.fits", np.asarray(sigmap, dtype=np.float32),
+                       header, clobber=True)
+        self.info("Quick-look significance map saved in "+prefix+"_QuickLook.fits")
+        self.info("Maximum significance: %.1f sigma" % sigmap.max())
+
+        if not(os.path.isfile(FitRunner.ccube) and os.path.isfile(FitRunner.BinnedMapfile)):
+            self.warning("No counts cube or binned exposure map, no sensitivity computed")
+            return
+        self.QuickLookSensitivity(FitRunner, exclusion, prefix+"_QuickLook_Sensitivity.txt")
+
+    def _TargetPixel(self, header) :
+        """ Indices (row, column) of the pixel of the map containing the
+        target, None if it is outside the map"""
+        from kapteyn import wcs
+        ra = float(self.config['target']['ra'])
+        dec = float(self.config['target']['dec'])
+        if header['CTYPE1'].startswith('GLON'):
+            ra, dec = diffuse.CelToGal(ra, dec)
+        proj = wcs.Projection(header)
+        if header['NAXIS'] > 2:
+            proj = proj.sub((1, 2))
+        x, y = proj.topixel((ra, dec))
+        # the FITS pixels start at 1
+        col, row = int(round(x))-1, int(round(y))-1
+        if not(0 <= col < header['NAXIS1'] and 0 <= row < header['NAXIS2']):
+            return None
+        return row, col
+
+    def QuickLookSensitivity(self, FitRunner, exclusion, filename) :
+        """ Sensitivity in each energy bin of the counts cube at the
+        position of the target, the background being estimated in the ring"""
+        radius = self.config['TSMap']['quicklook_radius']
+        rin, rout = self.config['TSMap']['quicklook_ring']
+        ccube = pyfits.open(FitRunner.ccube)
+        header = ccube[0].header
+        ebounds = modelmap.PlaneEnergies(ccube)
+        binsz = abs(header['CDELT1'])
+        if exclusion.shape != ccube[0].data.shape[1:]:
+            exclusion = None
+        pixel = self._TargetPixel(header)
+        if pixel is None:
+            ccube.close()
+            self.warning("The target is outside the counts cube, no sensitivity computed")
+            return
+        y, x = pixel
+        background = np.zeros(ebounds.size-1)
+        for k in xrange(ebounds.size-1):
+            _, noff, alpha = stats.RingBackground(ccube[0].data[k], binsz, radius,
+                                                  rin, rout, exclusion)
+            background[k] = noff[y, x]*alpha[y, x]
+        alpha = alpha[y, x]
+        ccube.close()
+
+        expmap = pyfits.open(FitRunner.BinnedMapfile)
+        pixel = self._TargetPixel(expmap[0].header)
+        if pixel is None:
+            expmap.close()
+            self.warning("The target is outside the exposure map, no sensitivity computed")
+            return
+        iy, ix = pixel
+        exposure = np.interp(np.log(ebounds), np.log(modelmap.PlaneEnergies(expmap)),
+                             expmap[0].data[:, iy, ix])
+        exposure = 0.5*(exposure[1:]+exposure[:-1])
+        expmap.close()
+
+        flux = stats.sensitivity(exposure, background, alpha)
+        if not np.all(np.isfinite(flux)):
+            self.warning("No background estimate in some energy bins (ring excluded or "
+                         "outside the map), their sensitivity is nan")
+        # E2dN/dE of a power law of index 2 with this flux in the bin
+        e2dnde = flux/(1/ebounds[:-1]-1/ebounds[1:])*MEV_TO_ERG
+        fsave = open(filename, 'w')
+        fsave.write("# Emin(MeV) Emax(MeV) Background Exposure(cm2 s) Flux(ph/cm2/s) E2dN/dE(erg/cm2/s)\n")
+        for k in xrange(ebounds.size-1):
+            fsave.write("%g\t%g\t%g\t%g\t%g\t%g\n" % (ebounds[k], ebounds[k+1], background[k],
+                                                    exposure[k], flux[k], e2dnde[k]))
+        fsave.close()
+        self.info("Quick-look sensitivity saved in "+filename)
+
 
 def GetSrc(Fit,ra,dec):
     """ return a Source object by cloning a pointlike source from the Fit object
@@ -184,7 +184,7 @@ def FreezeParams(fit, name, parameter, value):
         fit.logLike.getSource(name).getSrcFuncs()['Spectrum'].getParam(parameter).setValue(value)
         fit.logLike.getSource(name).getSrcFuncs()['Spectrum'].getParam(parameter).setFree(0)
     except:
-        for comp in self.components:
+        for comp in fit.components:
             try:
                 comp.logLike.getSource(name).getSrcFuncs()['Spectrum'].getParam(parameter).setBounds(value,value)
                 comp.logLike.getSource(name).getSrcFuncs()['Spectrum'].getParam(parameter).setValue(value)
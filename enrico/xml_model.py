@@ -1,12 +1,27 @@
 """Central place for the XML generation"""
 import os
 import sys
+import time
+import StringIO
 import xml.dom.minidom
 import numpy as np
 import pyfits
 from enrico import utils
+from enrico import catalog
+from enrico import diffuse
 import enrico.environ as env
 
+#Name of the source made of the fixed point sources ([model]/merge_fixed)
+FIXEDSOURCES = "FixedSources"
+#evtype and suffix of the XML file of the components of the analysis,
+#for each option of [ComponentAnalysis]
+COMPONENTS = [('FrontBack', [(1, 'FRONT'), (2, 'BACK')]),
+              ('PSF', [(4, 'PSF0'), (8, 'PSF1'), (16, 'PSF2'), (32, 'PSF3')]),
+              ('EDISP', [(64, 'EDISP0'), (128, 'EDISP1'), (256, 'EDISP2'), (512, 'EDISP3')])]
+#Binning of the template of the fixed sources
+TEMPLATE_BINS_PER_DECADE = 10
+TEMPLATE_MIN_COSLAT = 0.25
+
 
 def addParameter(el, name, free, value, scale, min, max):
     """Add a parameter to a source"""
@@ -296,7 +311,7 @@ def AddSpatial(doc,ra,dec,extendedName=""):
 
     return spatial
 
-def GetlistFromFits(config, catalog):
+def GetlistFromFits(config, catalogfile):
     from enrico import Loggin
     mes = Loggin.Message()
     """Read the config and catalog file and generate the list of sources to include"""
@@ -319,79 +334,32 @@ def GetlistFromFits(config, catalog):
         model = "PowerLaw"
 
     #read the catalog file
-    cfile = pyfits.open(catalog)
-    data = cfile[1].data
-    names = data.field('Source_Name')
-    ra = data.field('RAJ2000')
-    dec = data.field('DEJ2000')
-    flux = data.field('Flux_Density')
-    pivot = data.field('Pivot_Energy')
-    is8yr = 'FL8Y' in cfile[1].header['CDS-NAME']
-    try :  # valid for the 2FGH, not for the 1FHL
-      if is8yr:
-        spectype = data.field('SpectrumType')
-        index = data.field('PL_Index')
-        #if spectype is 'PowerLaw':
-        #    index = data.field('PL_Index')
-        #if spectype is 'LogParabola':
-        #index = data.field('LP_Index')
-        beta  = data.field('LP_beta')
-        #if spectype is 'PLSuperExpCutoff2':
-        # From the makeFL8Yxml.py script
-        #index  = data.field('PLEC_Index')
-        #pivot  = data.field('PivotEnergy')
-        expfac = data.field('PLEC_Expfactor')
-        expind = data.field('PLEC_Exp_Index')
-        cutoff=(1./expfac)**(1./expind)
-        #cutoff = data.field('Cutoff')
-        #beta = data.field('LP_beta')
-      else:
-        index = data.field('Spectral_Index')
-        cutoff = data.field('Cutoff')
-        beta = data.field('beta')
-        spectype = data.field('SpectrumType')
-    except :
-      raise
-      index = data.field('Spectral_Index')
-      cutoff = np.zeros(names.size)
-      beta = np.zeros(names.size)
-      spectype = np.array(names.size*["PowerLaw"])
-      pivot *= 1e3 ## energy in the 1FHL are in GeV
-      flux *= 1e3
-
-    try :
-      extendedName    = data.field('Extended_Source_Name')
-      if is8yr:
-        extendedfits    = cfile[2].data.field('Spatial_Filename')
-        extendedsrcname = cfile[2].data.field('Source_Name')
-      else:
-        extendedfits    = cfile[5].data.field('Spatial_Filename')
-        extendedsrcname = cfile[5].data.field('Source_Name')
-    except:
-      raise
-      mes.warning("Cannot find the extended source list: please check the xml")
-      extendedName = np.array(names.size*[""])
-      extendedsrcname = []
-
-
-    sigma = data.field('Signif_Avg')
+    cat = catalog.LoadCatalog(catalogfile, config)
+    names = cat.names
+    ra = cat.ra
+    dec = cat.dec
+    flux = cat.flux
+    pivot = cat.pivot
+    index = cat.index
+    cutoff = cat.cutoff
+    beta = cat.beta
+    spectype = cat.spectype
+    sigma = cat.sigma
+    extendedName = cat.extendedName
+
+    #only the sources close to the target or in the ROI can be added
+    candidates = np.union1d(cat.Cone(ra_src, dec_src, max(max_radius, .1)),
+                            cat.Cone(ra_space, dec_space, roi))
+    #distance from the center of the maps and from the target
+    rspaces = cat.Separation(ra_space, dec_space, candidates)
+    rsrcs = cat.Separation(ra_src, dec_src, candidates)
 
     sources = []
     Nfree = 0
     Nextended = 0
-    #loop over all the sources of the catalog
-    for i in xrange(len(names)):
-        #distance from the center of the maps
-        rspace = utils.calcAngSepDeg(float(ra[i]), float(dec[i]), ra_space, dec_space)
-        #distance for the target
-        rsrc = utils.calcAngSepDeg(float(ra[i]), float(dec[i]), ra_src, dec_src)
-
-        j=0
-        extended_fitsfilename = ""
-        for extname in extendedsrcname:
-            if extname == extendedName[i]:
-                extended_fitsfilename = extendedfits[j]
-            j+=1
+    #loop over the candidate sources, in the order of the catalog
+    for i, rspace, rsrc in zip(candidates, rspaces, rsrcs):
+        extended_fitsfilename = cat.extended[i]
 
         # if the source has a separation less than 0.1deg to the target and has
         # the same model type as the one we want to use, insert as our target
@@ -453,7 +421,7 @@ def GetlistFromFits(config, catalog):
     print Nextended, " source(s) is (are) extended"
 
     #save log of the generation of the xml
-    save = "catalog: "+catalog+"\n"
+    save = "catalog: "+catalogfile+"\n"
     save += "Add "+str(len(sources))+" sources in the ROI of "+str(roi)+ "("+str(config['space']['rad'])+"+ 2 ) degrees\n"
     save += " sources have free parameters inside "+str(max_radius)+" degrees\n"
     save += str(Nextended)+" source(s) is (are) extended\n"
@@ -463,22 +431,94 @@ def GetlistFromFits(config, catalog):
 
     return sources
 
+def SpectrumDNDE(src, energy, emin, emax):
+    """dN/dE (ph/cm2/s/MeV) of a source of the list made by GetlistFromFits,
+    as modelled by WriteXml, at the energies energy (MeV)"""
+    spectype = src.get('SpectrumType').strip()
+    flux = float(src.get('flux'))
+    index = float(src.get('index'))
+    escale = float(src.get('scale'))
+    if spectype == "PowerLaw":
+        return flux*(energy/escale)**index
+    if spectype == "PowerLaw2":
+        return flux*(index+1)*energy**index/(emax**(index+1)-emin**(index+1))
+    if spectype == "LogParabola":
+        x = energy/escale
+        return flux*x**(-(abs(index)+float(src.get('beta'))*np.log(x)))
+    if spectype in ["PLExpCutoff", "PLSuperExpCutoff", "PLSuperExpCutoff2"]:
+        return flux*(energy/escale)**index*np.exp(-energy/float(src.get('cutoff')))
+    raise ValueError("unknown model %s" %spectype)
+
+def MakeFixedSourcesTemplate(srclist, config, filename):
+    """Sum the intensity of the fixed point sources of srclist in a
+    map cube (CAR projection, celestial coordinates), to be used as a single
+    diffuse source with a MapCubeFunction. The position of the sources is
+    rounded to the pixels of the cube, which are convolved with the PSF
+    by gtsrcmaps as for the other diffuse sources."""
+    emin = float(config['energy']['emin'])
+    emax = float(config['energy']['emax'])
+    ra0 = float(config['space']['xref'])
+    dec0 = float(config['space']['yref'])
+    binsz = float(config['space']['binsz'])
+    # the sources are within rad+2 degrees, plus a margin of one degree
+    radius = float(config['space']['rad'])+3
+
+    # energy planes slightly beyond the range of the analysis
+    nenergy = max(2, int(np.log10(emax/emin)*TEMPLATE_BINS_PER_DECADE+0.5)+1)
+    energy = np.logspace(np.log10(emin/1.1), np.log10(emax*1.1), nenergy)
+
+    # plate carree grid: with CRVAL2 = 0 pixels are aligned with RA and Dec
+    latmin, latmax = max(-90., dec0-radius), min(90., dec0+radius)
+    coslat = np.cos(np.radians(max(abs(latmin), abs(latmax))))
+    cdelt1 = binsz/max(coslat, TEMPLATE_MIN_COSLAT)
+    nlon = int(min(360., 2*radius/max(coslat, 1e-3))/cdelt1)+1
+    nlat = int((latmax-latmin)/binsz)+1
+    crpix1 = (nlon+1)/2.
+    crpix2 = 1-latmin/binsz
+
+    cube = np.zeros((nenergy, nlat, nlon))
+    for src in srclist:
+        dlon = (float(src.get('ra'))-ra0+180.) % 360.-180.
+        i = int(np.floor(-dlon/cdelt1+crpix1-0.5))
+        j = int(np.floor(float(src.get('dec'))/binsz+crpix2-0.5))
+        if i < 0 or i >= nlon or j < 0 or j >= nlat:
+            continue
+        lat = (j+1-crpix2)*binsz
+        solidangle = np.radians(cdelt1)*np.radians(binsz)*np.cos(np.radians(lat))
+        cube[:, j, i] += SpectrumDNDE(src, energy, emin, emax)/max(solidangle, 1e-12)
+
+    hdu = pyfits.PrimaryHDU(cube.astype(np.float32))
+    header = hdu.header
+    for key, value in [('CTYPE1', 'RA---CAR'), ('CRVAL1', ra0), ('CRPIX1', crpix1),
+                       ('CDELT1', -cdelt1), ('CTYPE2', 'DEC--CAR'), ('CRVAL2', 0.),
+                       ('CRPIX2', crpix2), ('CDELT2', binsz), ('CTYPE3', 'Energy'),
+                       ('CRVAL3', 1.), ('CRPIX3', 1.), ('CDELT3', 1.), ('CUNIT3', 'MeV'),
+                       ('BUNIT', 'photon/cm**2/MeV/s/sr'), ('RADESYS', 'FK5'),
+                       ('EQUINOX', 2000.)]:
+        header[key] = value
+    col = pyfits.Column(name='Energy', format='D', unit='MeV', array=energy)
+    try:
+        energies = pyfits.BinTableHDU.from_columns([col])
+    except AttributeError: # pyfits < 3.3
+        energies = pyfits.new_table([col])
+    energies.name = 'ENERGIES'
+    pyfits.HDUList([hdu, energies]).writeto(filename, clobber=True)
+
+def IsMerged(src, config):
+    """True if the source is merged in the template of the fixed sources"""
+    return (src.get('IsFree') == 0 and src.get('ExtendedName') == "" and
+            src.get('name') != config['target']['name'])
+
 def IsIn(name, sources):
     for source in sources:
         if source == name:
             return True
     return False
 
-def WriteXml(lib, doc, srclist, config):
+def DiffuseModels(config):
+    """Return the files of the galactic and isotropic diffuse models"""
     from enrico import Loggin
     mes = Loggin.Message()
-    """Fill and write the library of sources into an XML file"""
-    emin = config['energy']['emin']
-    emax = config['energy']['emax']
-
-    Galname = "GalDiffModel"
-    Isoname = "IsoDiffModel"
-
     #test if the user provides diffuse files. if not  use the default one
     if config['model']['diffuse_gal_dir'] == "":
         Gal_dir = env.DIFFUSE_DIR
@@ -507,15 +547,23 @@ def WriteXml(lib, doc, srclist, config):
     else:
         Iso = Iso_dir + "/" + config['model']['diffuse_iso']
 
+    # use only the part of the galactic model around the ROI
+    if config['model']['diffuse_cutout'] == 'yes':
+        Gal = diffuse.GalacticCutout(Gal, config)
 
-    #add diffuse sources
-    addDiffusePL(lib, Iso, free=1, value=1.0,
-                 max=10.0, min=1.0, name=Isoname)
-    addGalprop(lib, Gal, free=1, value=1.0, scale=1.0,
-               max=10.0, min=.010, name=Galname)
+    return Gal, Iso
 
-    print "Iso model file ",Iso
-    print "Galactic model file ",Gal
+
+def SourcesXml(srclist, config):
+    """Make the XML elements of the sources of srclist (and of the template
+    of the fixed sources, see [model]/merge_fixed) and return them as a
+    string. It does not depend on the component of the analysis, so it is
+    made once for all the XML files of a target"""
+    from enrico import Loggin
+    mes = Loggin.Message()
+    emin = config['energy']['emin']
+    emax = config['energy']['emax']
+    lib, doc = CreateLib()
 
     yesnodict = {}
     for y in ['yes',True,'true',1,1.0,'1','1.0']:
@@ -535,8 +583,24 @@ def WriteXml(lib, doc, srclist, config):
     except NameError:
         ebldict = None
 
+    # merge the fixed point sources into a single map cube
+    merge = False
+    if config['model']['merge_fixed'] == 'yes':
+        if config['analysis']['likelihood'] == 'binned':
+            merge = True
+            template = config['out']+'/'+config['target']['name']+'_FixedSources.fits'
+            merged = [src for src in srclist if IsMerged(src, config)]
+            mes.info("Merge %d fixed sources into the template %s" %(len(merged), template))
+            MakeFixedSourcesTemplate(merged, config, template)
+            addGalprop(lib, template, free=0, value=1.0, scale=1.0,
+                       max=10.0, min=.010, name=FIXEDSOURCES)
+        else:
+            mes.warning("merge_fixed is only used for binned analyses")
+
     # loop over the list of sources and add it to the library
     for i in xrange(len(srclist)):
+        if merge and IsMerged(srclist[i], config):
+            continue
         name = srclist[i].get('name')
         if (name == config['target']['name']):
             ebl = ebldict
@@ -579,13 +643,47 @@ def WriteXml(lib, doc, srclist, config):
         else:
             print('Warning!!!, unknown model %s' %spectype.strip())
 
+    xmlstring = StringIO.StringIO()
+    for node in lib.childNodes:
+        if node.nodeType == node.ELEMENT_NODE:
+            node.writexml(xmlstring, '  ', '  ', '\n')
+    return xmlstring.getvalue()
+
+
+def WriteXml(srcxml, config):
+    """Write the XML file of the model, made of the diffuse models and of
+    the sources srcxml (see SourcesXml). The file is written as it is made,
+    in the same format as toprettyxml"""
+    from enrico import Loggin
+    mes = Loggin.Message()
+    Galname = "GalDiffModel"
+    Isoname = "IsoDiffModel"
+    Gal, Iso = DiffuseModels(config)
+
+    lib, doc = CreateLib()
+    #add diffuse sources
+    addDiffusePL(lib, Iso, free=1, value=1.0,
+                 max=10.0, min=1.0, name=Isoname)
+    addGalprop(lib, Gal, free=1, value=1.0, scale=1.0,
+               max=10.0, min=.010, name=Galname)
+
+    print "Iso model file ",Iso
+    print "Galactic model file ",Gal
+
     folder = config['out']
     os.system('mkdir -p ' + folder)
 
     output = config['file']['xml']
 
     mes.info("write the Xml file in "+output)
-    open(output, 'w').write(doc.toprettyxml('  '))#save it
+    xmlfile = open(output, 'w')
+    xmlfile.write('<?xml version="1.0" ?>\n')
+    xmlfile.write('<%s title="%s">\n' % (lib.tagName, lib.getAttribute('title')))
+    for node in lib.childNodes:
+        node.writexml(xmlfile, '  ', '  ', '\n')
+    xmlfile.write(srcxml)
+    xmlfile.write('</%s>\n' % lib.tagName)
+    xmlfile.close()
 
 
 def CreateLib():
@@ -624,9 +722,8 @@ def Xml_to_Reg(Filename, listSource, Prog=None):
     fds9.close()
 
 
-def XmlMaker(config):
-    folder = config['out']
-    os.system('mkdir -p ' + folder)
+def GetCatalog(config):
+    """Return the catalog file to use"""
     # test if the user provide a catalog or not.
     #if not use the default one
     if config['environ']['FERMI_CATALOG_DIR'] == '':
@@ -636,73 +733,53 @@ def XmlMaker(config):
         catalogDir = config['environ']['FERMI_CATALOG_DIR']
 
     if config['environ']['FERMI_CATALOG'] == '':
-        catalog = catalogDir + "/" + env.CATALOG
+        catalogfile = catalogDir + "/" + env.CATALOG
         print "use the default catalog"
     else:
-        catalog = catalogDir + "/" + config['environ']['FERMI_CATALOG']
+        catalogfile = catalogDir + "/" + config['environ']['FERMI_CATALOG']
+    return catalogfile
 
-    print "Use the catalog : ", catalog
 
-    lib, doc = CreateLib()
-    srclist = GetlistFromFits(config, catalog)
+def GetComponents(config):
+    """Return the (evtype, suffix of the XML file) of the components of the
+    analysis, see [ComponentAnalysis]"""
+    for option, components in COMPONENTS:
+        if config['ComponentAnalysis'][option] == "yes":
+            return components
+    return [(config["event"]["evtype"], "")]
+
+
+def XmlMaker(config):
+    folder = config['out']
+    os.system('mkdir -p ' + folder)
+    catalogfile = GetCatalog(config)
+    print "Use the catalog : ", catalogfile
 
+    srclist = GetlistFromFits(config, catalogfile)
+    srcxml = SourcesXml(srclist, config)
 
-    # deal with the summedlike analysis
+    # deal with the summedlike analysis: one file per component
     xml = config["file"]["xml"]
-    if config['ComponentAnalysis']['FrontBack'] == "yes":
-      config["event"]["evtype"] = 1
-      config["file"]["xml"] = xml.replace(".xml","_FRONT.xml")
-      WriteXml(lib, doc, srclist, config)
-    
-      lib, doc = CreateLib()
-      config["event"]["evtype"] = 2
-      config["file"]["xml"] = xml.replace(".xml","_BACK.xml")
-      WriteXml(lib, doc, srclist, config)
-
-    elif config['ComponentAnalysis']['PSF'] == "yes":
-      config["event"]["evtype"] = 4
-      config["file"]["xml"] = xml.replace(".xml","_PSF0.xml")
-      WriteXml(lib, doc, srclist, config)
-    
-      lib, doc = CreateLib()
-      config["event"]["evtype"] = 8
-      config["file"]["xml"] = xml.replace(".xml","_PSF1.xml")
-      WriteXml(lib, doc, srclist, config)
-
-      lib, doc = CreateLib()
-      config["event"]["evtype"] = 16
-      config["file"]["xml"] = xml.replace(".xml","_PSF2.xml")
-      WriteXml(lib, doc, srclist, config)
-
-      lib, doc = CreateLib()
-      config["event"]["evtype"] = 32
-      config["file"]["xml"] = xml.replace(".xml","_PSF3.xml")
-      WriteXml(lib, doc, srclist, config)
-
-    elif config['ComponentAnalysis']['EDISP'] == "yes":
-      config["event"]["evtype"] = 64
-      config["file"]["xml"] = xml.replace(".xml","_EDISP0.xml")
-      WriteXml(lib, doc, srclist, config)
-    
-      lib, doc = CreateLib()
-      config["event"]["evtype"] = 128
-      config["file"]["xml"] = xml.replace(".xml","_EDISP1.xml")
-      WriteXml(lib, doc, srclist, config)
-
-      lib, doc = CreateLib()
-      config["event"]["evtype"] = 256
-      config["file"]["xml"] = xml.replace(".xml","_EDISP2.xml")
-      WriteXml(lib, doc, srclist, config)
-
-      lib, doc = CreateLib()
-      config["event"]["evtype"] = 512
-      config["file"]["xml"] = xml.replace(".xml","_EDISP3.xml")
-      WriteXml(lib, doc, srclist, config)
-    else :
-      WriteXml(lib, doc, srclist, config)
-    
+    for evt, suffix in GetComponents(config):
+        config["event"]["evtype"] = evt
+        if suffix != "":
+            config["file"]["xml"] = xml.replace(".xml","_"+suffix+".xml")
+        WriteXml(srcxml, config)
+
     # Recover the old xml file.
     config["file"]["xml"] = xml
 
     Xml_to_Reg(folder + "/Roi_model",
         srclist, Prog=sys.argv[0])
+
+
+def XmlMakerBatch(configs):
+    """Make the XML models of many targets. The catalog is read once and
+    the sources of each target are found in memory"""
+    from enrico import Loggin
+    mes = Loggin.Message()
+    start = time.time()
+    for config in configs:
+        mes.info("Make the XML model of "+config['target']['name'])
+        XmlMaker(config)
+    mes.info("%d XML models made in %.1f s" % (len(configs), time.time()-start))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""Check the downloader (enrico.download) against local stand-in servers:
+an HTTP server with Range/If-Range support (SimpleHTTPServer) and an FTP
+server (pyftpdlib, skipped if it is not installed). For both protocols,
+check a fresh download, an incremental update, the resume of a partial
+file, a partial file of an older version of the remote file and the
+verify mode."""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import ftplib
+import urllib2
+import urlparse
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+from enrico import download
+
+logging.basicConfig(level=logging.WARNING)
+
+
+class RangeHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve the files with Range, If-Range and a strong ETag"""
+    def log_message(self, *args):
+        pass
+
+    def _Head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return None
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return False
+        data = open(path, 'rb').read()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        start = 0
+        rng = self.headers.getheader('Range')
+        ifrange = self.headers.getheader('If-Range')
+        if rng is not None and (ifrange is None or ifrange == etag):
+            start = int(rng.split('=')[1].rstrip('-'))
+            if start >= len(data):
+                self.send_error(416)
+                return False
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(os.stat(path).st_mtime))
+        self.send_header('Content-Length', str(len(data)-start))
+        self.end_headers()
+        return data[start:]
+
+    def do_HEAD(self):
+        if self._Head() is None:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+
+    def do_GET(self):
+        body = self._Head()
+        if body is None: # directory listing
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+        elif body:
+            self.wfile.write(body)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def StartHttp(root):
+    os.chdir(root)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d/weekly' % server.server_address[1], server.shutdown
+
+
+def StartFtp(root):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    handler = FTPHandler
+    handler.authorizer = authorizer
+    server = FTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'ftp://127.0.0.1:%d/weekly' % server.address[1], server.close_all
+
+
+def Validator(url):
+    """Version of the remote file, as recorded by the downloader"""
+    if url.startswith('ftp://'):
+        parts = urlparse.urlparse(url)
+        ftp = ftplib.FTP()
+        ftp.connect(parts.hostname, parts.port)
+        ftp.login()
+        try:
+            return ftp.sendcmd('MDTM '+parts.path)
+        finally:
+            ftp.close()
+    request = urllib2.Request(url)
+    request.get_method = lambda: 'HEAD'
+    return urllib2.urlopen(request).info().getheader('ETag')
+
+
+def Check(condition, message):
+    print('%-60s %s' % (message, 'OK' if condition else 'FAILED'))
+    if not condition:
+        sys.exit(1)
+
+
+def Content(path):
+    return open(path, 'rb').read()
+
+
+def CheckProtocol(url, remote, local):
+    name = url.split('://')[0].upper()
+    remotefile = lambda i: os.path.join(remote, 'week_%d.fits' % i)
+    localfile = lambda i: os.path.join(local, 'week_%d.fits' % i)
+    mirror = lambda verify=False: download.Download(
+        download.MirrorTasks(url, local, '*.fits'), 3, verify)
+
+    # fresh download
+    failed = mirror()
+    Check(failed == [] and all(Content(localfile(i)) == Content(remotefile(i)) for i in range(1, 4)),
+          name+': fresh download')
+    manifest = download.ReadManifest(local)
+    Check(sorted(manifest) == ['week_%d.fits' % i for i in range(1, 4)], name+': manifest')
+
+    # incremental: only the new file is fetched
+    open(remotefile(4), 'wb').write(os.urandom(200000))
+    before = dict((i, os.stat(localfile(i)).st_mtime) for i in range(1, 4))
+    time.sleep(1.1)
+    mirror()
+    Check(Content(localfile(4)) == Content(remotefile(4)) and
+          all(os.stat(localfile(i)).st_mtime == before[i] for i in range(1, 4)),
+          name+': incremental download')
+
+    # resume: the first bytes of the partial file are kept (they are made
+    # different from the remote ones to see it), the rest is fetched
+    data = Content(remotefile(2))
+    os.remove(localfile(2))
+    manifest = download.ReadManifest(local)
+    del manifest['week_2.fits']
+    download.WriteManifest(local, manifest)
+    prefix = 'x'*1000
+    open(localfile(2)+'.part', 'wb').write(prefix)
+    json.dump({'size': len(data), 'validator': Validator(url+'/week_2.fits')},
+              open(localfile(2)+'.part.json', 'w'))
+    mirror()
+    Check(Content(localfile(2)) == prefix+data[len(prefix):] and
+          not os.path.exists(localfile(2)+'.part.json'), name+': resume of a partial file')
+    os.remove(localfile(2))
+    mirror()
+    Check(Content(localfile(2)) == data, name+': download again')
+
+    # partial file of an older version, the new one having the same size
+    data = Content(remotefile(3))
+    validator = Validator(url+'/week_3.fits')
+    os.remove(localfile(3))
+    open(localfile(3)+'.part', 'wb').write(data[:1000])
+    json.dump({'size': len(data), 'validator': validator}, open(localfile(3)+'.part.json', 'w'))
+    newdata = os.urandom(len(data))
+    open(remotefile(3), 'wb').write(newdata)
+    mtime = time.time()+10 # the FTP modification time is given in seconds
+    os.utime(remotefile(3), (mtime, mtime))
+    mirror()
+    Check(Content(localfile(3)) == newdata, name+': partial file of an older version')
+
+    # verify: a corrupted file of the right size is only found in verify mode
+    corrupted = 'y'*100+Content(localfile(1))[100:]
+    open(localfile(1), 'wb').write(corrupted)
+    mirror()
+    Check(Content(localfile(1)) == corrupted, name+': corrupted file kept without verify')
+    mirror(verify=True)
+    Check(Content(localfile(1)) == Content(remotefile(1)), name+': corrupted file fetched again (verify)')
+
+
+def Setup(folder):
+    remote = os.path.join(folder, 'remote', 'weekly')
+    os.makedirs(remote)
+    for i in range(1, 4):
+        open(os.path.join(remote, 'week_%d.fits' % i), 'wb').write(os.urandom(100000*i+17))
+    open(os.path.join(remote, 'readme.txt'), 'w').write('not a fits file\n')
+    return os.path.join(folder, 'remote'), remote
+
+
+if __name__ == '__main__':
+    folder = tempfile.mkdtemp(prefix='enrico_download_')
+    cwd = os.getcwd()
+    try:
+        root, remote = Setup(os.path.join(folder, 'http'))
+        url, stop = StartHttp(root)
+        try:
+            CheckProtocol(url, remote, os.path.join(folder, 'http', 'local'))
+        finally:
+            stop()
+            os.chdir(cwd)
+
+        try:
+            import pyftpdlib
+        except ImportError:
+            print('pyftpdlib is not installed, FTP not checked')
+        else:
+            root, remote = Setup(os.path.join(folder, 'ftp'))
+            url, stop = StartFtp(root)
+            try:
+                CheckProtocol(url, remote, os.path.join(folder, 'ftp', 'local'))
+            finally:
+                stop()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print('All the checks passed')
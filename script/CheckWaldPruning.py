@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+"""Check the decisions taken from the Wald estimate of the TS when the
+weak sources are removed (FitMaker.RemoveWeakSources): with the default
+threshold (min_source_TS = 1), a source at TS~0 is removed without
+computing its full TS, a bright source is kept and only the borderline
+sources need the full TS."""
+from enrico import stats
+
+minTS = 1.
+for wald, expected in [(0., True), (0.1, True), (0.2, True),
+                       (1., None), (3., None),
+                       (5., False), (100., False)]:
+    decision = stats.WaldWeak(wald, minTS)
+    status = 'OK' if decision is expected else 'FAILED'
+    print('Wald TS %6.2f : %-5s %s' % (wald, decision, status))
+    assert decision is expected
+print('All the checks passed')